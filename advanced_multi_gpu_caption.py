@@ -1,74 +1,272 @@
 import json
 import os
-from datasets import load_dataset
 from tqdm import tqdm
 import multiprocessing as mp
 from multiprocessing import Queue, Process, Manager, Value
-import torch
-from transformers import AutoProcessor, AutoModelForImageTextToText
-import qwen_vl_utils.vision_process
 from PIL import Image
 import time
-from queue import Empty
+from queue import Empty, Full
 import gc
-import psutil
 import threading
-from contextlib import contextmanager
+from contextlib import contextmanager, nullcontext
 import logging
 import signal
 import sys
+from lazy_imports import lazy_import, get_import_times, format_import_times
+from autotune import load_profile, apply_profile
+from cpu_backend import available_cores, pin_to_cores, quantize_dynamic_int8
+from embedding_store import EmbeddingStore, VisionFeatureCapture, pool_features
+from multi_prompt import (PRIMARY_PROMPT, build_prompt_messages, encode_images, missing_prompts,
+                          select_image_features, write_outputs)
+from preprocessing_profile import (DEFAULT_PREPROCESS_PROFILE_PATH, apply_preprocess_profile, count_vision_tokens,
+                                   describe_preprocess_profile, load_preprocess_profile)
+from placement import build_placement, device_index, group_by_device, format_placement
+from caption_decoding import DEFAULT_MAX_CAPTION_WORDS, build_caption_stopping_criteria, decode_new_tokens
+from assisted_decoding import AssistedDecoder, merge_assist_stats, summarize_assist_stats
+from retry_queue import RetryScheduler
+from compiled_execution import (DEFAULT_BATCH_BUCKETS, DEFAULT_SIZE_BUCKETS, CompiledExecution,
+                                summarize_compile_stats)
+from elastic_pool import (DEFAULT_CONTROL_FILE, DEFAULT_RESCAN_INTERVAL, ElasticWorkerPool,
+                          discover_devices)
+from flow_control import (DEFAULT_MAX_MEMORY_PERCENT, PROGRESS_QUEUE_SIZE, RESULT_QUEUE_PER_WORKER,
+                          TASK_PREFETCH_PER_WORKER, QueueOccupancy, TaskFeeder, put_progress)
+from image_sources import DEFAULT_IMAGE_ROOT, ArchiveSource, create_shard_local_batches, open_image_source
+from image_validation import DEFAULT_NEGATIVE_CACHE_PATH, validate_tasks, write_validation_report
+from task_table import TaskTable, batch_pickle_bytes
+from task_trace import DEFAULT_TRACE_PATH, TraceCollector, TraceSampler, mark, mark_all
+from telemetry import DEFAULT_TELEMETRY_PATH, TelemetrySampler
+from thread_budget import (DEFAULT_INTER_OP_THREADS, DEFAULT_RESERVED_CORES, StageTimer, apply_thread_budget,
+                           format_stage_cpu, format_thread_layout, plan_thread_budgets, reserve_main_process,
+                           set_torch_threads)
+from template_tracker import DEFAULT_TEMPLATE_OUTPUT_DIR, TemplateCompletionTracker, create_template_batches
 
 # 设置日志
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# 设置视觉处理参数
-qwen_vl_utils.vision_process.MIN_PIXELS = 28 * 28 * 8
-qwen_vl_utils.vision_process.MAX_PIXELS = 28 * 28 * 64
+def _import_heavy_modules():
+    """延迟导入 torch / transformers，只在真正需要模型的工作进程中调用"""
+    torch = lazy_import("torch")
+    transformers = lazy_import("transformers")
+    return torch, transformers
+
+# 描述生成的消息模板
+CAPTION_MESSAGES = [
+    {
+        "role": "user",
+        "content": [
+            {"type": "image"},
+            {"type": "text", "text": "describe the image briefly, within 30 words, output the description directly, do not start with 'the image is' or 'the photo is' or 'I can see' or anything that start with this image."},
+        ],
+    }
+]
+
+def make_result(task, caption, success, **extra):
+    """构造结果字典；服务模式下原样带回任务的 task_id 以便匹配请求"""
+    result = {
+        'image_path': task['image_path'],
+        'output_path': task['output_path'],
+        'caption': caption,
+        'success': success
+    }
+    if 'task_id' in task:
+        result['task_id'] = task['task_id']
+    if task.get('retry_attempt'):
+        result['attempt'] = task['retry_attempt']
+    if 'trace' in task:
+        result['trace'] = task['trace']
+    result.update(extra)
+    return result
 
 class AdvancedMultiGPUCaptionGenerator:
     def __init__(self, num_gpus=8, batch_size=8, model_name="HuggingFaceM4/idefics2-8b",
-                 max_retries=3, checkpoint_interval=1000):
+                 max_retries=3, checkpoint_interval=1000, max_new_tokens=64,
+                 max_image_size=1024, do_image_splitting=None, longest_edge=None,
+                 preprocess_profile_path=DEFAULT_PREPROCESS_PROFILE_PATH,
+                 device_type="cuda", cpu_threads_per_worker=None, quantize=None, placement=None,
+                 max_caption_words=DEFAULT_MAX_CAPTION_WORDS, draft_model_name=None, assist_baseline_images=2,
+                 retry_backoff=2.0, retry_resize_factor=0.75, template_ordered=False,
+                 template_output_dir=DEFAULT_TEMPLATE_OUTPUT_DIR, validate_images=False, validation_workers=None,
+                 negative_cache_path=DEFAULT_NEGATIVE_CACHE_PATH, telemetry_interval=10.0,
+                 telemetry_path=DEFAULT_TELEMETRY_PATH, max_memory_percent=DEFAULT_MAX_MEMORY_PERCENT,
+                 compile_mode=None, batch_buckets=DEFAULT_BATCH_BUCKETS, size_buckets=DEFAULT_SIZE_BUCKETS,
+                 trace_sample_rate=0.0, trace_path=DEFAULT_TRACE_PATH, image_source=DEFAULT_IMAGE_ROOT,
+                 elastic=False, control_file=DEFAULT_CONTROL_FILE, rescan_interval=DEFAULT_RESCAN_INTERVAL,
+                 prompts=None, embedding_dir=None, thread_budget=False, numa_aware=False,
+                 reserved_cores=DEFAULT_RESERVED_CORES, intra_op_threads=None,
+                 inter_op_threads=DEFAULT_INTER_OP_THREADS, compact_tasks=False):
         self.num_gpus = num_gpus
         self.batch_size = batch_size
         self.model_name = model_name
+        self.draft_model_name = draft_model_name  # 可选的小草稿模型，用于辅助（推测）解码
+        self.assist_baseline_images = assist_baseline_images
+        self.assistant = None  # 在工作进程中创建
+        self.compile_mode = compile_mode  # torch.compile 模式，None 表示 eager 执行
+        self.batch_buckets = batch_buckets
+        self.size_buckets = size_buckets
+        self.compiled = None  # 在工作进程中创建
         self.max_retries = max_retries
+        self.retry_backoff = retry_backoff  # 第 n 次重试延后 retry_backoff * 2^(n-1) 秒
+        self.retry_resize_factor = retry_resize_factor  # 每次重试把缩放上限再乘以该系数
         self.checkpoint_interval = checkpoint_interval
+        self.template_ordered = template_ordered  # 按模板调度，模板完成后立即写出汇总记录
+        self.template_output_dir = template_output_dir
+        self.validate_images = validate_images  # 派发前并行检查图片，坏图写入持久缓存
+        self.validation_workers = validation_workers
+        self.negative_cache_path = negative_cache_path
+        self.telemetry_interval = telemetry_interval  # 资源采样间隔（秒），None 表示不采样
+        self.telemetry_path = telemetry_path  # .jsonl 或 .csv
+        self.max_memory_percent = max_memory_percent  # 主机内存超过该比例时暂停派发
+        self.trace_sample_rate = trace_sample_rate  # 按该比例抽样任务记录逐跳时间线
+        self.trace_path = trace_path
+        self.images = open_image_source(image_source)  # 图片目录，或 tar / zip 分片的索引文件
+        self.max_new_tokens = max_new_tokens
+        self.max_caption_words = max_caption_words
+        # 多提示词模式：{键名: 提示词设置}，每张图片只编码一次，同一批次生成全部输出；None 表示只生成描述
+        self.prompts = prompts
+        self.embedding_dir = embedding_dir  # 同时导出池化后的视觉特征（float16 内存映射分片），None 表示不导出
+        self.max_image_size = max_image_size
+        # 视觉 token 预算：按模型的预处理配置设置切分和分辨率，None 表示沿用配置文件 / 内置值
+        self.do_image_splitting = do_image_splitting
+        self.longest_edge = longest_edge
+        self.preprocess_profile_path = preprocess_profile_path
+        self.device_type = device_type
+        self.quantize = quantize
+        self.cpu_threads_per_worker = cpu_threads_per_worker
+        self.elastic = elastic  # 运行中按控制文件 / 信号 / 新空闲的GPU增减工作进程
+        self.control_file = control_file
+        self.rescan_interval = rescan_interval
+        
+        # 放置表：工作进程 -> 设备，默认每张GPU一个副本；CPU后端每个进程绑定一组互不重叠的核心
+        # 弹性模式下启动时只使用当前空闲的GPU（最多 num_gpus 张）
+        if placement is None:
+            if device_type == "cpu":
+                placement = build_placement(["cpu"], num_gpus, cpu_threads_per_worker=cpu_threads_per_worker)
+            elif elastic:
+                devices = discover_devices(device_type)[:num_gpus]
+                if not devices:
+                    raise RuntimeError("没有发现空闲的GPU")
+                logger.info(f"发现空闲GPU: {devices}")
+                placement = build_placement(devices)
+            else:
+                placement = build_placement([f"cuda:{i}" for i in range(num_gpus)])
+        self.placement = placement
+        self.num_workers = len(placement)
+        
+        # 线程预算：每个工作进程绑定互不重叠的核心，并限制 intra-op / inter-op / tokenizers / 图片预处理线程数
+        self.thread_budget = thread_budget
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.reserved_cores = None
+        # 绑定主进程之前的全部可用核心，没有分到核心的工作进程和弹性扩容从中分配
+        self.all_cores = available_cores()
+        if thread_budget:
+            self.reserved_cores = plan_thread_budgets(placement, reserved_cores, numa_aware,
+                                                      intra_op_threads, inter_op_threads)
+            # 主进程及其之后启动的 Manager、采样线程、图片检查进程池都只使用保留核心
+            reserve_main_process(self.reserved_cores)
+        self.stage_timer = StageTimer()  # 每个进程各自累计
+        
+        # 紧凑任务表：任务表随生成器在工作进程启动时传递一次，批次只传 range / 序号
+        self.compact_tasks = compact_tasks
+        self.task_table = None
         
         # 共享状态
         self.manager = Manager()
         self.processed_count = self.manager.Value('i', 0)
         self.failed_count = self.manager.Value('i', 0)
-        self.gpu_stats = self.manager.dict()
-        
-        # 初始化GPU统计
-        for i in range(num_gpus):
-            self.gpu_stats[i] = {
-                'processed': 0,
-                'failed': 0,
-                'avg_time': 0.0,
-                'memory_usage': 0.0
-            }
+        self.worker_stats = self.manager.dict()
+        
+        # 初始化工作进程统计（按工作进程而不是设备统计）
+        for worker in self.placement:
+            self.init_worker_stats(worker)
+    
+    def init_worker_stats(self, worker):
+        self.worker_stats[worker['worker_id']] = {
+            'device': worker['device'],
+            'processed': 0,
+            'failed': 0,
+            'deferred': 0,
+            'avg_time': 0.0,
+            'busy_time': 0.0,
+            'generated_tokens': 0,
+            'vision_tokens': 0,
+            'prompt_outputs': 0,
+            'tokens_saved': 0,
+            'memory_usage': 0.0,
+            'memory_reserved': 0.0,
+            'pid': None
+        }
+    
+    def __getstate__(self):
+        """Manager 对象本身无法被 pickle，spawn 子进程时只传递共享代理"""
+        state = self.__dict__.copy()
+        state.pop('manager', None)
+        return state
+    
+    def load_model(self, device):
+        """加载模型和处理器到指定设备"""
+        torch, transformers = _import_heavy_modules()
+        
+        # CPU上半精度算子支持不完整，使用 float32
+        on_cpu = device == "cpu"
+        model = transformers.AutoModelForImageTextToText.from_pretrained(
+            self.model_name,
+            torch_dtype=torch.float32 if on_cpu else torch.float16,  # 使用半精度节省内存
+            device_map={"": device},
+            low_cpu_mem_usage=True,
+            use_cache=False  # 禁用缓存节省内存
+        )
+        
+        processor = transformers.AutoProcessor.from_pretrained(self.model_name)
+        # 整批生成需要左侧填充
+        processor.tokenizer.padding_side = "left"
+        apply_preprocess_profile(processor, self.preprocess_profile())
+        
+        # 设置模型为评估模式
+        model.eval()
+        
+        if on_cpu and self.quantize == "int8":
+            model = quantize_dynamic_int8(model)
+        return model, processor
     
     @contextmanager
-    def gpu_memory_monitor(self, gpu_id):
+    def gpu_memory_monitor(self, worker_id, device):
         """GPU内存监控上下文管理器"""
+        torch = lazy_import("torch")
+        gpu_index = device_index(device)
         try:
-            torch.cuda.set_device(gpu_id)
-            torch.cuda.empty_cache()
+            if gpu_index is not None:
+                torch.cuda.set_device(gpu_index)
+                torch.cuda.empty_cache()
             yield
         finally:
-            if torch.cuda.is_available():
-                memory_used = torch.cuda.memory_allocated(gpu_id) / 1024**3  # GB
-                self.gpu_stats[gpu_id]['memory_usage'] = memory_used
+            if gpu_index is not None and torch.cuda.is_available():
+                stats = dict(self.worker_stats[worker_id])
+                stats['memory_usage'] = torch.cuda.memory_allocated(gpu_index) / 1024**3  # GB
+                stats['memory_reserved'] = torch.cuda.memory_reserved(gpu_index) / 1024**3
+                self.worker_stats[worker_id] = stats
                 torch.cuda.empty_cache()
                 gc.collect()
     
-    def worker_process(self, gpu_id, task_queue, result_queue, progress_queue, stop_event):
+    def next_batch(self, task_queue, retry_queue):
+        """优先取主任务队列，主队列暂时为空时才处理重试队列（重试优先级更低）"""
+        try:
+            return task_queue.get_nowait()
+        except Empty:
+            if retry_queue is None:
+                return task_queue.get(timeout=5)
+        try:
+            return retry_queue.get_nowait()
+        except Empty:
+            return task_queue.get(timeout=1)
+    
+    def worker_process(self, worker_id, task_queue, result_queue, progress_queue, stop_event, retry_queue=None,
+                       drain_event=None):
         """增强的工作进程，包含错误恢复和性能监控"""
         
         def signal_handler(signum, frame):
-            logger.info(f"GPU {gpu_id} 收到停止信号")
+            logger.info(f"Worker {worker_id} 收到停止信号")
             stop_event.set()
         
         signal.signal(signal.SIGTERM, signal_handler)
@@ -78,62 +276,103 @@ class AdvancedMultiGPUCaptionGenerator:
         processor = None
         consecutive_failures = 0
         
+        worker = self.placement[worker_id]
+        device = worker['device']
+        
+        # 线程池大小在导入 torch / numpy 时确定，必须先设置
+        if worker.get('threads'):
+            # 没有分到专属核心时也要离开主进程的保留核心（子进程继承了主进程的亲和性）
+            cores = worker['cores'] or [core for core in self.all_cores if core not in (self.reserved_cores or [])]
+            apply_thread_budget(cores, worker['threads'])
+        
+        torch, transformers = _import_heavy_modules()
+        logger.info(f"Worker {worker_id} 依赖导入耗时: {format_import_times(get_import_times())}")
+        if worker.get('threads'):
+            set_torch_threads(worker['threads'])
+        
+        # 记录进程号，供主进程的资源采样读取 RSS
+        stats = dict(self.worker_stats[worker_id])
+        stats['pid'] = os.getpid()
+        self.worker_stats[worker_id] = stats
+        
         try:
-            # 设置CUDA设备
-            torch.cuda.set_device(gpu_id)
-            device = f"cuda:{gpu_id}"
+            if device == "cpu":
+                # CPU后端：绑定核心并让线程数与核心数一致（启用线程预算时已经设置）
+                if not worker.get('threads'):
+                    pin_to_cores(worker['cores'])
+                logger.info(f"Worker {worker_id} 绑定CPU核心 {worker['cores']}, 量化: {self.quantize or '无'}")
+            else:
+                # 设置CUDA设备，同一张卡上的多个副本按显存比例限制
+                torch.cuda.set_device(device_index(device))
+                if worker['memory_fraction'] is not None:
+                    torch.cuda.set_per_process_memory_fraction(worker['memory_fraction'], device_index(device))
             
-            logger.info(f"GPU {gpu_id} 开始加载模型...")
+            logger.info(f"Worker {worker_id} 在 {device} 上开始加载模型 (副本 {worker['replica']})...")
             
-            # 加载模型到指定GPU
-            model = AutoModelForImageTextToText.from_pretrained(
-                self.model_name,
-                torch_dtype=torch.float16,  # 使用半精度节省内存
-                device_map={"": device},
-                low_cpu_mem_usage=True,
-                use_cache=False  # 禁用缓存节省内存
-            )
+            # 加载模型到指定设备
+            model, processor = self.load_model(device)
             
-            processor = AutoProcessor.from_pretrained(self.model_name)
+            if self.draft_model_name:
+                self.assistant = AssistedDecoder(
+                    self.draft_model_name, model, processor, device, self.assist_baseline_images
+                )
+                logger.info(f"Worker {worker_id} 草稿模型 {self.draft_model_name} 加载完成，启用辅助解码")
             
-            # 设置模型为评估模式
-            model.eval()
+            logger.info(f"Worker {worker_id} 模型加载完成")
             
-            logger.info(f"GPU {gpu_id} 模型加载完成")
+            if self.compile_mode:
+                self.compile_worker_model(worker_id, model, processor, device)
             
-            while not stop_event.is_set():
+            # 排空时在批次之间退出：手上的批次处理完、结果放入结果队列后才停止取任务
+            while not stop_event.is_set() and not (drain_event is not None and drain_event.is_set()):
                 try:
                     # 从队列获取批次任务
-                    batch_tasks = task_queue.get(timeout=5)
+                    batch_tasks = self.next_batch(task_queue, retry_queue)
                     if batch_tasks is None:  # 结束信号
                         break
+                    if self.task_table is not None:
+                        batch_tasks = self.task_table.materialize(batch_tasks)
                     
+                    mark_all(batch_tasks, 'dequeued', 'retry_queue' if batch_tasks[0].get('retry_attempt') else 'task_queue')
                     start_time = time.time()
                     
-                    with self.gpu_memory_monitor(gpu_id):
+                    with self.gpu_memory_monitor(worker_id, device):
                         # 批量处理图片
                         batch_results = self.process_batch_advanced(
-                            batch_tasks, model, processor, device, gpu_id
+                            batch_tasks, model, processor, device, worker_id
                         )
                     
                     processing_time = time.time() - start_time
+                    mark_all(batch_results, 'processed', f"worker {worker_id} ({device})")
                     
                     # 更新统计信息
                     success_count = sum(1 for r in batch_results if r['success'])
-                    fail_count = len(batch_results) - success_count
+                    deferred_count = sum(1 for r in batch_results if r.get('retry'))
+                    fail_count = len(batch_results) - success_count - deferred_count
                     
-                    stats = dict(self.gpu_stats[gpu_id])
+                    stats = dict(self.worker_stats[worker_id])
                     stats['processed'] += success_count
                     stats['failed'] += fail_count
+                    stats['deferred'] += deferred_count
                     stats['avg_time'] = (stats['avg_time'] + processing_time) / 2
-                    self.gpu_stats[gpu_id] = stats
+                    stats['busy_time'] += processing_time
+                    stats['generated_tokens'] += sum(r.get('new_tokens', 0) for r in batch_results)
+                    stats['vision_tokens'] += sum(r.get('vision_tokens', 0) for r in batch_results)
+                    stats['prompt_outputs'] += sum(len(r.get('outputs', ())) for r in batch_results)
+                    stats['tokens_saved'] += sum(r.get('tokens_saved', 0) for r in batch_results)
+                    if self.assistant is not None:
+                        stats['assist'] = dict(self.assistant.stats)
+                    if self.compiled is not None:
+                        stats['compile'] = dict(self.compiled.stats)
+                    stats['stage_cpu'] = {name: dict(entry) for name, entry in self.stage_timer.stats.items()}
+                    self.worker_stats[worker_id] = stats
                     
                     # 将结果放入结果队列
                     for result in batch_results:
                         result_queue.put(result)
                     
-                    # 更新进度
-                    progress_queue.put(len(batch_tasks))
+                    # 更新进度（队列满时丢弃，不阻塞）
+                    put_progress(progress_queue, len(batch_tasks))
                     
                     # 重置连续失败计数
                     consecutive_failures = 0
@@ -142,10 +381,10 @@ class AdvancedMultiGPUCaptionGenerator:
                     continue
                 except Exception as e:
                     consecutive_failures += 1
-                    logger.error(f"GPU {gpu_id} 处理出错 (连续失败 {consecutive_failures}): {e}")
+                    logger.error(f"Worker {worker_id} 处理出错 (连续失败 {consecutive_failures}): {e}")
                     
                     if consecutive_failures >= 3:
-                        logger.warning(f"GPU {gpu_id} 连续失败过多，重启模型")
+                        logger.warning(f"Worker {worker_id} 连续失败过多，重启模型")
                         try:
                             del model, processor
                             torch.cuda.empty_cache()
@@ -153,27 +392,17 @@ class AdvancedMultiGPUCaptionGenerator:
                             time.sleep(2)
                             
                             # 重新加载模型
-                            model = AutoModelForImageTextToText.from_pretrained(
-                                self.model_name,
-                                torch_dtype=torch.float16,
-                                device_map={"": device},
-                                low_cpu_mem_usage=True,
-                                use_cache=False
-                            )
-                            processor = AutoProcessor.from_pretrained(self.model_name)
-                            model.eval()
+                            model, processor = self.load_model(device)
                             
                             consecutive_failures = 0
-                            logger.info(f"GPU {gpu_id} 模型重启完成")
+                            logger.info(f"Worker {worker_id} 模型重启完成")
                             
                         except Exception as restart_error:
-                            logger.error(f"GPU {gpu_id} 重启失败: {restart_error}")
+                            logger.error(f"Worker {worker_id} 重启失败: {restart_error}")
                             break
                     
-                    time.sleep(1)  # 短暂休息
-                    
         except Exception as e:
-            logger.error(f"GPU {gpu_id} 致命错误: {e}")
+            logger.error(f"Worker {worker_id} 致命错误: {e}")
         finally:
             if model is not None:
                 del model
@@ -181,10 +410,205 @@ class AdvancedMultiGPUCaptionGenerator:
                 del processor
             torch.cuda.empty_cache()
             gc.collect()
-            logger.info(f"GPU {gpu_id} 工作进程结束")
+            logger.info(f"Worker {worker_id} 工作进程结束")
+    
+    def compile_worker_model(self, worker_id, model, processor, device):
+        """编译模型并预热所有形状桶，分别记录编译耗时和稳态加速比"""
+        self.compiled = CompiledExecution(model, self.batch_buckets, self.size_buckets, self.compile_mode, device)
+        generate_fn = lambda images: self.generate_for_images(images, model, processor, device)
+        
+        self.compiled.stats['eager_seconds'] = self.compiled.measure(generate_fn, self.batch_size)
+        modules = self.compiled.compile()
+        logger.info(f"Worker {worker_id} 编译 {modules} (mode={self.compiled.mode})，开始预热...")
+        
+        compile_seconds = self.compiled.warmup(generate_fn, self.batch_size)
+        self.compiled.stats['compiled_seconds'] = self.compiled.measure(generate_fn, self.batch_size)
+        summary = summarize_compile_stats(self.compiled.stats)
+        logger.info(f"Worker {worker_id} 预热 {summary['warmup_shapes']} 种形状，编译耗时 {compile_seconds:.1f}s，"
+                    f"稳态加速比 {summary['steady_state_speedup']:.2f}x")
+        
+        stats = dict(self.worker_stats[worker_id])
+        stats['compile'] = dict(self.compiled.stats)
+        self.worker_stats[worker_id] = stats
+    
+    def preprocess_profile(self):
+        """当前模型的预处理配置（内置 < 配置文件 < 构造参数 / 调优结果）"""
+        return load_preprocess_profile(self.model_name, self.preprocess_profile_path, {
+            'do_image_splitting': self.do_image_splitting,
+            'longest_edge': self.longest_edge,
+        })
+    
+    def load_image(self, image_path, max_size=None):
+        """加载图片并按最长边上限缩放；重试任务会带更小的上限"""
+        with Image.open(self.images.open(image_path)) as img:
+            image = img.convert("RGB")
+        
+        # 可选：调整图片大小以节省内存
+        max_size = max_size or self.max_image_size
+        if max(image.size) > max_size:
+            ratio = max_size / max(image.size)
+            new_size = tuple(int(dim * ratio) for dim in image.size)
+            image = image.resize(new_size, Image.Resampling.LANCZOS)
+        return image
+    
+    def load_images(self, tasks):
+        with self.stage_timer.stage('load_image'):
+            return [self.load_image(task['image_path'], task.get('max_image_size')) for task in tasks]
+    
+    def generate_for_images(self, images, model, processor, device):
+        """对一组已加载的图片整批生成，返回 (描述列表, 每张新生成的 token 数, 每张的视觉 token 数, 每张的视觉特征)"""
+        torch = lazy_import("torch")
+        prompt = processor.apply_chat_template(CAPTION_MESSAGES, add_generation_prompt=True)
+        
+        with torch.no_grad():
+            with self.stage_timer.stage('preprocess'):
+                inputs = processor(text=[prompt] * len(images), images=[[image] for image in images],
+                                   padding=True, return_tensors="pt")
+                if self.compiled is not None:
+                    # 编译模式：像素补齐到预热过的分辨率桶，补齐区域由 pixel_attention_mask 屏蔽
+                    inputs = self.compiled.pad_inputs(inputs)
+                
+                # 将输入移动到GPU
+                inputs = {k: v.to(device) if isinstance(v, torch.Tensor) else v 
+                        for k, v in inputs.items()}
+            prompt_length = inputs['input_ids'].shape[1]
+            vision_tokens = count_vision_tokens(processor, inputs['input_ids'], self.preprocess_profile())
+            
+            # 生成描述：超过词数预算或写完一句即停止，已完成的行不再占用解码步
+            generate = model.generate if self.assistant is None else self.assistant.generate
+            # 导出特征时截获 generate 内部已经算出的视觉特征，不额外运行编码器
+            capture = VisionFeatureCapture(model) if self.embedding_dir else None
+            with capture or nullcontext(), self.stage_timer.stage('generate'):
+                generated_ids = generate(
+                    **inputs,
+                    max_new_tokens=self.max_new_tokens,
+                    do_sample=False,
+                    pad_token_id=processor.tokenizer.eos_token_id,
+                    num_beams=1,  # 使用贪婪搜索节省内存
+                    stopping_criteria=build_caption_stopping_criteria(
+                        processor.tokenizer, prompt_length, self.max_caption_words
+                    )
+                )
+        
+        with self.stage_timer.stage('decode'):
+            captions, token_counts = decode_new_tokens(processor.tokenizer, generated_ids, prompt_length,
+                                                       self.max_caption_words,
+                                                       pad_token_id=processor.tokenizer.eos_token_id)
+        embeddings = pool_features(capture.features if capture else None, len(images))
+        return captions, token_counts, vision_tokens, embeddings
+    
+    def generate_prompt_outputs(self, tasks, images, model, processor, device):
+        """多提示词：每张图片只经过一次视觉编码器，(图片, 提示词) 组合在同一批次中共享编码结果生成
+
+        每个任务生成 task['prompts']（默认全部提示词）中的输出，按键名放在结果的 outputs 中。
+        """
+        torch = lazy_import("torch")
+        rows = [(index, key) for index, task in enumerate(tasks) for key in task.get('prompts') or self.prompts]
+        settings = [self.prompts[key] for _, key in rows]
+        texts = [processor.apply_chat_template(build_prompt_messages(setting['instruction']), add_generation_prompt=True)
+                 for setting in settings]
+        budgets = [setting['max_new_tokens'] or self.max_new_tokens for setting in settings]
+        max_words = [setting['max_words'] for setting in settings]
+        
+        with torch.no_grad():
+            with self.stage_timer.stage('preprocess'):
+                image_inputs = processor.image_processor([[image] for image in images], return_tensors="pt")
+            with self.stage_timer.stage('generate'):
+                features = encode_images(model, image_inputs['pixel_values'].to(device),
+                                         image_inputs['pixel_attention_mask'].to(device))
+            with self.stage_timer.stage('preprocess'):
+                if features is None:
+                    # 模型不支持单独编码：每行各带一份图片，仍在同一批次中生成
+                    inputs = processor(text=texts, images=[[images[index]] for index, _ in rows],
+                                       padding=True, return_tensors="pt")
+                else:
+                    # 只对文本分词（图片占位符按预处理配置展开），视觉特征按行复用
+                    inputs = processor(text=texts, padding=True, return_tensors="pt")
+                inputs = {k: v.to(device) if isinstance(v, torch.Tensor) else v
+                          for k, v in inputs.items()}
+            if features is not None:
+                inputs['image_hidden_states'] = select_image_features(features, len(images),
+                                                                      [index for index, _ in rows])
+            prompt_length = inputs['input_ids'].shape[1]
+            vision_tokens = count_vision_tokens(processor, inputs['input_ids'], self.preprocess_profile())
+            
+            # 辅助解码的草稿模型无法复用视觉特征，多提示词模式下直接使用主模型
+            capture = VisionFeatureCapture(model) if self.embedding_dir and features is None else None
+            with capture or nullcontext(), self.stage_timer.stage('generate'):
+                generated_ids = model.generate(
+                    **inputs,
+                    max_new_tokens=max(budgets),
+                    do_sample=False,
+                    pad_token_id=processor.tokenizer.eos_token_id,
+                    num_beams=1,
+                    # 整批上限取最大预算，预算较小的行由停止条件按行结束
+                    stopping_criteria=build_caption_stopping_criteria(
+                        processor.tokenizer, prompt_length, max_words,
+                        [setting['stop_on_sentence_end'] for setting in settings], max_new_tokens=budgets
+                    )
+                )
+        
+        with self.stage_timer.stage('decode'):
+            captions, token_counts = decode_new_tokens(processor.tokenizer, generated_ids, prompt_length, max_words,
+                                                       pad_token_id=processor.tokenizer.eos_token_id,
+                                                       max_new_tokens=budgets)
+        embeddings = [None] * len(tasks)
+        if capture is not None:
+            # 退回逐行编码时按行池化，每张图片取它的第一行
+            for (index, _), embedding in reversed(list(zip(rows, pool_features(capture.features, len(rows))))):
+                embeddings[index] = embedding
+        elif self.embedding_dir:
+            embeddings = pool_features(features, len(images))
+        
+        outputs = [{} for _ in tasks]
+        new_tokens = [0] * len(tasks)
+        budget = [0] * len(tasks)
+        image_tokens = [0] * len(tasks)
+        for row, (index, key) in enumerate(rows):
+            outputs[index][key] = captions[row]
+            new_tokens[index] += token_counts[row]
+            budget[index] += budgets[row]
+            image_tokens[index] = vision_tokens[row]
+        
+        return [
+            make_result(task, outputs[index].get(PRIMARY_PROMPT, next(iter(outputs[index].values()))), True,
+                        outputs=outputs[index], new_tokens=new_tokens[index],
+                        tokens_saved=budget[index] - new_tokens[index], vision_tokens=image_tokens[index],
+                        **self.embedding_extra(embeddings[index]))
+            for index, task in enumerate(tasks)
+        ]
     
-    def process_batch_advanced(self, batch_tasks, model, processor, device, gpu_id):
+    def embedding_extra(self, embedding):
+        """导出特征时随结果带回主进程写入特征库"""
+        return {'embedding': embedding} if self.embedding_dir else {}
+    
+    def generate_captions(self, tasks, model, processor, device):
+        """对一组任务整批生成描述，只解码新生成的 token"""
+        if self.prompts:
+            images = self.load_images(tasks)
+            return self.generate_prompt_outputs(tasks, images, model, processor, device)
+        if self.assistant is not None and len(tasks) > 1:
+            # 辅助解码只支持批次大小为1，逐张生成
+            return [result for task in tasks for result in self.generate_captions([task], model, processor, device)]
+        
+        images = self.load_images(tasks)
+        if self.compiled is not None:
+            # 编译模式：批次补齐到预热过的批次桶，分辨率在预处理后补齐
+            images = self.compiled.pad_batch(images)
+        
+        captions, token_counts, vision_tokens, embeddings = self.generate_for_images(images, model, processor, device)
+        
+        results = []
+        for task, caption, new_tokens, image_tokens, embedding in zip(tasks, captions, token_counts, vision_tokens,
+                                                                      embeddings):
+            results.append(make_result(task, caption, True, new_tokens=new_tokens,
+                                       tokens_saved=self.max_new_tokens - new_tokens, vision_tokens=image_tokens,
+                                       **self.embedding_extra(embedding)))
+        return results
+    
+    def process_batch_advanced(self, batch_tasks, model, processor, device, worker_id):
         """高级批量处理，包含更多优化"""
+        torch = lazy_import("torch")
         results = []
         
         try:
@@ -192,144 +616,52 @@ class AdvancedMultiGPUCaptionGenerator:
             valid_tasks = []
             
             for task in batch_tasks:
+                # 派发前已经检查过的图片不再重复预检查
+                if task.get('validated'):
+                    valid_tasks.append(task)
+                    continue
+                
                 image_path = task['image_path']
-                full_path = f"/root/dataset/raw/{image_path}"
                 
                 # 预检查文件是否存在
-                if not os.path.exists(full_path):
-                    results.append({
-                        'image_path': image_path,
-                        'output_path': task['output_path'],
-                        'caption': "ERROR: 文件不存在",
-                        'success': False
-                    })
+                if not self.images.exists(image_path):
+                    results.append(make_result(task, "ERROR: 文件不存在", False))
                     continue
                 
                 try:
                     # 检查图片是否可以打开（快速检查）
-                    with Image.open(full_path) as img:
+                    with Image.open(self.images.open(image_path)) as img:
                         if img.mode not in ['RGB', 'RGBA', 'L']:
-                            results.append({
-                                'image_path': image_path,
-                                'output_path': task['output_path'],
-                                'caption': f"ERROR: 不支持的图片格式 {img.mode}",
-                                'success': False
-                            })
+                            results.append(make_result(task, f"ERROR: 不支持的图片格式 {img.mode}", False))
                             continue
                     
                     valid_tasks.append(task)
                     
                 except Exception as e:
-                    results.append({
-                        'image_path': image_path,
-                        'output_path': task['output_path'],
-                        'caption': f"ERROR: 图片格式错误 - {e}",
-                        'success': False
-                    })
+                    results.append(make_result(task, f"ERROR: 图片格式错误 - {e}", False))
             
             if not valid_tasks:
                 return results
             
-            # 准备消息模板
-            messages = [
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "image"},
-                        {"type": "text", "text": "describe the image briefly, within 30 words, output the description directly, do not start with 'the image is' or 'the photo is' or 'I can see' or anything that start with this image."},
-                    ],
-                }
-            ]
-            
-            # 逐个处理（避免内存溢出）
-            for task in valid_tasks:
-                retries = 0
-                success = False
-                
-                while retries < self.max_retries and not success:
-                    try:
-                        image_path = task['image_path']
-                        full_path = f"/root/dataset/raw/{image_path}"
-                        
-                        # 加载并预处理图片
-                        with Image.open(full_path) as img:
-                            image = img.convert("RGB")
-                            
-                            # 可选：调整图片大小以节省内存
-                            max_size = 1024
-                            if max(image.size) > max_size:
-                                ratio = max_size / max(image.size)
-                                new_size = tuple(int(dim * ratio) for dim in image.size)
-                                image = image.resize(new_size, Image.Resampling.LANCZOS)
-                        
-                        prompt = processor.apply_chat_template(messages, add_generation_prompt=True)
-                        
-                        # 处理输入
-                        with torch.no_grad():
-                            inputs = processor(text=prompt, images=[image], return_tensors="pt")
-                            
-                            # 将输入移动到GPU
-                            inputs = {k: v.to(device) if isinstance(v, torch.Tensor) else v 
-                                    for k, v in inputs.items()}
-                            
-                            # 生成描述
-                            generated_ids = model.generate(
-                                **inputs,
-                                max_new_tokens=100,  # 减少生成长度
-                                do_sample=False,
-                                pad_token_id=processor.tokenizer.eos_token_id,
-                                num_beams=1  # 使用贪婪搜索节省内存
-                            )
-                            
-                            generated_texts = processor.batch_decode(
-                                generated_ids, 
-                                skip_special_tokens=True
-                            )
-                        
-                        caption = generated_texts[0].strip()
-                        
-                        # 清理生成的文本
-                        if prompt in caption:
-                            caption = caption.replace(prompt, "").strip()
-                        
-                        results.append({
-                            'image_path': image_path,
-                            'output_path': task['output_path'],
-                            'caption': caption,
-                            'success': True
-                        })
-                        
-                        success = True
-                        
-                    except torch.cuda.OutOfMemoryError:
-                        torch.cuda.empty_cache()
-                        gc.collect()
-                        retries += 1
-                        logger.warning(f"GPU {gpu_id} 内存不足，重试 {retries}/{self.max_retries}")
-                        time.sleep(1)
-                        
-                    except Exception as e:
-                        retries += 1
-                        logger.warning(f"GPU {gpu_id} 处理 {image_path} 失败 (尝试 {retries}): {e}")
-                        time.sleep(0.5)
-                
-                if not success:
-                    results.append({
-                        'image_path': task['image_path'],
-                        'output_path': task['output_path'],
-                        'caption': f"ERROR: 处理失败，已重试 {self.max_retries} 次",
-                        'success': False
-                    })
+            # 整批生成（逐行提前停止）；失败时不在这里等待重试，
+            # 而是把任务交回主进程，延后以单张、更小尺寸的设置放入重试队列
+            try:
+                results.extend(self.generate_captions(valid_tasks, model, processor, device))
+            except torch.cuda.OutOfMemoryError:
+                torch.cuda.empty_cache()
+                gc.collect()
+                logger.warning(f"Worker {worker_id} 生成内存不足，{len(valid_tasks)} 张图片转入重试队列")
+                results.extend(make_result(task, "RETRY: 内存不足", False, retry=True, retry_task=task)
+                               for task in valid_tasks)
+            except Exception as e:
+                logger.warning(f"Worker {worker_id} 生成失败，{len(valid_tasks)} 张图片转入重试队列: {e}")
+                results.extend(make_result(task, f"RETRY: {e}", False, retry=True, retry_task=task)
+                               for task in valid_tasks)
             
         except Exception as e:
-            logger.error(f"GPU {gpu_id} 批量处理严重错误: {e}")
+            logger.error(f"Worker {worker_id} 批量处理严重错误: {e}")
             for task in batch_tasks:
-                results.append({
-                    'image_path': task['image_path'],
-                    'output_path': task['output_path'],
-                    'caption': f"ERROR: 批量处理失败 - {e}",
-                    'success': False
-                })
+                results.append(make_result(task, f"ERROR: 批量处理失败 - {e}", False))
         
         return results
     
@@ -338,7 +670,7 @@ class AdvancedMultiGPUCaptionGenerator:
         checkpoint_data = {
             'processed_files': list(processed_files),
             'timestamp': time.time(),
-            'stats': dict(self.gpu_stats)
+            'stats': dict(self.worker_stats)
         }
         
         with open('checkpoint.json', 'w', encoding='utf-8') as f:
@@ -358,37 +690,10 @@ class AdvancedMultiGPUCaptionGenerator:
                 logger.warning(f"加载检查点失败: {e}")
         return set()
     
-    def monitor_system_resources(self, stop_event):
-        """系统资源监控线程"""
-        while not stop_event.is_set():
-            try:
-                # CPU使用率
-                cpu_percent = psutil.cpu_percent(interval=1)
-                
-                # 内存使用率
-                memory = psutil.virtual_memory()
-                memory_percent = memory.percent
-                
-                # GPU内存使用情况
-                gpu_memory_info = []
-                for i in range(self.num_gpus):
-                    if torch.cuda.is_available():
-                        memory_used = torch.cuda.memory_allocated(i) / 1024**3
-                        memory_total = torch.cuda.get_device_properties(i).total_memory / 1024**3
-                        gpu_memory_info.append(f"GPU{i}: {memory_used:.1f}/{memory_total:.1f}GB")
-                
-                if cpu_percent > 90 or memory_percent > 90:
-                    logger.warning(f"系统资源紧张 - CPU: {cpu_percent}%, 内存: {memory_percent}%")
-                
-                time.sleep(30)  # 每30秒检查一次
-                
-            except Exception as e:
-                logger.error(f"资源监控错误: {e}")
-                time.sleep(60)
-    
     def run(self):
         """运行高级多GPU处理"""
         logger.info("开始高级多GPU图片描述生成...")
+        logger.info(f"图片输入: {self.images.describe()}")
         
         # 创建输出目录
         os.makedirs("./shape_descriptions", exist_ok=True)
@@ -396,49 +701,89 @@ class AdvancedMultiGPUCaptionGenerator:
         # 加载检查点
         processed_files = self.load_checkpoint()
         
-        # 准备任务
-        all_tasks = self.prepare_tasks(processed_files)
+        # 准备任务；多提示词模式按每个输出文件是否存在判断，检查点只记录了图片是否处理过
+        template_tracker = TemplateCompletionTracker(self.template_output_dir) if self.template_ordered else None
+        all_tasks = self.prepare_tasks(processed_files if not self.prompts else None, template_tracker)
+        if self.validate_images:
+            # 紧凑任务表在检查期间临时还原为字典，检查后只保留有效任务的紧凑形式
+            valid_tasks, bad_images = validate_tasks(
+                list(all_tasks.iter_tasks()) if self.compact_tasks else all_tasks, self.images,
+                num_workers=self.validation_workers, cache_path=self.negative_cache_path
+            )
+            all_tasks = all_tasks.subset(valid_tasks, TaskTable.VALIDATED) if self.compact_tasks else valid_tasks
+            if bad_images:
+                write_validation_report(bad_images)
+            if template_tracker is not None:
+                for bad in bad_images:
+                    template_tracker.record(make_result(bad['task'], f"ERROR: {bad['error']}", False))
+        if template_tracker is not None:
+            template_tracker.start()
         if not all_tasks:
             logger.info("没有需要处理的任务")
             return
         
         # 创建批次
         batches = self.create_batches(all_tasks)
+        trace_collector = TraceCollector()
+        embedding_store = EmbeddingStore(self.embedding_dir) if self.embedding_dir else None
+        if self.compact_tasks:
+            # 工作进程在启动时随生成器拿到任务表
+            self.task_table = all_tasks
+            logger.info(f"紧凑任务表: {len(all_tasks)} 条, {all_tasks.nbytes() / 1024**2:.1f}MB, "
+                        f"{len(all_tasks.templates)} 个模板, 内联 {len(all_tasks.inline)} 条; "
+                        f"批次 pickle 合计约 {batch_pickle_bytes(batches, sample=1000) / 1024**2:.2f}MB")
+        if self.trace_sample_rate:
+            traced = len(all_tasks.inline) if self.compact_tasks else sum(1 for task in all_tasks if 'trace' in task)
+            logger.info(f"追踪 {traced} 个任务 (采样率 {self.trace_sample_rate:.2%})")
         logger.info(f"分成 {len(batches)} 个批次，每个批次 {self.batch_size} 张图片")
         logger.info(f"总计需要处理 {len(all_tasks)} 张图片")
         
-        # 创建队列和事件
-        task_queue = Queue(maxsize=min(len(batches) + self.num_gpus, 1000))
-        result_queue = Queue()
-        progress_queue = Queue()
+        # 创建有界队列和事件：任务由派发线程按容量逐步放入，结果队列满时工作进程阻塞等待写出
+        task_capacity = self.num_workers * TASK_PREFETCH_PER_WORKER
+        result_capacity = self.num_workers * max(RESULT_QUEUE_PER_WORKER, self.batch_size)
+        task_queue = Queue(maxsize=task_capacity)
+        result_queue = Queue(maxsize=result_capacity)
+        progress_queue = Queue(maxsize=PROGRESS_QUEUE_SIZE)
+        retry_queue = Queue(maxsize=task_capacity)
         stop_event = mp.Event()
-        
-        # 启动资源监控线程
-        monitor_thread = threading.Thread(
-            target=self.monitor_system_resources,
-            args=(stop_event,)
+        feeder = TaskFeeder(task_queue, batches, max_memory_percent=self.max_memory_percent,
+                            on_feed=lambda batch: mark_all(batch, 'enqueued', 'main'))
+        occupancy = QueueOccupancy({
+            'task': (task_queue, task_capacity),
+            'retry': (retry_queue, task_capacity),
+            'result': (result_queue, result_capacity),
+        })
+        pool = ElasticWorkerPool(
+            self, (task_queue, result_queue, progress_queue, stop_event, retry_queue),
+            elastic=self.elastic, control_file=self.control_file, rescan_interval=self.rescan_interval
         )
-        monitor_thread.daemon = True
-        monitor_thread.start()
+        retry_scheduler = RetryScheduler(
+            retry_queue, self.max_retries, self.retry_backoff, self.retry_resize_factor, self.max_image_size
+        )
+        
+        # 启动资源采样线程
+        telemetry = None
+        if self.telemetry_interval:
+            telemetry = TelemetrySampler(
+                self.worker_stats, self.placement,
+                {'task': task_queue, 'retry': retry_queue, 'result': result_queue, 'progress': progress_queue},
+                interval=self.telemetry_interval, output_path=self.telemetry_path
+            )
+            telemetry.start()
+        
+        for line in format_placement(self.placement):
+            logger.info(line)
+        logger.info(f"预处理配置 ({self.model_name}): {describe_preprocess_profile(self.preprocess_profile())}")
+        if self.thread_budget:
+            for line in format_thread_layout(self.placement, self.reserved_cores):
+                logger.info(line)
         
         try:
-            # 将批次任务放入队列
-            for batch in batches:
-                task_queue.put(batch)
+            # 派发线程按队列容量放入批次，结束信号在所有任务（包括延后的重试）完成后才发送
+            feeder.start()
             
-            # 添加结束信号
-            for _ in range(self.num_gpus):
-                task_queue.put(None)
-            
-            # 启动工作进程
-            processes = []
-            for gpu_id in range(self.num_gpus):
-                p = Process(
-                    target=self.worker_process,
-                    args=(gpu_id, task_queue, result_queue, progress_queue, stop_event)
-                )
-                p.start()
-                processes.append(p)
+            # 启动工作进程；弹性模式下运行中可以扩容和排空
+            pool.start()
             
             # 监控进度和收集结果
             total_processed = 0
@@ -450,22 +795,48 @@ class AdvancedMultiGPUCaptionGenerator:
                 
                 while total_processed < total_images:
                     try:
-                        result = result_queue.get(timeout=2)
+                        # 把到期的重试任务放入重试队列，处理扩缩容请求
+                        retry_scheduler.pump()
+                        pool.poll(total_processed)
+                        if pool.alive_count() == 0:
+                            logger.error("所有工作进程都已退出，停止收集")
+                            break
+                        
+                        result = result_queue.get(timeout=0.5)
+                        mark(result, 'result_received', 'result_queue')
+                        
+                        # 需要重试的任务延后处理，超过重试次数的记为最终失败
+                        if result.get('retry'):
+                            result = retry_scheduler.schedule(result)
+                            if result is None:
+                                continue
+                        else:
+                            retry_scheduler.record(result)
                         
-                        # 保存结果
+                        # 保存结果；视觉特征写入特征库后不再随结果保留
+                        embedding = result.pop('embedding', None)
                         if result['success']:
-                            with open(result['output_path'], "w", encoding='utf-8') as file:
-                                file.write(result['caption'])
+                            write_outputs(result)
+                            if embedding_store is not None:
+                                embedding_store.add(result['image_path'], embedding)
                             processed_files.add(result['image_path'])
                         else:
                             logger.warning(f"处理失败: {result['image_path']} - {result['caption']}")
                         
+                        if template_tracker is not None:
+                            template_tracker.record(result)
+                        mark(result, 'written', 'main')
+                        trace_collector.add(result)
+                        
                         total_processed += 1
                         pbar.update(1)
+                        occupancy.sample()
                         
                         # 定期保存检查点
                         if total_processed - last_checkpoint >= self.checkpoint_interval:
                             self.save_checkpoint(processed_files)
+                            if embedding_store is not None:
+                                embedding_store.flush()
                             last_checkpoint = total_processed
                         
                         # 更新进度信息
@@ -473,15 +844,17 @@ class AdvancedMultiGPUCaptionGenerator:
                             elapsed = time.time() - start_time
                             speed = total_processed / elapsed
                             
-                            # 计算GPU统计信息
-                            gpu_info = []
-                            for i in range(self.num_gpus):
-                                stats = self.gpu_stats[i]
-                                gpu_info.append(f"GPU{i}:{stats['processed']}✓/{stats['failed']}✗")
+                            # 计算工作进程统计信息
+                            worker_info = []
+                            for worker in self.placement[:4]:  # 显示前4个工作进程的状态
+                                stats = self.worker_stats[worker['worker_id']]
+                                worker_info.append(f"W{worker['worker_id']}:{stats['processed']}✓/{stats['failed']}✗")
                             
                             pbar.set_postfix({
                                 'speed': f'{speed:.2f} img/s',
-                                'GPUs': ' '.join(gpu_info[:4])  # 显示前4个GPU的状态
+                                'pool': pool.active_count(),
+                                'workers': ' '.join(worker_info),
+                                'queues': occupancy.current()
                             })
                     
                     except Empty:
@@ -497,38 +870,108 @@ class AdvancedMultiGPUCaptionGenerator:
             # 保存最终检查点
             self.save_checkpoint(processed_files)
             
+            # 添加结束信号（排空中的进程会自行退出，不需要）
+            for _ in range(pool.active_count()):
+                try:
+                    task_queue.put(None, timeout=5)
+                except Full:
+                    break
+            
         except KeyboardInterrupt:
             logger.info("手动中断处理")
             stop_event.set()
         finally:
             # 等待所有进程结束
-            for p in processes:
-                p.join(timeout=10)
-                if p.is_alive():
-                    p.terminate()
-                    p.join()
+            pool.join()
             
             stop_event.set()
+            feeder.stop()
+            if telemetry is not None:
+                telemetry.stop()
+            if embedding_store is not None:
+                embedding_store.close()
             
             elapsed_time = time.time() - start_time
             logger.info(f"\n处理完成!")
             logger.info(f"总用时: {elapsed_time:.2f} 秒")
             logger.info(f"平均速度: {total_processed / elapsed_time:.2f} 图片/秒")
             logger.info(f"成功处理: {total_processed} 张图片")
+            logger.info(retry_scheduler.summary())
+            logger.info(feeder.summary())
+            logger.info(occupancy.summary())
+            logger.info(pool.summary(total_processed))
+            if template_tracker is not None:
+                logger.info(template_tracker.summary())
+            if telemetry is not None:
+                logger.info(telemetry.summary())
+            if trace_collector.traces:
+                trace_collector.export(self.trace_path)
+                logger.info(trace_collector.summary())
             
-            # 打印GPU统计信息
-            for i in range(self.num_gpus):
-                stats = self.gpu_stats[i]
-                logger.info(f"GPU {i}: 成功 {stats['processed']}, 失败 {stats['failed']}, "
-                          f"平均耗时 {stats['avg_time']:.2f}s")
+            self.report_worker_stats(total_processed, elapsed_time)
     
-    def prepare_tasks(self, skip_files=None):
-        """准备任务列表，跳过已处理的文件"""
+    def report_worker_stats(self, total_processed, elapsed_time):
+        """按副本和按设备打印吞吐统计"""
+        device_speed = {}
+        for worker in self.placement:
+            stats = self.worker_stats[worker['worker_id']]
+            speed = stats['processed'] / stats['busy_time'] if stats['busy_time'] > 0 else 0.0
+            device_speed[worker['device']] = device_speed.get(worker['device'], 0.0) + speed
+            logger.info(f"Worker {worker['worker_id']} ({worker['device']} 副本 {worker['replica']}): "
+                        f"成功 {stats['processed']}, 失败 {stats['failed']}, 转入重试 {stats['deferred']}, "
+                        f"平均耗时 {stats['avg_time']:.2f}s, {speed:.3f} 图片/秒")
+            if stats['processed'] > 0:
+                logger.info(f"  平均生成 {stats['generated_tokens'] / stats['processed']:.1f} token/图, "
+                            f"提前停止节省 {stats['tokens_saved'] / stats['processed']:.1f} token/图, "
+                            f"视觉输入 {stats['vision_tokens'] / stats['processed']:.1f} token/图")
+                if stats.get('stage_cpu'):
+                    logger.info(f"  CPU时间: {format_stage_cpu(stats['stage_cpu'], stats['processed'])}")
+                if stats['prompt_outputs']:
+                    logger.info(f"  多提示词: 每次图片编码生成 {stats['prompt_outputs'] / stats['processed']:.2f} 个输出")
+            
+            # CPU后端：报告每核心吞吐，便于决定长尾任务的分配
+            if worker['cores']:
+                logger.info(f"  {len(worker['cores'])} 核, {speed / len(worker['cores']):.4f} 图片/秒/核")
+        
+        for device, worker_ids in group_by_device(self.placement).items():
+            logger.info(f"{device}: {len(worker_ids)} 个副本, 合计 {device_speed[device]:.3f} 图片/秒")
+        
+        if self.draft_model_name:
+            assist_stats = merge_assist_stats(
+                self.worker_stats[w['worker_id']]['assist'] for w in self.placement
+                if 'assist' in self.worker_stats[w['worker_id']]
+            )
+            if assist_stats:
+                summary = summarize_assist_stats(assist_stats)
+                speedup = summary['measured_speedup']
+                logger.info(f"辅助解码 ({self.draft_model_name}): 接受率 {summary['acceptance_rate']:.1%}, "
+                            f"每次主模型前向 {summary['tokens_per_target_step']:.2f} token, "
+                            f"实测加速比 {f'{speedup:.2f}x' if speedup else '未测量'} "
+                            f"(基于 {assist_stats['baseline_images']} 张对照图片)")
+        
+        for worker in self.placement:
+            compile_stats = self.worker_stats[worker['worker_id']].get('compile')
+            if compile_stats:
+                summary = summarize_compile_stats(compile_stats)
+                speedup = summary['steady_state_speedup']
+                logger.info(f"Worker {worker['worker_id']} 编译模式 ({self.compile_mode}): "
+                            f"编译与预热 {summary['compile_seconds']:.1f}s ({summary['warmup_shapes']} 种形状), "
+                            f"稳态加速比 {f'{speedup:.2f}x' if speedup else '未测量'}")
+        
+        total_cores = sum(len(w['cores']) for w in self.placement if w['cores'])
+        if total_cores:
+            logger.info(f"CPU总吞吐: {total_processed / elapsed_time / total_cores:.4f} 图片/秒/核 "
+                        f"({total_cores} 核)")
+    
+    def prepare_tasks(self, skip_files=None, template_tracker=None):
+        """准备任务列表，跳过已处理的文件；传入 template_tracker 时同时登记每个模板的全部元素"""
         if skip_files is None:
             skip_files = set()
         
         total_jsons = os.listdir("./jsons")
-        all_tasks = []
+        all_tasks = TaskTable() if self.compact_tasks else []
+        # 抽样任务在扫描到时开始追踪，时间线的第一段包含检查、分批和派发前的等待
+        trace_sampler = TraceSampler(self.trace_sample_rate)
         
         logger.info("准备任务列表...")
         for _json in tqdm(total_jsons, desc="扫描JSON文件"):
@@ -547,22 +990,34 @@ class AdvancedMultiGPUCaptionGenerator:
                 
                 types = detail_json["types"]
                 _images = _data["images"]
+                shapes = []
+                pending_images = []
                 
                 for img_idx, img in enumerate(detail_json["images"]):
                     if types[img_idx] not in ["TextElement", "ImageElement"]:
                         image_file = _images[img_idx]["file"]
+                        shapes.append({'image_path': image_file, 'type': types[img_idx]})
                         
                         # 跳过已处理的文件
                         if image_file in skip_files:
                             continue
                         
                         output_path = f"./shape_descriptions/{image_file}.txt"
-                        if not os.path.exists(output_path):
-                            all_tasks.append({
-                                'image_path': image_file,
-                                'output_path': output_path,
-                                'json_name': name
-                            })
+                        extra = {}
+                        if self.prompts:
+                            # 多提示词：只生成还没有输出文件的键，全部缺失时使用默认（全部提示词）
+                            prompts = missing_prompts(output_path, self.prompts)
+                            if not prompts:
+                                continue
+                            if len(prompts) < len(self.prompts):
+                                extra['prompts'] = prompts
+                        elif os.path.exists(output_path):
+                            continue
+                        self.add_task(all_tasks, trace_sampler, image_file, output_path, name, **extra)
+                        pending_images.append(image_file)
+                
+                if template_tracker is not None:
+                    template_tracker.register(name, shapes, pending_images)
                         
             except Exception as e:
                 logger.error(f"处理JSON文件 {_json} 时出错: {e}")
@@ -571,8 +1026,36 @@ class AdvancedMultiGPUCaptionGenerator:
         logger.info(f"总共需要处理 {len(all_tasks)} 张图片")
         return all_tasks
     
+    def add_task(self, all_tasks, trace_sampler, image_path, output_path, json_name, **extra):
+        """追加一个任务；紧凑任务表中只有带额外状态的任务（抽样追踪、部分提示词）保留字典"""
+        if isinstance(all_tasks, TaskTable):
+            index = all_tasks.append(image_path, json_name)
+            task = dict(all_tasks.task(index), **extra)
+            trace_sampler.maybe_start(task)
+            if extra or 'trace' in task:
+                all_tasks.inline[index] = task
+            return
+        all_tasks.append({
+            'image_path': image_path,
+            'output_path': output_path,
+            'json_name': json_name,
+            **extra
+        })
+        trace_sampler.maybe_start(all_tasks[-1])
+    
     def create_batches(self, tasks):
         """将任务分成批次"""
+        if isinstance(tasks, TaskTable):
+            if self.template_ordered or isinstance(self.images, ArchiveSource):
+                # 需要按模板 / 分片重新排列时临时还原为字典，切好后只保留序号
+                return tasks.to_refs(self.create_batches(list(tasks.iter_tasks())))
+            return tasks.contiguous_batches(self.batch_size)
+        if self.template_ordered:
+            return create_template_batches(tasks, self.batch_size)
+        if isinstance(self.images, ArchiveSource):
+            # 归档输入：每个批次只读一个分片，分片内按偏移顺序读取
+            return create_shard_local_batches(tasks, self.batch_size, self.images)
+        
         batches = []
         for i in range(0, len(tasks), self.batch_size):
             batch = tasks[i:i + self.batch_size]
@@ -585,6 +1068,21 @@ def main():
     BATCH_SIZE = 8  # 每个GPU每次处理的图片数
     MAX_RETRIES = 3  # 最大重试次数
     CHECKPOINT_INTERVAL = 1000  # 检查点间隔
+    MAX_NEW_TOKENS = 64  # 最大生成长度（30词以内的描述通常不超过50个token）
+    MAX_IMAGE_SIZE = 1024  # 图片最长边上限
+    
+    # 如果存在自动调优结果，则覆盖上面的默认值
+    profile = load_profile()
+    config = apply_profile({
+        'num_gpus': NUM_GPUS,
+        'batch_size': BATCH_SIZE,
+        'max_new_tokens': MAX_NEW_TOKENS,
+        'max_image_size': MAX_IMAGE_SIZE,
+    }, profile)
+    NUM_GPUS = config['num_gpus']
+    BATCH_SIZE = config['batch_size']
+    if profile:
+        logger.info(f"已加载自动调优配置: {config}")
     
     logger.info(f"高级多GPU配置:")
     logger.info(f"- GPU数量: {NUM_GPUS}")
@@ -598,7 +1096,9 @@ def main():
         num_gpus=NUM_GPUS,
         batch_size=BATCH_SIZE,
         max_retries=MAX_RETRIES,
-        checkpoint_interval=CHECKPOINT_INTERVAL
+        checkpoint_interval=CHECKPOINT_INTERVAL,
+        max_new_tokens=config['max_new_tokens'],
+        max_image_size=config['max_image_size']
     )
     
     generator.run()
@@ -0,0 +1,121 @@
+import logging
+import time
+
+from lazy_imports import lazy_import
+
+logger = logging.getLogger(__name__)
+
+
+class AssistedDecoder:
+    """辅助（推测）解码：小的草稿模型先提出候选 token，主模型一次前向验证
+
+    通过前向钩子统计主模型和草稿模型的调用次数来估算接受率：
+    主模型每次前向产生 接受的草稿 token + 1 个自身 token，草稿模型每次前向提出 1 个候选 token。
+    """
+
+    def __init__(self, draft_model_name, target_model, processor, device, baseline_images=2,
+                 num_assistant_tokens=None):
+        transformers = lazy_import("transformers")
+
+        self.target_model = target_model
+        self.processor = processor
+        self.baseline_images = baseline_images
+        self.num_assistant_tokens = num_assistant_tokens
+
+        self.draft_model = transformers.AutoModelForImageTextToText.from_pretrained(
+            draft_model_name,
+            torch_dtype=target_model.dtype,
+            device_map={"": device},
+            low_cpu_mem_usage=True
+        )
+        self.draft_model.eval()
+
+        # 词表不同时需要走通用辅助解码（transformers>=4.46），传入两边的分词器
+        self.draft_tokenizer = None
+        draft_processor = transformers.AutoProcessor.from_pretrained(draft_model_name)
+        if draft_processor.tokenizer.get_vocab() != processor.tokenizer.get_vocab():
+            self.draft_tokenizer = draft_processor.tokenizer
+
+        self.calls = {'target': 0, 'draft': 0}
+        self.target_model.register_forward_pre_hook(self.counting_hook('target'))
+        self.draft_model.register_forward_pre_hook(self.counting_hook('draft'))
+
+        self.stats = {
+            'images': 0,
+            'new_tokens': 0,
+            'target_calls': 0,
+            'draft_calls': 0,
+            'baseline_images': 0,
+            'baseline_seconds': 0.0,
+            'assisted_seconds': 0.0,
+        }
+
+    def counting_hook(self, name):
+        def hook(module, args):
+            self.calls[name] += 1
+        return hook
+
+    def generate_kwargs(self):
+        kwargs = {'assistant_model': self.draft_model, 'use_cache': True}
+        if self.draft_tokenizer is not None:
+            kwargs['tokenizer'] = self.processor.tokenizer
+            kwargs['assistant_tokenizer'] = self.draft_tokenizer
+        if self.num_assistant_tokens is not None:
+            kwargs['num_assistant_tokens'] = self.num_assistant_tokens
+        return kwargs
+
+    def generate(self, **generate_kwargs):
+        """对单张图片做辅助解码，参数与 model.generate 相同（辅助解码只支持批次大小为1）"""
+        prompt_length = generate_kwargs['input_ids'].shape[1]
+
+        # 前几张图片同时跑一次普通解码，测量实际加速比
+        measure_baseline = self.stats['baseline_images'] < self.baseline_images
+        if measure_baseline:
+            start = time.perf_counter()
+            self.target_model.generate(use_cache=True, **generate_kwargs)
+            self.stats['baseline_seconds'] += time.perf_counter() - start
+            reset_stopping_criteria(generate_kwargs.get('stopping_criteria'))
+
+        calls_before = dict(self.calls)
+        start = time.perf_counter()
+        generated_ids = self.target_model.generate(**self.generate_kwargs(), **generate_kwargs)
+        elapsed = time.perf_counter() - start
+
+        self.stats['images'] += 1
+        self.stats['new_tokens'] += generated_ids.shape[1] - prompt_length
+        self.stats['target_calls'] += self.calls['target'] - calls_before['target']
+        self.stats['draft_calls'] += self.calls['draft'] - calls_before['draft']
+        if measure_baseline:
+            self.stats['baseline_images'] += 1
+            self.stats['assisted_seconds'] += elapsed
+
+        return generated_ids
+
+
+def reset_stopping_criteria(stopping_criteria):
+    """有状态的停止条件在复用于下一次 generate 前需要重置"""
+    for criteria in stopping_criteria or []:
+        if hasattr(criteria, 'reset'):
+            criteria.reset()
+
+
+def summarize_assist_stats(stats):
+    """由累计统计计算接受率和加速比"""
+    accepted = stats['new_tokens'] - stats['target_calls']
+    acceptance_rate = accepted / stats['draft_calls'] if stats['draft_calls'] > 0 else 0.0
+    tokens_per_target_step = stats['new_tokens'] / stats['target_calls'] if stats['target_calls'] > 0 else 0.0
+    speedup = stats['baseline_seconds'] / stats['assisted_seconds'] if stats['assisted_seconds'] > 0 else None
+    return {
+        'acceptance_rate': acceptance_rate,
+        'tokens_per_target_step': tokens_per_target_step,
+        'measured_speedup': speedup,
+    }
+
+
+def merge_assist_stats(stats_list):
+    """合并多个工作进程的辅助解码统计"""
+    merged = {}
+    for stats in stats_list:
+        for key, value in stats.items():
+            merged[key] = merged.get(key, 0) + value
+    return merged
@@ -0,0 +1,216 @@
+import itertools
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+from lazy_imports import lazy_import
+from preprocessing_profile import apply_preprocess_profile
+from task_manifest import scan_manifest
+
+logger = logging.getLogger(__name__)
+
+# 自动调优结果文件，生成脚本启动时自动读取
+DEFAULT_PROFILE_PATH = "caption_profile.json"
+# 三个生成脚本默认使用的模型；调优结果只对测出它的模型有效
+DEFAULT_MODEL_NAME = "HuggingFaceM4/idefics2-8b"
+
+# 可以由调优结果覆盖的配置项
+TUNABLE_KEYS = ["num_gpus", "batch_size", "max_new_tokens", "max_image_size", "do_image_splitting", "longest_edge"]
+
+# 默认搜索空间
+DEFAULT_SEARCH_SPACE = {
+    "batch_size": [4, 8, 16],
+    "max_new_tokens": [60, 100],
+    "max_image_size": [768, 1024],
+    "do_image_splitting": [False],
+    "longest_edge": [980],
+}
+
+
+def load_profile(path=DEFAULT_PROFILE_PATH):
+    """读取调优结果，文件不存在或损坏时返回空字典"""
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        logger.warning(f"读取调优配置 {path} 失败: {e}")
+        return {}
+
+
+def save_profile(profile, path=DEFAULT_PROFILE_PATH):
+    """保存调优结果"""
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(profile, f, ensure_ascii=False, indent=2)
+    logger.info(f"调优配置已保存到 {path}")
+
+
+def profile_matches(profile, model_name=DEFAULT_MODEL_NAME):
+    """调优结果是否针对当前模型；不匹配时记录警告"""
+    profile_model = profile.get("model_name")
+    if profile and profile_model and profile_model != model_name:
+        logger.warning(f"调优配置针对的模型是 {profile_model}，当前模型为 {model_name}，忽略该配置")
+        return False
+    return True
+
+
+def apply_profile(config, profile, model_name=DEFAULT_MODEL_NAME):
+    """用调优结果覆盖配置中的可调参数，返回新的配置字典；模型不匹配时原样返回"""
+    config = dict(config)
+    if not profile_matches(profile, model_name):
+        return config
+    for key in TUNABLE_KEYS:
+        if key in config and profile.get("config", {}).get(key) is not None:
+            config[key] = profile["config"][key]
+    return config
+
+
+def build_search_space(search_space=None):
+    """把搜索空间展开为配置列表"""
+    search_space = search_space or DEFAULT_SEARCH_SPACE
+    keys = list(search_space)
+    return [dict(zip(keys, values)) for values in itertools.product(*(search_space[k] for k in keys))]
+
+
+def sample_pending_tasks(sample_size, seed=0, skip_files=None):
+    """从真实待处理任务中随机抽取校准样本"""
+    pending = scan_manifest(skip_files=skip_files)['pending_tasks']
+    random.Random(seed).shuffle(pending)
+    return pending[:sample_size]
+
+
+class RssPeakSampler:
+    """后台线程按固定间隔采样本进程 RSS，记录一段时间内的峰值
+
+    ru_maxrss 是整个进程生命周期的峰值、无法重置，后面的配置会继承前面配置的峰值，
+    因此 CPU 上每组配置单独采样。
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        psutil = lazy_import("psutil")
+        process = psutil.Process()
+        self.peak = process.memory_info().rss
+
+        def loop():
+            while not self.stop_event.wait(self.interval):
+                self.peak = max(self.peak, process.memory_info().rss)
+
+        self.thread = threading.Thread(target=loop, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop_event.set()
+        self.thread.join()
+        return False
+
+
+class ThroughputAutotuner:
+    def __init__(self, generator, sample_tasks, device="cuda:0", warmup_batches=1):
+        self.generator = generator
+        self.sample_tasks = sample_tasks
+        self.device = device
+        self.warmup_batches = warmup_batches
+        self.model = None
+        self.processor = None
+        self.rss_sampler = None
+
+    def peak_memory_gb(self):
+        """返回本轮校准的峰值内存：GPU 上为显存峰值，CPU 上为本轮采样到的进程常驻内存峰值"""
+        torch = lazy_import("torch")
+        if self.device.startswith("cuda"):
+            return torch.cuda.max_memory_allocated(self.device) / 1024**3
+        return self.rss_sampler.peak / 1024**3
+
+    def measure(self, config):
+        """用一组配置跑一次短校准，返回吞吐和峰值内存"""
+        torch = lazy_import("torch")
+        generator = self.generator
+        for key, value in config.items():
+            setattr(generator, key, value)
+
+        # 切分和分辨率写在处理器上，每组配置重新设置
+        apply_preprocess_profile(self.processor, generator.preprocess_profile())
+
+        batches = generator.create_batches(self.sample_tasks)
+        warmup, timed = batches[:self.warmup_batches], batches[self.warmup_batches:]
+        if not timed:
+            warmup, timed = [], batches
+
+        for batch in warmup:
+            generator.process_batch_advanced(batch, self.model, self.processor, self.device, 0)
+
+        if self.device.startswith("cuda"):
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+        images = 0
+        failed = 0
+        start = time.perf_counter()
+        with RssPeakSampler() as self.rss_sampler:
+            for batch in timed:
+                results = generator.process_batch_advanced(batch, self.model, self.processor, self.device, 0)
+                images += len(results)
+                failed += sum(1 for r in results if not r['success'])
+        if self.device.startswith("cuda"):
+            torch.cuda.synchronize(self.device)
+        elapsed = time.perf_counter() - start
+
+        return {
+            "config": dict(config),
+            "images": images,
+            "failed": failed,
+            "seconds": elapsed,
+            "images_per_sec": images / elapsed if elapsed > 0 else 0.0,
+            "peak_memory_gb": self.peak_memory_gb(),
+        }
+
+    def run(self, configs, max_memory_gb=None):
+        """依次测量所有配置，返回 (全部结果, 最优结果)"""
+        self.model, self.processor = self.generator.load_model(self.device)
+
+        results = []
+        for index, config in enumerate(configs):
+            logger.info(f"校准 {index + 1}/{len(configs)}: {config}")
+            try:
+                result = self.measure(config)
+            except Exception as e:
+                logger.warning(f"配置 {config} 校准失败: {e}")
+                lazy_import("torch").cuda.empty_cache()
+                continue
+
+            logger.info(f"  {result['images_per_sec']:.2f} 图片/秒, 峰值内存 {result['peak_memory_gb']:.2f}GB, "
+                        f"失败 {result['failed']}")
+            results.append(result)
+
+        candidates = [r for r in results if r['failed'] == 0]
+        if max_memory_gb is not None:
+            candidates = [r for r in candidates if r['peak_memory_gb'] <= max_memory_gb]
+
+        best = max(candidates, key=lambda r: r['images_per_sec']) if candidates else None
+        return results, best
+
+
+def build_profile(best, results, num_gpus, model_name, device):
+    """把最优结果整理成调优配置文件内容"""
+    config = dict(best["config"])
+    config["num_gpus"] = num_gpus
+    return {
+        "model_name": model_name,
+        "device": device,
+        "created_at": time.time(),
+        "config": config,
+        "images_per_sec_per_gpu": best["images_per_sec"],
+        "peak_memory_gb": best["peak_memory_gb"],
+        "sweep": results,
+    }
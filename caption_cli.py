@@ -0,0 +1,608 @@
+import time
+
+_CLI_START = time.perf_counter()
+
+import argparse
+import json
+import os
+import sys
+
+from autotune import DEFAULT_PROFILE_PATH, DEFAULT_SEARCH_SPACE, load_profile, apply_profile, profile_matches
+from caption_service import DEFAULT_MAX_INCOMING
+from embedding_store import DEFAULT_EMBEDDING_DIR
+from flow_control import DEFAULT_MAX_MEMORY_PERCENT
+from image_sources import DEFAULT_IMAGE_ROOT, DEFAULT_SHARD_SIZE_MB
+from lazy_imports import HEAVY_MODULES, lazy_import, measure_cold_import
+from multi_prompt import PROMPT_PRESETS, load_prompts
+from preprocessing_profile import DEFAULT_PREPROCESS_PROFILE_PATH, estimate_vision_tokens, load_preprocess_profile
+from task_manifest import DEFAULT_JSONS_DIR, DEFAULT_DETAIL_DIR, DEFAULT_OUTPUT_DIR, scan_manifest
+from telemetry import DEFAULT_TELEMETRY_PATH
+from thread_budget import DEFAULT_INTER_OP_THREADS, DEFAULT_RESERVED_CORES
+from template_watcher import DEFAULT_LATENCY_LOG_PATH, DEFAULT_POLL_INTERVAL, DEFAULT_WATCH_REPORT_INTERVAL
+from template_tracker import DEFAULT_TEMPLATE_OUTPUT_DIR
+
+# 启动本命令行工具本身所需的导入耗时（不含 torch / transformers）
+CLI_IMPORT_SECONDS = time.perf_counter() - _CLI_START
+
+# 三个生成脚本对应的模块与类
+GENERATORS = {
+    'basic': ('multi_gpu_caption', 'MultiGPUCaptionGenerator'),
+    'improved': ('improved_multi_gpu_caption', 'ImprovedMultiGPUCaptionGenerator'),
+    'advanced': ('advanced_multi_gpu_caption', 'AdvancedMultiGPUCaptionGenerator'),
+}
+
+def load_checkpoint_files(checkpoint_path):
+    """读取高级版本的检查点，返回已处理文件集合"""
+    if not os.path.exists(checkpoint_path):
+        return set()
+    try:
+        with open(checkpoint_path, 'r', encoding='utf-8') as f:
+            return set(json.load(f)['processed_files'])
+    except Exception as e:
+        print(f"读取检查点失败: {e}")
+        return set()
+
+
+def parse_int_list(value):
+    """解析逗号分隔的整数列表，例如 4,8,16"""
+    return [int(item) for item in value.split(",") if item.strip()]
+
+
+def format_duration(seconds):
+    """把秒数格式化为 时:分:秒"""
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def command_plan(args):
+    """扫描任务清单并报告待处理数量、重复项、视觉 token 估算和预计耗时（不导入 torch）"""
+    skip_files = set()
+    if args.variant == 'advanced':
+        skip_files = load_checkpoint_files(args.checkpoint)
+
+    scan_start = time.perf_counter()
+    summary = scan_manifest(args.jsons_dir, args.detail_dir, args.output_dir, skip_files)
+    scan_seconds = time.perf_counter() - scan_start
+
+    pending = len(summary['pending_tasks'])
+    duplicates = summary['duplicates']
+    duplicate_extra = sum(count - 1 for count in duplicates.values())
+    unique_pending = pending - duplicate_extra
+    # 未指定时按模型的预处理配置（切分 / 分辨率）估算每张图片的视觉 token
+    tokens_per_image = args.tokens_per_image
+    if tokens_per_image is None:
+        tokens_per_image = estimate_vision_tokens(load_preprocess_profile(args.model_name, args.preprocess_profile))
+    vision_tokens = unique_pending * tokens_per_image
+    # 未指定吞吐时优先使用自动调优测得的结果
+    img_per_sec_per_gpu = args.img_per_sec_per_gpu
+    if img_per_sec_per_gpu is None:
+        profile = load_profile(args.profile)
+        img_per_sec_per_gpu = (profile.get('images_per_sec_per_gpu', 1.0) if profile_matches(profile, args.model_name)
+                               else 1.0)
+    throughput = img_per_sec_per_gpu * args.num_gpus
+    projected_seconds = unique_pending / throughput if throughput > 0 else 0.0
+
+    report = {
+        'variant': args.variant,
+        'templates': summary['templates'],
+        'mismatched_templates': len(summary['mismatched_templates']),
+        'broken_templates': len(summary['broken_templates']),
+        'shape_elements': summary['shape_elements'],
+        'already_done': summary['already_done'],
+        'checkpoint_skipped': summary['checkpoint_skipped'],
+        'pending': pending,
+        'duplicate_images': len(duplicates),
+        'duplicate_extra_tasks': duplicate_extra,
+        'unique_pending': unique_pending,
+        'tokens_per_image': tokens_per_image,
+        'estimated_vision_tokens': vision_tokens,
+        'throughput_img_per_sec': throughput,
+        'projected_seconds': projected_seconds,
+        'scan_seconds': scan_seconds,
+        'cli_import_seconds': CLI_IMPORT_SECONDS,
+        'torch_imported': 'torch' in sys.modules,
+    }
+
+    if args.measure_imports:
+        report['cold_import_seconds'] = {name: measure_cold_import(name) for name in HEAVY_MODULES}
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+
+    print(f"任务规划 ({args.variant}):")
+    print(f"- 模板数量: {report['templates']} (数量不匹配 {report['mismatched_templates']}, "
+          f"读取失败 {report['broken_templates']})")
+    print(f"- 形状元素: {report['shape_elements']}")
+    print(f"- 已完成: {report['already_done']}, 检查点跳过: {report['checkpoint_skipped']}")
+    print(f"- 待处理: {pending} (重复图片 {len(duplicates)} 张, 多余任务 {duplicate_extra} 个, "
+          f"去重后 {unique_pending})")
+    print(f"- 预计视觉 token: {vision_tokens:,} ({tokens_per_image}/图)")
+    print(f"- 预计耗时: {format_duration(projected_seconds)} "
+          f"(按 {throughput:.2f} 图片/秒, {args.num_gpus} 个GPU)")
+    print(f"- 扫描耗时: {scan_seconds:.2f}s, 命令行导入耗时: {CLI_IMPORT_SECONDS:.3f}s, "
+          f"已导入torch: {report['torch_imported']}")
+
+    for path, count in list(duplicates.items())[:args.show_duplicates]:
+        print(f"  重复: {path} x{count}")
+
+    if args.measure_imports:
+        print("- 重量级依赖冷启动导入耗时:")
+        for name, seconds in report['cold_import_seconds'].items():
+            shown = f"{seconds:.2f}s" if seconds is not None else "导入失败"
+            print(f"  {name}: {shown}")
+
+
+def build_run_placement(args, num_gpus):
+    """根据命令行参数生成放置表，未指定时返回 None 使用默认的一卡一副本
+
+    num_gpus 为已经合并了调优配置和 --num-gpus 的GPU数量。
+    """
+    from placement import build_placement, load_placement_file, parse_device_list
+
+    if args.placement_file:
+        return load_placement_file(args.placement_file, args.cpu_threads)
+    if args.devices is None and args.replicas_per_device == 1 and args.memory_fraction is None:
+        return None
+
+    if args.devices is not None:
+        devices = parse_device_list(args.devices, args.device_type)
+    elif args.device_type == "cpu":
+        devices = ["cpu"]
+    else:
+        devices = [f"cuda:{i}" for i in range(num_gpus)]
+    return build_placement(devices, args.replicas_per_device, args.memory_fraction, args.cpu_threads)
+
+
+def build_generator(args, variant):
+    """根据命令行参数创建生成器实例"""
+    import importlib
+
+    module_name, class_name = GENERATORS[variant]
+    generator_class = getattr(importlib.import_module(module_name), class_name)
+
+    kwargs = {'num_gpus': 8, 'model_name': args.model_name, 'max_new_tokens': 64}
+    if variant == 'improved':
+        kwargs['group_size'] = args.group_size
+        kwargs['canvas_context'] = args.canvas_context
+    else:
+        kwargs['batch_size'] = 8
+        kwargs['max_memory_percent'] = args.max_memory_percent
+    if variant == 'advanced':
+        kwargs['max_retries'] = args.max_retries
+        kwargs['checkpoint_interval'] = args.checkpoint_interval
+        kwargs['max_image_size'] = 1024
+        kwargs['device_type'] = args.device_type
+        kwargs['cpu_threads_per_worker'] = args.cpu_threads
+        kwargs['quantize'] = args.quantize
+        kwargs['draft_model_name'] = args.draft_model_name
+        kwargs['retry_backoff'] = args.retry_backoff
+        kwargs['retry_resize_factor'] = args.retry_resize_factor
+        kwargs['template_ordered'] = args.template_ordered
+        kwargs['template_output_dir'] = args.template_output_dir
+        kwargs['validate_images'] = args.validate_images
+        kwargs['validation_workers'] = args.validation_workers
+        kwargs['telemetry_interval'] = args.telemetry_interval
+        kwargs['telemetry_path'] = args.telemetry_path
+        kwargs['compile_mode'] = args.compile
+        kwargs['batch_buckets'] = parse_int_list(args.batch_buckets)
+        kwargs['size_buckets'] = parse_int_list(args.size_buckets)
+        kwargs['trace_sample_rate'] = args.trace_sample_rate
+        kwargs['trace_path'] = args.trace_path
+        kwargs['image_source'] = args.image_source
+        kwargs['elastic'] = args.elastic
+        kwargs['control_file'] = args.control_file
+        kwargs['rescan_interval'] = args.rescan_interval
+        kwargs['do_image_splitting'] = None
+        kwargs['longest_edge'] = None
+        kwargs['preprocess_profile_path'] = args.preprocess_profile
+        kwargs['prompts'] = load_prompts(args.prompts)
+        kwargs['embedding_dir'] = args.embedding_dir
+        kwargs['thread_budget'] = args.thread_budget
+        kwargs['numa_aware'] = args.numa_aware
+        kwargs['reserved_cores'] = args.reserved_cores
+        kwargs['intra_op_threads'] = args.intra_op_threads
+        kwargs['inter_op_threads'] = args.inter_op_threads
+        kwargs['compact_tasks'] = args.compact_tasks
+
+    # 优先级：命令行参数 > 自动调优配置 > 脚本默认值
+    if not args.no_profile:
+        kwargs = apply_profile(kwargs, load_profile(args.profile), args.model_name)
+    for key in ('num_gpus', 'batch_size', 'max_new_tokens', 'max_image_size', 'do_image_splitting', 'longest_edge'):
+        value = getattr(args, key)
+        if value is not None and key in kwargs:
+            kwargs[key] = value
+    if variant == 'advanced':
+        # 放置表在合并调优配置和命令行参数之后生成，GPU数量与最终配置一致
+        kwargs['placement'] = build_run_placement(args, kwargs['num_gpus'])
+
+    print(f"配置: {variant}, {kwargs}")
+    return generator_class(**kwargs)
+
+
+def command_run(args):
+    """运行指定的生成脚本"""
+    import multiprocessing as mp
+
+    mp.set_start_method('spawn', force=True)
+    generator = build_generator(args, args.variant)
+    generator.run()
+
+
+def command_serve(args):
+    """启动常驻描述服务，模型保持加载状态，请求动态合并成批次"""
+    import multiprocessing as mp
+    from caption_service import CaptionService, serve
+
+    mp.set_start_method('spawn', force=True)
+
+    generator = build_generator(args, 'advanced')
+    service = CaptionService(generator, max_batch_size=generator.batch_size, max_wait_ms=args.max_wait_ms,
+                             jobs_dir=args.jobs_dir, max_incoming=args.max_incoming)
+    serve(service, args.host, args.port, args.unix_socket)
+
+
+def command_watch(args):
+    """守护模式：工作进程常驻，轮询模板目录，新到达模板的形状元素立即生成描述"""
+    import multiprocessing as mp
+    from caption_service import CaptionService
+    from template_watcher import CaptionWatchDaemon, TemplateWatcher
+
+    mp.set_start_method('spawn', force=True)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    generator = build_generator(args, 'advanced')
+    service = CaptionService(generator, max_batch_size=generator.batch_size, max_wait_ms=args.max_wait_ms,
+                             max_incoming=args.max_incoming)
+    daemon = CaptionWatchDaemon(service, TemplateWatcher(args.jsons_dir, args.detail_dir), args.output_dir,
+                                args.poll_interval, args.report_interval, args.latency_log)
+    daemon.run(from_now=args.from_now)
+
+
+def command_autotune(args):
+    """在真实待处理任务的样本上做短校准，保存最优配置"""
+    from autotune import ThroughputAutotuner, build_profile, build_search_space, sample_pending_tasks, save_profile
+    from advanced_multi_gpu_caption import AdvancedMultiGPUCaptionGenerator
+
+    sample_tasks = sample_pending_tasks(args.sample_size, args.seed, load_checkpoint_files(args.checkpoint))
+    if not sample_tasks:
+        print("没有待处理任务可用于校准")
+        return
+
+    search_space = dict(DEFAULT_SEARCH_SPACE)
+    search_space['batch_size'] = parse_int_list(args.batch_sizes)
+    search_space['max_new_tokens'] = parse_int_list(args.max_new_tokens)
+    search_space['max_image_size'] = parse_int_list(args.max_image_sizes)
+    search_space['longest_edge'] = parse_int_list(args.longest_edges)
+    if args.try_image_splitting:
+        search_space['do_image_splitting'] = [False, True]
+    configs = build_search_space(search_space)
+    print(f"校准样本 {len(sample_tasks)} 张图片, 共 {len(configs)} 组配置")
+
+    generator = AdvancedMultiGPUCaptionGenerator(num_gpus=1, model_name=args.model_name,
+                                                 preprocess_profile_path=args.preprocess_profile)
+    tuner = ThroughputAutotuner(generator, sample_tasks, device=args.device)
+    results, best = tuner.run(configs, max_memory_gb=args.max_memory_gb)
+    if best is None:
+        print("没有配置通过校准，未保存调优结果")
+        return
+
+    num_gpus = args.num_gpus
+    if num_gpus is None:
+        torch = lazy_import("torch")
+        num_gpus = torch.cuda.device_count() if args.device.startswith("cuda") else 1
+
+    profile = build_profile(best, results, num_gpus, args.model_name, args.device)
+    save_profile(profile, args.profile)
+    print(f"最优配置: {profile['config']}")
+    print(f"单卡吞吐: {best['images_per_sec']:.2f} 图片/秒, 峰值内存 {best['peak_memory_gb']:.2f}GB")
+
+
+def command_compare(args):
+    """在固定样本上运行两组配置，并列报告吞吐差异和描述差异"""
+    from autotune import sample_pending_tasks
+    from golden_compare import compare_runs, format_report, load_sample, parse_config, run_config, save_sample
+
+    # 样本保存到文件，之后的对比使用完全相同的图片
+    if os.path.exists(args.sample_file):
+        sample_tasks = load_sample(args.sample_file)
+    else:
+        sample_tasks = sample_pending_tasks(args.sample_size, args.seed, load_checkpoint_files(args.checkpoint))
+        if not sample_tasks:
+            print("没有待处理任务可用于对比")
+            return
+        save_sample(sample_tasks, args.sample_file)
+    print(f"对比样本 {len(sample_tasks)} 张图片 ({args.sample_file})")
+
+    runs = []
+    for config in (parse_config(args.baseline), parse_config(args.candidate)):
+        print(f"运行配置: {config or '默认'}")
+        runs.append(run_config(config, sample_tasks, args.device, args.model_name))
+
+    report = compare_runs(runs[0], runs[1])
+    print(format_report(report, args.show_diffs))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"对比报告已写入 {args.output}")
+
+
+def command_bench_transport(args):
+    """比较进程间传输张量数据的两种方式：pickle 的 Queue 与共享内存环形缓冲区"""
+    from shm_ring import benchmark_transport
+
+    results = benchmark_transport(args.payload_mb, args.iterations, args.slots)
+    for result in results:
+        print(f"{result['transport']:>9}: {result['mb_per_sec']:8.1f} MB/s, "
+              f"延迟 p50 {result['latency_p50_ms']:.2f}ms / p99 {result['latency_p99_ms']:.2f}ms "
+              f"({result['iterations']} 次 x {result['payload_mb']:.1f}MB)")
+
+
+def manifest_image_order(jsons_dir=DEFAULT_JSONS_DIR, detail_dir=DEFAULT_DETAIL_DIR):
+    """按模板顺序列出全部形状元素图片，同一模板的图片打包到相邻位置"""
+    from task_manifest import iter_template_shapes, load_template
+
+    image_paths = []
+    seen = set()
+    for json_file in sorted(os.listdir(jsons_dir)):
+        try:
+            name, data, detail = load_template(json_file, jsons_dir, detail_dir)
+        except Exception as e:
+            print(f"读取模板 {json_file} 失败: {e}")
+            continue
+        for shape in iter_template_shapes(name, data, detail):
+            if shape['image_path'] not in seen:
+                seen.add(shape['image_path'])
+                image_paths.append(shape['image_path'])
+    return image_paths
+
+
+def command_pack_images(args):
+    """把散落的图片文件打包成 tar / zip 分片并建立索引，供 --image-source 使用"""
+    import logging
+    from image_sources import pack_directory
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    image_paths = manifest_image_order() if args.manifest_order else None
+    index_path = pack_directory(args.root, args.output_dir, image_paths, args.shard_size_mb, args.format)
+    print(f"使用方式: caption_cli.py run --image-source {index_path}")
+
+
+def command_neighbors(args):
+    """在导出的图片特征库中查询最相似的图片"""
+    from embedding_store import EmbeddingIndex
+
+    index = EmbeddingIndex(args.embedding_dir)
+    if args.image_path not in index.rows:
+        print(f"特征库中没有 {args.image_path}")
+        return
+    neighbors = index.nearest_to_id(args.image_path, args.k)
+    if args.json:
+        print(json.dumps([{'image_path': item, 'score': score} for item, score in neighbors], ensure_ascii=False,
+                         indent=2))
+        return
+    print(f"{args.image_path} 的最近邻 (共 {len(index)} 条特征):")
+    for item, score in neighbors:
+        print(f"  {score:.4f}  {item}")
+
+
+def command_bench_tasks(args):
+    """在相同的任务清单上对比字典任务和紧凑任务表的内存与 pickle 大小"""
+    from task_table import compare_task_representations
+
+    results = compare_task_representations(args.jsons_dir, args.detail_dir, args.output_dir, args.batch_size)
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return
+    dict_result, compact_result = results
+    print(f"任务数: {dict_result['tasks']}, 批次数: {dict_result['batches']} (每批 {args.batch_size})")
+    rows = [
+        ('构建耗时 (s)', 'build_seconds', "{:.2f}"),
+        ('Python 分配峰值 (MB)', 'python_peak_mb', "{:.1f}"),
+        ('RSS 增长 (MB)', 'rss_growth_mb', "{:.1f}"),
+        ('全部批次 pickle (字节)', 'batch_pickle_bytes', "{:,}"),
+        ('每个工作进程启动时 (字节)', 'per_worker_pickle_bytes', "{:,}"),
+    ]
+    print(f"{'':<28}{'字典':>16}{'紧凑':>16}{'比例':>10}")
+    for label, key, fmt in rows:
+        before, after = dict_result[key], compact_result[key]
+        ratio = f"{after / before:.2f}x" if before else "-"
+        print(f"{label:<28}{fmt.format(before):>16}{fmt.format(after):>16}{ratio:>10}")
+
+
+def add_generator_arguments(parser):
+    """run / serve 共用的生成器参数"""
+    parser.add_argument('--num-gpus', type=int, default=None)
+    parser.add_argument('--batch-size', type=int, default=None)
+    parser.add_argument('--max-new-tokens', type=int, default=None)
+    parser.add_argument('--max-image-size', type=int, default=None)
+    parser.add_argument('--model-name', default="HuggingFaceM4/idefics2-8b")
+    parser.add_argument('--max-retries', type=int, default=3)
+    parser.add_argument('--retry-backoff', type=float, default=2.0,
+                        help="失败图片第 n 次重试延后 backoff * 2^(n-1) 秒（仅 advanced）")
+    parser.add_argument('--retry-resize-factor', type=float, default=0.75,
+                        help="每次重试把图片缩放上限乘以该系数（仅 advanced）")
+    parser.add_argument('--checkpoint-interval', type=int, default=1000)
+    parser.add_argument('--profile', default=DEFAULT_PROFILE_PATH)
+    parser.add_argument('--no-profile', action='store_true', help="忽略自动调优配置")
+    parser.add_argument('--device-type', choices=['cuda', 'cpu'], default='cuda',
+                        help="cpu 时 --num-gpus 表示CPU工作进程数（仅 advanced）")
+    parser.add_argument('--cpu-threads', type=int, default=None, help="每个CPU工作进程绑定的核心数，默认平均分配")
+    parser.add_argument('--quantize', choices=['int8'], default=None, help="CPU后端对线性层做动态 int8 量化")
+    parser.add_argument('--devices', default=None, help="使用的设备序号，例如 0,2,3（跳过被其他任务占用的卡）")
+    parser.add_argument('--replicas-per-device', type=int, default=1, help="每个设备上的模型副本数")
+    parser.add_argument('--memory-fraction', type=float, default=None, help="每个副本可用的显存比例")
+    parser.add_argument('--placement-file', default=None, help="JSON格式的 工作进程->设备 放置表（仅 advanced）")
+    parser.add_argument('--draft-model-name', default=None, help="辅助（推测）解码使用的小草稿模型（仅 advanced）")
+    parser.add_argument('--template-ordered', action='store_true',
+                        help="按模板调度，模板完成后立即写出汇总记录（仅 advanced）")
+    parser.add_argument('--template-output-dir', default=DEFAULT_TEMPLATE_OUTPUT_DIR, help="模板汇总记录目录")
+    parser.add_argument('--validate-images', action='store_true',
+                        help="派发前并行检查图片，坏图记入持久缓存，之后的运行直接跳过（仅 advanced）")
+    parser.add_argument('--validation-workers', type=int, default=None, help="图片检查进程数，默认CPU核数")
+    parser.add_argument('--telemetry-interval', type=float, default=10.0, help="资源采样间隔（秒），0 表示关闭")
+    parser.add_argument('--telemetry-path', default=DEFAULT_TELEMETRY_PATH, help="资源时序输出，.jsonl 或 .csv")
+    parser.add_argument('--max-memory-percent', type=float, default=DEFAULT_MAX_MEMORY_PERCENT,
+                        help="主机内存超过该比例时暂停派发新批次（basic / advanced）")
+    parser.add_argument('--compile', nargs='?', const='auto', default=None,
+                        choices=['auto', 'default', 'reduce-overhead', 'max-autotune'],
+                        help="用 torch.compile 编译视觉编码器和解码步（仅 advanced），auto 时 GPU 用 reduce-overhead；"
+                             "预处理后的像素按 mask 补齐到分辨率桶，上线前用 compare --candidate compile_mode=auto 确认描述一致")
+    parser.add_argument('--batch-buckets', default="1,2,4,8", help="编译模式下的批次分桶")
+    parser.add_argument('--size-buckets', default="512,768,1024", help="编译模式下的分辨率分桶（最长边）")
+    parser.add_argument('--trace-sample-rate', type=float, default=0.0,
+                        help="按该比例抽样任务，导出逐跳时间线（Chrome trace 格式，仅 advanced）")
+    parser.add_argument('--trace-path', default="trace.json")
+    parser.add_argument('--image-source', default=DEFAULT_IMAGE_ROOT,
+                        help="图片目录，或 pack-images 生成的分片索引 index.json（仅 advanced）")
+    parser.add_argument('--elastic', action='store_true',
+                        help="弹性工作进程池：启动时只用空闲的GPU，运行中可扩容 / 排空（仅 advanced）")
+    parser.add_argument('--control-file', default="pool_control.txt",
+                        help="弹性池控制文件，每行一条命令：add <设备> / drain [worker_id]")
+    parser.add_argument('--rescan-interval', type=float, default=60.0, help="重新发现空闲GPU的间隔（秒），0 表示关闭")
+    parser.add_argument('--group-size', type=int, default=1,
+                        help="同一模板的多个元素合并到一个多图提示中生成（仅 improved），1 表示逐张")
+    parser.add_argument('--image-splitting', dest='do_image_splitting', action=argparse.BooleanOptionalAction,
+                        default=None, help="覆盖预处理配置中的图片切分（开启时每张图片 5 倍视觉 token，仅 advanced）")
+    parser.add_argument('--longest-edge', type=int, default=None, help="覆盖预处理配置中的最长边（仅 advanced）")
+    parser.add_argument('--preprocess-profile', default=DEFAULT_PREPROCESS_PROFILE_PATH,
+                        help="按模型名覆盖内置预处理设置的 JSON 文件")
+    parser.add_argument('--prompts', default=None,
+                        help=f"多提示词：逗号分隔的输出键（{', '.join(PROMPT_PRESETS)}）或 JSON 文件，"
+                             f"每张图片只编码一次（仅 advanced）")
+    parser.add_argument('--embedding-dir', default=None,
+                        help="同时导出池化后的视觉特征到该目录（float16 内存映射分片 + id 索引，仅 advanced）")
+    parser.add_argument('--thread-budget', action='store_true',
+                        help="每个工作进程绑定互不重叠的核心，并限制 intra-op / inter-op / tokenizers / 图片预处理线程数（仅 advanced）")
+    parser.add_argument('--numa-aware', action='store_true', help="线程预算按GPU所在的 NUMA 节点分配核心")
+    parser.add_argument('--reserved-cores', type=int, default=DEFAULT_RESERVED_CORES, help="留给主进程的核心数")
+    parser.add_argument('--intra-op-threads', type=int, default=None, help="每个工作进程的 intra-op 线程数，默认等于分到的核心数")
+    parser.add_argument('--inter-op-threads', type=int, default=DEFAULT_INTER_OP_THREADS)
+    parser.add_argument('--compact-tasks', action='store_true',
+                        help="任务保存在紧凑任务表中，批次只传任务序号（仅 advanced）")
+    parser.add_argument('--canvas-context', action='store_true', help="多图提示中附带画布的类别、标题和关键词")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="多GPU图片描述生成统一入口")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    plan = subparsers.add_parser('plan', help="只扫描任务清单并估算工作量，不加载模型")
+    plan.add_argument('--variant', choices=sorted(GENERATORS), default='advanced')
+    plan.add_argument('--jsons-dir', default=DEFAULT_JSONS_DIR)
+    plan.add_argument('--detail-dir', default=DEFAULT_DETAIL_DIR)
+    plan.add_argument('--output-dir', default=DEFAULT_OUTPUT_DIR)
+    plan.add_argument('--checkpoint', default='checkpoint.json')
+    plan.add_argument('--num-gpus', type=int, default=8)
+    plan.add_argument('--img-per-sec-per-gpu', type=float, default=None,
+                      help="单卡吞吐，默认读取自动调优结果，否则为 1.0")
+    plan.add_argument('--profile', default=DEFAULT_PROFILE_PATH)
+    plan.add_argument('--tokens-per-image', type=int, default=None, help="默认按模型的预处理配置估算")
+    plan.add_argument('--model-name', default="HuggingFaceM4/idefics2-8b")
+    plan.add_argument('--preprocess-profile', default=DEFAULT_PREPROCESS_PROFILE_PATH)
+    plan.add_argument('--show-duplicates', type=int, default=10)
+    plan.add_argument('--measure-imports', action='store_true',
+                      help="在子进程中测量 torch 等重量级依赖的冷启动导入耗时")
+    plan.add_argument('--json', action='store_true', help="以 JSON 输出报告")
+    plan.set_defaults(func=command_plan)
+
+    run = subparsers.add_parser('run', help="运行生成脚本")
+    run.add_argument('--variant', choices=sorted(GENERATORS), default='advanced')
+    add_generator_arguments(run)
+    run.set_defaults(func=command_run)
+
+    serve = subparsers.add_parser('serve', help="启动常驻描述服务（HTTP 或 Unix socket），仅 advanced")
+    add_generator_arguments(serve)
+    serve.add_argument('--host', default="127.0.0.1")
+    serve.add_argument('--port', type=int, default=8080)
+    serve.add_argument('--unix-socket', default=None, help="监听 Unix socket 而不是 TCP 端口")
+    serve.add_argument('--max-wait-ms', type=float, default=50, help="合并批次时第一个请求的最长等待时间")
+    serve.add_argument('--jobs-dir', default="./service_jobs", help="批量任务结果目录")
+    serve.add_argument('--max-incoming', type=int, default=DEFAULT_MAX_INCOMING, help="等待合并成批次的请求上限")
+    serve.set_defaults(func=command_serve)
+
+    watch = subparsers.add_parser('watch', help="守护模式：轮询模板目录，增量生成新到达模板的描述，仅 advanced")
+    add_generator_arguments(watch)
+    watch.add_argument('--jsons-dir', default=DEFAULT_JSONS_DIR)
+    watch.add_argument('--detail-dir', default=DEFAULT_DETAIL_DIR)
+    watch.add_argument('--output-dir', default=DEFAULT_OUTPUT_DIR)
+    watch.add_argument('--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL, help="轮询目录 mtime 的间隔（秒）")
+    watch.add_argument('--max-wait-ms', type=float, default=50, help="合并批次时第一个请求的最长等待时间")
+    watch.add_argument('--report-interval', type=float, default=DEFAULT_WATCH_REPORT_INTERVAL,
+                       help="打印延迟统计的间隔（秒）")
+    watch.add_argument('--latency-log', default=DEFAULT_LATENCY_LOG_PATH, help="逐张图片的端到端延迟记录（JSONL）")
+    watch.add_argument('--max-incoming', type=int, default=DEFAULT_MAX_INCOMING,
+                       help="等待合并成批次的请求上限，提交新模板时在此阻塞")
+    watch.add_argument('--from-now', action='store_true', help="跳过启动时已有的模板，只处理之后到达的文件")
+    watch.set_defaults(func=command_watch)
+
+    autotune = subparsers.add_parser('autotune', help="在真实任务样本上校准批次大小、生成长度等参数")
+    autotune.add_argument('--model-name', default="HuggingFaceM4/idefics2-8b")
+    autotune.add_argument('--device', default="cuda:0")
+    autotune.add_argument('--sample-size', type=int, default=64)
+    autotune.add_argument('--seed', type=int, default=0)
+    autotune.add_argument('--checkpoint', default='checkpoint.json')
+    autotune.add_argument('--batch-sizes', default="4,8,16")
+    autotune.add_argument('--max-new-tokens', default="60,100")
+    autotune.add_argument('--max-image-sizes', default="768,1024")
+    autotune.add_argument('--longest-edges', default="980", help="预处理最长边候选")
+    autotune.add_argument('--try-image-splitting', action='store_true', help="同时校准开启图片切分的配置")
+    autotune.add_argument('--preprocess-profile', default=DEFAULT_PREPROCESS_PROFILE_PATH)
+    autotune.add_argument('--max-memory-gb', type=float, default=None, help="峰值内存上限，超过的配置不会被选中")
+    autotune.add_argument('--num-gpus', type=int, default=None, help="写入配置的GPU数量，默认为本机可见GPU数")
+    autotune.add_argument('--profile', default=DEFAULT_PROFILE_PATH)
+    autotune.set_defaults(func=command_autotune)
+
+    compare = subparsers.add_parser('compare', help="在固定样本上对比两组配置的吞吐和描述差异")
+    compare.add_argument('--baseline', default="", help="基准配置：JSON 文件或 key=value,... ，默认为生成器默认值")
+    compare.add_argument('--candidate', required=True, help="待比较配置，格式同 --baseline")
+    compare.add_argument('--model-name', default="HuggingFaceM4/idefics2-8b")
+    compare.add_argument('--device', default="cuda:0")
+    compare.add_argument('--sample-file', default="golden_sample.json", help="固定样本文件，不存在时抽样生成")
+    compare.add_argument('--sample-size', type=int, default=64)
+    compare.add_argument('--seed', type=int, default=0)
+    compare.add_argument('--checkpoint', default='checkpoint.json')
+    compare.add_argument('--show-diffs', type=int, default=5)
+    compare.add_argument('--output', default=None, help="把完整对比报告写入 JSON 文件")
+    compare.set_defaults(func=command_compare)
+
+    bench = subparsers.add_parser('bench-transport', help="测量进程间张量传输的吞吐和延迟")
+    bench.add_argument('--payload-mb', type=float, default=8)
+    bench.add_argument('--iterations', type=int, default=50)
+    bench.add_argument('--slots', type=int, default=4, help="环形缓冲区槽位数")
+    bench.set_defaults(func=command_bench_transport)
+
+    pack = subparsers.add_parser('pack-images', help="把图片目录打包成带索引的 tar / zip 分片")
+    pack.add_argument('--root', default=DEFAULT_IMAGE_ROOT)
+    pack.add_argument('--output-dir', required=True)
+    pack.add_argument('--shard-size-mb', type=int, default=DEFAULT_SHARD_SIZE_MB)
+    pack.add_argument('--format', choices=['tar', 'zip'], default='tar')
+    pack.add_argument('--manifest-order', action='store_true',
+                      help="只打包模板中的形状元素，并按模板顺序排列（默认按目录顺序打包全部文件）")
+    pack.set_defaults(func=command_pack_images)
+
+    neighbors = subparsers.add_parser('neighbors', help="在 --embedding-dir 导出的特征库中查询相似图片")
+    neighbors.add_argument('image_path', help="特征库中的图片 id（即任务的 image_path）")
+    neighbors.add_argument('--embedding-dir', default=DEFAULT_EMBEDDING_DIR)
+    neighbors.add_argument('-k', type=int, default=10)
+    neighbors.add_argument('--json', action='store_true')
+    neighbors.set_defaults(func=command_neighbors)
+
+    bench_tasks = subparsers.add_parser('bench-tasks', help="对比字典任务和紧凑任务表的内存占用与 pickle 大小")
+    bench_tasks.add_argument('--jsons-dir', default=DEFAULT_JSONS_DIR)
+    bench_tasks.add_argument('--detail-dir', default=DEFAULT_DETAIL_DIR)
+    bench_tasks.add_argument('--output-dir', default=DEFAULT_OUTPUT_DIR)
+    bench_tasks.add_argument('--batch-size', type=int, default=8)
+    bench_tasks.add_argument('--json', action='store_true')
+    bench_tasks.set_defaults(func=command_bench_tasks)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import re
+
+from lazy_imports import lazy_import
+
+# 描述约定：一句话、不超过30个词
+DEFAULT_MAX_CAPTION_WORDS = 30
+SENTENCE_TERMINATORS = (".", "!", "?", "。", "！", "？")
+
+
+def row_value(value, row):
+    """按行取值：列表按行索引，标量对所有行相同"""
+    return value[row] if isinstance(value, (list, tuple)) else value
+
+
+class CaptionStoppingCriteria:
+    """按描述约定提前停止生成：超过词数预算或写完一句话即停止，逐行判断
+
+    返回每一行的布尔结果，已完成的行会被 generate 标记为结束并只填充 pad，
+    整批在所有行完成后立即结束，而不是等到 EOS 或 max_new_tokens。
+    max_words / stop_on_sentence_end 也可以是按行的列表（多提示词批次中每行的输出要求不同）。
+    max_new_tokens 为按行的 token 预算：整批的 generate 上限取各行最大值时，预算较小的行在此结束。
+    """
+
+    def __init__(self, tokenizer, prompt_length, max_words=DEFAULT_MAX_CAPTION_WORDS,
+                 stop_on_sentence_end=True, min_words=3, max_new_tokens=None):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.max_words = max_words
+        self.stop_on_sentence_end = stop_on_sentence_end
+        self.min_words = min_words
+        self.max_new_tokens = max_new_tokens
+        self.finished = None
+
+    def reset(self):
+        self.finished = None
+
+    def row_finished(self, token_ids, row=0):
+        budget = row_value(self.max_new_tokens, row)
+        if budget is not None and len(token_ids) >= budget:
+            return True
+        text = self.tokenizer.decode(token_ids, skip_special_tokens=True).strip()
+        words = text.split()
+
+        # 出现第 max_words + 1 个词时说明前 max_words 个词已经完整
+        if len(words) > row_value(self.max_words, row):
+            return True
+        return (row_value(self.stop_on_sentence_end, row) and len(words) >= self.min_words
+                and text.endswith(SENTENCE_TERMINATORS))
+
+    def __call__(self, input_ids, scores, **kwargs):
+        torch = lazy_import("torch")
+        if self.finished is None:
+            self.finished = [False] * input_ids.shape[0]
+
+        new_tokens = input_ids[:, self.prompt_length:]
+        for row, token_ids in enumerate(new_tokens):
+            if not self.finished[row]:
+                self.finished[row] = self.row_finished(token_ids, row)
+
+        return torch.tensor(self.finished, dtype=torch.bool, device=input_ids.device)
+
+
+def build_caption_stopping_criteria(tokenizer, prompt_length, max_words=DEFAULT_MAX_CAPTION_WORDS,
+                                    stop_on_sentence_end=True, max_new_tokens=None):
+    """构造传给 model.generate 的停止条件列表"""
+    transformers = lazy_import("transformers")
+    return transformers.StoppingCriteriaList([
+        CaptionStoppingCriteria(tokenizer, prompt_length, max_words, stop_on_sentence_end,
+                                max_new_tokens=max_new_tokens)
+    ])
+
+
+def trim_caption(text, max_words=DEFAULT_MAX_CAPTION_WORDS):
+    """截断到词数预算以内"""
+    words = text.split()
+    if len(words) > max_words:
+        return " ".join(words[:max_words])
+    return text
+
+
+def decode_new_tokens(tokenizer, generated_ids, prompt_length, max_words=DEFAULT_MAX_CAPTION_WORDS,
+                      pad_token_id=None, max_new_tokens=None):
+    """只解码新生成的 token，返回 (描述列表, 每行新生成的 token 数)
+
+    pad_token_id 为传给 generate 的填充 token（已结束的行用它填充），默认取 tokenizer 的设置。
+    每行计数到第一个 EOS 或填充 token 为止，不把结束后的填充算作生成的 token。
+    max_new_tokens（标量或按行列表）给出时，每行的文本和计数都不超过该行的预算。
+    """
+    new_tokens = generated_ids[:, prompt_length:]
+    if max_new_tokens is None:
+        texts = tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+    else:
+        texts = [tokenizer.decode(token_ids[:row_value(max_new_tokens, row)], skip_special_tokens=True)
+                 for row, token_ids in enumerate(new_tokens)]
+
+    if pad_token_id is None:
+        pad_token_id = tokenizer.pad_token_id
+    ended = new_tokens == tokenizer.eos_token_id
+    if pad_token_id is not None:
+        ended = ended | (new_tokens == pad_token_id)
+    token_counts = (ended.cumsum(dim=1) == 0).sum(dim=1).tolist()
+    if max_new_tokens is not None:
+        token_counts = [min(count, row_value(max_new_tokens, row)) for row, count in enumerate(token_counts)]
+
+    captions = [trim_caption(text.strip(), row_value(max_words, row)) for row, text in enumerate(texts)]
+    return captions, token_counts
+
+
+GROUP_LINE_PATTERN = re.compile(r"^\s*(?:image|图片|element)?\s*#?(\d+)\s*[:：.)\-]\s*(.+?)\s*$", re.IGNORECASE)
+
+
+def parse_group_captions(text, count, max_words=DEFAULT_MAX_CAPTION_WORDS):
+    """从多图提示的回答中按 "Image k: ..." 逐行取出每张图片的描述
+
+    编号必须覆盖 1..count 且每条非空，否则返回 None，由调用方退回逐张生成。
+    """
+    captions = {}
+    for line in text.splitlines():
+        match = GROUP_LINE_PATTERN.match(line)
+        if match is None:
+            continue
+        index = int(match.group(1))
+        if 1 <= index <= count and index not in captions:
+            captions[index] = trim_caption(match.group(2).strip(), max_words)
+
+    if len(captions) != count or not all(captions.values()):
+        return None
+    return [captions[index] for index in range(1, count + 1)]
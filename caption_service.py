@@ -0,0 +1,394 @@
+import json
+import logging
+import os
+import queue
+import socketserver
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Process, Queue
+import multiprocessing as mp
+from queue import Empty, Full
+
+from flow_control import PROGRESS_QUEUE_SIZE, RESULT_QUEUE_PER_WORKER, TASK_PREFETCH_PER_WORKER, QueueOccupancy
+from multi_prompt import write_outputs
+from retry_queue import RetryScheduler
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOBS_DIR = "./service_jobs"
+# 等待合并成批次的请求上限；超过时 submit 阻塞，HTTP 同步请求在等待超时后返回 503
+DEFAULT_MAX_INCOMING = 1024
+DEFAULT_SUBMIT_TIMEOUT = 5.0
+
+
+class ServiceBusy(Exception):
+    """请求队列已满"""
+
+
+def percentile(values, fraction):
+    """计算百分位数（最近邻），空列表返回 None"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class PendingRequest:
+    """一张图片的待完成请求"""
+
+    def __init__(self, task, job_id=None):
+        self.task = task
+        self.job_id = job_id
+        self.submitted_at = time.time()
+        self.done = threading.Event()
+        self.result = None
+
+
+class CaptionService:
+    """常驻描述服务：工作进程只加载一次模型，并发请求按最长等待时间合并成批次"""
+
+    def __init__(self, generator, max_batch_size=8, max_wait_ms=50, latency_window=1000,
+                 jobs_dir=DEFAULT_JOBS_DIR, max_incoming=DEFAULT_MAX_INCOMING):
+        self.generator = generator
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.jobs_dir = jobs_dir
+
+        # 入口队列同样有界：pending 只包含已进入队列或正在处理的请求
+        self.max_incoming = max_incoming
+        self.incoming = queue.Queue(maxsize=max_incoming)
+        self.rejected = 0
+        self.occupancy = None
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.latencies = deque(maxlen=latency_window)
+        self.jobs = {}
+        self.completed = 0
+        self.failed = 0
+        self.batches = 0
+
+        self.task_queue = None
+        self.result_queue = None
+        self.progress_queue = None
+        self.retry_queue = None
+        self.retry_scheduler = None
+        self.stop_event = None
+        self.processes = []
+        self.threads = []
+
+    def start(self):
+        """启动工作进程以及批次合并、结果分发线程"""
+        num_workers = len(self.generator.placement)
+        self.task_queue = Queue(maxsize=num_workers * TASK_PREFETCH_PER_WORKER)
+        self.result_queue = Queue(maxsize=num_workers * max(RESULT_QUEUE_PER_WORKER, self.max_batch_size))
+        self.progress_queue = Queue(maxsize=PROGRESS_QUEUE_SIZE)
+        self.retry_queue = Queue(maxsize=num_workers * TASK_PREFETCH_PER_WORKER)
+        self.stop_event = mp.Event()
+        self.occupancy = QueueOccupancy({
+            'incoming': (self.incoming, self.max_incoming),
+            'task': (self.task_queue, num_workers * TASK_PREFETCH_PER_WORKER),
+            'result': (self.result_queue, num_workers * max(RESULT_QUEUE_PER_WORKER, self.max_batch_size)),
+            'retry': (self.retry_queue, num_workers * TASK_PREFETCH_PER_WORKER),
+        })
+        self.retry_scheduler = RetryScheduler(
+            self.retry_queue, self.generator.max_retries, self.generator.retry_backoff,
+            self.generator.retry_resize_factor, self.generator.max_image_size
+        )
+
+        for worker in self.generator.placement:
+            p = Process(
+                target=self.generator.worker_process,
+                args=(worker['worker_id'], self.task_queue, self.result_queue, self.progress_queue, self.stop_event,
+                      self.retry_queue)
+            )
+            p.start()
+            self.processes.append(p)
+
+        for target in (self.batch_loop, self.dispatch_loop):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+        logger.info(f"描述服务已启动: {len(self.processes)} 个工作进程, 批次上限 {self.max_batch_size}, "
+                    f"最长等待 {self.max_wait * 1000:.0f}ms")
+
+    def stop(self):
+        """通知工作进程结束并等待退出"""
+        for _ in self.processes:
+            self.task_queue.put(None)
+        for p in self.processes:
+            p.join(timeout=30)
+            if p.is_alive():
+                p.terminate()
+                p.join()
+        self.stop_event.set()
+        logger.info("描述服务已停止")
+
+    def submit(self, image_path, output_path=None, job_id=None, timeout=None):
+        """提交一张图片，返回 PendingRequest
+
+        请求队列满时阻塞；timeout 秒内仍然放不进去时抛出 ServiceBusy（timeout 为 None 时一直等待）。
+        """
+        task = {
+            'task_id': uuid.uuid4().hex,
+            'image_path': image_path,
+            'output_path': output_path
+        }
+        request = PendingRequest(task, job_id)
+        with self.pending_lock:
+            self.pending[task['task_id']] = request
+        try:
+            self.incoming.put(request, timeout=timeout)
+        except Full:
+            with self.pending_lock:
+                self.pending.pop(task['task_id'], None)
+            self.rejected += 1
+            raise ServiceBusy(f"请求队列已满（{self.max_incoming}）")
+        return request
+
+    def caption(self, image_path, output_path=None, timeout=None, submit_timeout=None):
+        """同步生成一张图片的描述"""
+        request = self.submit(image_path, output_path, timeout=submit_timeout)
+        if not request.done.wait(timeout):
+            raise TimeoutError(f"等待 {image_path} 的描述超时")
+        return request.result
+
+    def batch_loop(self):
+        """把并发请求合并成批次：凑满批次或第一个请求等待超过 max_wait 时立即发出"""
+        while not self.stop_event.is_set():
+            try:
+                first = self.incoming.get(timeout=0.5)
+            except Empty:
+                continue
+
+            batch = [first.task]
+            deadline = first.submitted_at + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.incoming.get(timeout=remaining).task)
+                except Empty:
+                    break
+
+            # 任务队列有界：工作进程都在忙时在这里等待，新请求留在 incoming 中排队
+            self.task_queue.put(batch)
+            self.batches += 1
+
+    def dispatch_loop(self):
+        """把工作进程的结果分发回对应请求"""
+        while not self.stop_event.is_set():
+            # 服务模式不使用进度队列，及时清空避免堆积
+            try:
+                while True:
+                    self.progress_queue.get_nowait()
+            except Empty:
+                pass
+
+            self.retry_scheduler.pump()
+            try:
+                result = self.result_queue.get(timeout=0.5)
+            except Empty:
+                continue
+            # 服务模式不写特征库，特征数组也无法作为 JSON 返回
+            result.pop('embedding', None)
+
+            # 失败的图片延后重试，请求在重试完成或最终失败时才返回
+            if result.get('retry'):
+                result = self.retry_scheduler.schedule(result)
+                if result is None:
+                    continue
+            else:
+                self.retry_scheduler.record(result)
+
+            with self.pending_lock:
+                request = self.pending.pop(result.get('task_id'), None)
+            if request is None:
+                continue
+
+            latency = time.time() - request.submitted_at
+            result['latency'] = latency
+            self.latencies.append(latency)
+
+            if result['success']:
+                self.completed += 1
+                if result['output_path']:
+                    write_outputs(result)
+            else:
+                self.failed += 1
+
+            request.result = result
+            request.done.set()
+            if request.job_id is not None:
+                self.record_job_result(request.job_id, result)
+
+    def submit_job(self, lines):
+        """提交批量任务，lines 为 JSONL 行，每行 {"image_path": ..., "output_path": ...}"""
+        job_id = uuid.uuid4().hex[:12]
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        entries = [json.loads(line) for line in lines if line.strip()]
+        self.jobs[job_id] = {
+            'job_id': job_id,
+            'total': len(entries),
+            'done': 0,
+            'failed': 0,
+            'submitted_at': time.time(),
+            'finished_at': None,
+            'results_path': f"{self.jobs_dir}/{job_id}.jsonl",
+            'lock': threading.Lock()
+        }
+        if not entries:
+            self.jobs[job_id]['finished_at'] = time.time()
+        # 批量任务在后台线程中逐个提交，请求队列满时等待，不一次性全部放入内存中的队列
+        thread = threading.Thread(target=self.submit_entries, args=(job_id, entries), daemon=True)
+        thread.start()
+        return job_id
+
+    def submit_entries(self, job_id, entries):
+        for entry in entries:
+            if self.stop_event.is_set():
+                return
+            self.submit(entry['image_path'], entry.get('output_path'), job_id)
+
+    def record_job_result(self, job_id, result):
+        job = self.jobs[job_id]
+        with job['lock']:
+            with open(job['results_path'], "a", encoding='utf-8') as file:
+                file.write(json.dumps(result, ensure_ascii=False) + "\n")
+            job['done'] += 1
+            if not result['success']:
+                job['failed'] += 1
+            if job['done'] == job['total']:
+                job['finished_at'] = time.time()
+
+    def job_status(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        return {key: value for key, value in job.items() if key != 'lock'}
+
+    def stats(self):
+        """队列深度和延迟统计"""
+        latencies = list(self.latencies)
+        with self.pending_lock:
+            in_flight = len(self.pending)
+        p50 = percentile(latencies, 0.50)
+        p99 = percentile(latencies, 0.99)
+        return {
+            'queue_depth': self.incoming.qsize(),
+            'queue_capacity': self.max_incoming,
+            'occupancy': self.occupancy.current() if self.occupancy else "",
+            'rejected': self.rejected,
+            'in_flight': in_flight,
+            'workers': len(self.processes),
+            'batches': self.batches,
+            'completed': self.completed,
+            'failed': self.failed,
+            'retries_pending': self.retry_scheduler.pending() if self.retry_scheduler else 0,
+            'retries_succeeded': self.retry_scheduler.stats['succeeded'] if self.retry_scheduler else 0,
+            'latency_p50_ms': p50 * 1000 if p50 is not None else None,
+            'latency_p99_ms': p99 * 1000 if p99 is not None else None,
+        }
+
+
+class CaptionRequestHandler(BaseHTTPRequestHandler):
+    """HTTP 接口
+
+    POST /caption   {"image_path": ..., "output_path": 可选}  同步返回描述，请求队列满时返回 503
+    POST /jobs      JSONL 请求体，或 {"jsonl_path": ...}      返回 job_id
+    GET  /jobs/<id>                                           任务进度
+    GET  /stats                                               队列深度与 p50/p99 延迟
+    """
+
+    service = None
+    request_timeout = 600
+    submit_timeout = DEFAULT_SUBMIT_TIMEOUT
+
+    def address_string(self):
+        # Unix socket 没有客户端地址
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length).decode('utf-8')
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.send_json(200, self.service.stats())
+        elif self.path.startswith("/jobs/"):
+            status = self.service.job_status(self.path[len("/jobs/"):])
+            if status is None:
+                self.send_json(404, {'error': "任务不存在"})
+            else:
+                self.send_json(200, status)
+        else:
+            self.send_json(404, {'error': "未知路径"})
+
+    def do_POST(self):
+        try:
+            body = self.read_body()
+            if self.path == "/caption":
+                payload = json.loads(body)
+                result = self.service.caption(payload['image_path'], payload.get('output_path'),
+                                              timeout=self.request_timeout, submit_timeout=self.submit_timeout)
+                self.send_json(200, result)
+            elif self.path == "/jobs":
+                lines = [line for line in body.splitlines() if line.strip()]
+                # 也可以只传一个服务器本地的 JSONL 文件路径
+                if len(lines) == 1 and 'jsonl_path' in json.loads(lines[0]):
+                    with open(json.loads(lines[0])['jsonl_path'], encoding='utf-8') as file:
+                        lines = file.readlines()
+                self.send_json(202, {'job_id': self.service.submit_job(lines)})
+            else:
+                self.send_json(404, {'error': "未知路径"})
+        except ServiceBusy as e:
+            self.send_json(503, {'error': str(e)})
+        except TimeoutError as e:
+            self.send_json(504, {'error': str(e)})
+        except Exception as e:
+            self.send_json(400, {'error': str(e)})
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(service, host="127.0.0.1", port=8080, unix_socket=None):
+    """启动服务并阻塞，直到 Ctrl+C"""
+    handler = type("BoundCaptionRequestHandler", (CaptionRequestHandler,), {'service': service})
+
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = ThreadingUnixHTTPServer(unix_socket, handler)
+        logger.info(f"描述服务监听 unix:{unix_socket}")
+    else:
+        server = ThreadingHTTPServer((host, port), handler)
+        logger.info(f"描述服务监听 http://{host}:{port}")
+
+    service.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("收到中断信号，正在停止服务...")
+    finally:
+        server.server_close()
+        service.stop()
+        if unix_socket and os.path.exists(unix_socket):
+            os.remove(unix_socket)
@@ -0,0 +1,136 @@
+import logging
+import time
+
+from lazy_imports import lazy_import
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_BUCKETS = (1, 2, 4, 8)
+DEFAULT_SIZE_BUCKETS = (512, 768, 1024)
+
+# 不同版本 transformers 中视觉编码器 / 语言模型所在的属性路径
+VISION_MODULE_PATHS = ("model.vision_model", "vision_model", "model.vision_tower", "vision_tower")
+TEXT_MODULE_PATHS = ("model.text_model", "text_model", "model.language_model", "language_model")
+
+
+def find_submodule(model, paths):
+    for path in paths:
+        module = model
+        for name in path.split("."):
+            module = getattr(module, name, None)
+            if module is None:
+                break
+        if module is not None:
+            return path, module
+    return None, None
+
+
+class CompiledExecution:
+    """torch.compile 执行模式：编译视觉编码器和解码步，输入按固定的批次 / 分辨率分桶
+
+    预处理后的 pixel_values 用零补齐到 bucket x bucket，补齐区域在 pixel_attention_mask 中标为无效，
+    视觉编码器忽略这些 patch，图片内容与 eager 模式相同；批次补齐到最近的批次桶。
+    因此形状组合是有限的，重新编译次数有上限；所有组合在工作进程启动时预热。
+    """
+
+    def __init__(self, model, batch_buckets=DEFAULT_BATCH_BUCKETS, size_buckets=DEFAULT_SIZE_BUCKETS,
+                 mode=None, device="cuda"):
+        self.model = model
+        self.batch_buckets = sorted(batch_buckets)
+        self.size_buckets = sorted(size_buckets)
+        # reduce-overhead 依赖 CUDA Graphs，CPU 上使用默认模式
+        if mode in (None, "auto"):
+            mode = "default" if device == "cpu" else "reduce-overhead"
+        self.mode = mode
+        self.compiled_modules = []
+        self.stats = {
+            'compile_seconds': 0.0,
+            'warmup_shapes': 0,
+            'eager_seconds': None,
+            'compiled_seconds': None,
+        }
+
+    def compile(self):
+        torch = lazy_import("torch")
+        for paths, dynamic in ((VISION_MODULE_PATHS, False), (TEXT_MODULE_PATHS, None)):
+            path, module = find_submodule(self.model, paths)
+            if module is None:
+                logger.warning(f"未找到可编译的子模块: {paths}")
+                continue
+            # 视觉编码器输入已分桶，按静态形状编译；解码步的序列长度每步变化，交给自动动态形状
+            module.forward = torch.compile(module.forward, mode=self.mode, dynamic=dynamic)
+            self.compiled_modules.append(path)
+        return self.compiled_modules
+
+    def batch_bucket(self, count):
+        for bucket in self.batch_buckets:
+            if bucket >= count:
+                return bucket
+        return count
+
+    def size_bucket(self, longest_edge):
+        for bucket in self.size_buckets:
+            if bucket >= longest_edge:
+                return bucket
+        return self.size_buckets[-1]
+
+    def pad_inputs(self, inputs):
+        """把处理器输出的 pixel_values / pixel_attention_mask 右下补零到分辨率桶
+
+        不改变图片像素（不缩放、不贴画布），补齐区域的 mask 为 0，对模型不可见。
+        超过最大分辨率桶时保持原形状（会触发一次重新编译）。
+        """
+        F = lazy_import("torch.nn.functional")
+        pixel_values = inputs.get('pixel_values')
+        if pixel_values is None:
+            return inputs
+        height, width = pixel_values.shape[-2:]
+        size = self.size_bucket(max(height, width))
+        if max(height, width) > size:
+            logger.debug(f"预处理后尺寸 {height}x{width} 超过最大分辨率桶 {size}，不补齐")
+            return inputs
+        padding = (0, size - width, 0, size - height)
+        inputs['pixel_values'] = F.pad(pixel_values, padding, value=0.0)
+        mask = inputs.get('pixel_attention_mask')
+        if mask is not None:
+            inputs['pixel_attention_mask'] = F.pad(mask, padding, value=0)
+        return inputs
+
+    def pad_batch(self, images):
+        """重复最后一张图片把批次补齐到批次桶，多出的结果由调用方丢弃"""
+        target = self.batch_bucket(len(images))
+        return images + [images[-1]] * (target - len(images))
+
+    def warmup(self, generate_fn, max_batch_size):
+        """预热所有 (批次桶, 分辨率桶) 组合，返回编译耗时；generate_fn(images) 执行一次整批生成"""
+        Image = lazy_import("PIL.Image")
+        start = time.perf_counter()
+        for batch in self.batch_buckets:
+            if batch > self.batch_bucket(max_batch_size):
+                continue
+            for size in self.size_buckets:
+                generate_fn([Image.new("RGB", (size, size), "white")] * batch)
+                self.stats['warmup_shapes'] += 1
+        self.stats['compile_seconds'] = time.perf_counter() - start
+        return self.stats['compile_seconds']
+
+    def measure(self, generate_fn, batch_size, repeats=3):
+        """用最大的分辨率桶测一次稳态耗时（秒/批）"""
+        Image = lazy_import("PIL.Image")
+        images = [Image.new("RGB", (self.size_buckets[-1],) * 2, "white")] * self.batch_bucket(batch_size)
+        generate_fn(images)  # 不计入：首次调用包含内核选择等一次性开销
+        start = time.perf_counter()
+        for _ in range(repeats):
+            generate_fn(images)
+        return (time.perf_counter() - start) / repeats
+
+
+def summarize_compile_stats(stats):
+    speedup = None
+    if stats.get('eager_seconds') and stats.get('compiled_seconds'):
+        speedup = stats['eager_seconds'] / stats['compiled_seconds']
+    return {
+        'compile_seconds': stats['compile_seconds'],
+        'warmup_shapes': stats['warmup_shapes'],
+        'steady_state_speedup': speedup,
+    }
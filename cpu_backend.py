@@ -0,0 +1,40 @@
+import logging
+import os
+
+from lazy_imports import lazy_import
+
+logger = logging.getLogger(__name__)
+
+
+def available_cores():
+    """返回当前进程允许使用的CPU核心列表"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def partition_cores(num_workers, threads_per_worker=None, cores=None):
+    """把CPU核心切分成互不重叠的若干组，每个工作进程一组"""
+    if cores is None:
+        cores = available_cores()
+    if threads_per_worker is None:
+        threads_per_worker = max(1, len(cores) // num_workers)
+
+    if threads_per_worker * num_workers > len(cores):
+        raise ValueError(f"{num_workers} 个工作进程 x {threads_per_worker} 线程超过可用核心数 {len(cores)}")
+
+    return [cores[i * threads_per_worker:(i + 1) * threads_per_worker] for i in range(num_workers)]
+
+
+def pin_to_cores(cores):
+    """把当前进程绑定到指定核心，并让 PyTorch 的线程数与之匹配"""
+    torch = lazy_import("torch")
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+
+def quantize_dynamic_int8(model):
+    """对模型中的线性层做动态 int8 量化（仅适用于CPU推理）"""
+    torch = lazy_import("torch")
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
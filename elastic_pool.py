@@ -0,0 +1,298 @@
+import logging
+import os
+import signal
+import subprocess
+import time
+from multiprocessing import Event, Process
+
+from placement import parse_device_list
+from thread_budget import make_thread_budget
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONTROL_FILE = "pool_control.txt"
+DEFAULT_RESCAN_INTERVAL = 60.0
+# 空闲显存达到该比例的GPU才视为可用
+DEFAULT_MIN_FREE_FRACTION = 0.5
+
+
+def discover_devices(device_type="cuda", min_free_fraction=DEFAULT_MIN_FREE_FRACTION):
+    """查询当前空闲的GPU（通过 nvidia-smi，主进程不创建 CUDA 上下文）
+
+    CPU 没有可发现的容量，返回空列表；查询失败时同样返回空列表。
+    """
+    if device_type == "cpu":
+        return []
+    try:
+        output = subprocess.run(
+            ["nvidia-smi", "--query-gpu=index,memory.used,memory.total", "--format=csv,noheader,nounits"],
+            capture_output=True, text=True, timeout=10, check=True
+        ).stdout
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning(f"查询GPU失败: {e}")
+        return []
+
+    devices = []
+    visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+    visible = None if visible is None else [item.strip() for item in visible.split(",") if item.strip()]
+    for line in output.strip().splitlines():
+        index, used, total = [item.strip() for item in line.split(",")]
+        if visible is not None and index not in visible:
+            continue
+        if 1 - float(used) / float(total) >= min_free_fraction:
+            # 设置了 CUDA_VISIBLE_DEVICES 时，进程内的设备序号按可见列表重新编号
+            devices.append(f"cuda:{index if visible is None else visible.index(index)}")
+    return devices
+
+
+def read_control_file(path):
+    """读取并消费控制文件，每行一条命令：add <设备> / drain [worker_id]"""
+    if not path or not os.path.exists(path):
+        return []
+    consumed = path + ".consumed"
+    try:
+        os.replace(path, consumed)
+        with open(consumed, 'r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        os.remove(consumed)
+    except OSError as e:
+        logger.warning(f"读取控制文件失败: {e}")
+        return []
+
+    commands = []
+    for line in lines:
+        parts = line.split()
+        if not parts or parts[0].startswith("#"):
+            continue
+        if parts[0] in ("add", "drain"):
+            commands.append((parts[0], parts[1] if len(parts) > 1 else None))
+        else:
+            logger.warning(f"无法识别的控制命令: {line}")
+    return commands
+
+
+class PoolSegments:
+    """按工作进程数分段统计吞吐：每次池大小变化开始新的一段"""
+
+    def __init__(self):
+        self.segments = []
+
+    def update(self, pool_size, processed, now=None):
+        now = time.time() if now is None else now
+        if self.segments and self.segments[-1]['workers'] == pool_size:
+            return
+        if self.segments:
+            self.close(processed, now)
+        self.segments.append({'workers': pool_size, 'start': now, 'processed_start': processed})
+        logger.info(f"工作进程数: {pool_size}")
+
+    def close(self, processed, now=None):
+        segment = self.segments[-1]
+        segment['end'] = time.time() if now is None else now
+        segment['processed'] = processed - segment['processed_start']
+
+    def summary(self, processed):
+        if not self.segments:
+            return "池大小分段: 无"
+        self.close(processed)
+        lines = ["池大小分段吞吐:"]
+        for segment in self.segments:
+            seconds = segment['end'] - segment['start']
+            speed = segment['processed'] / seconds if seconds > 0 else 0.0
+            per_worker = speed / segment['workers'] if segment['workers'] else 0.0
+            lines.append(f"  {segment['workers']} 个工作进程: {seconds:.0f}s, {segment['processed']} 张, "
+                         f"{speed:.2f} 图片/秒 ({per_worker:.2f} 图片/秒/进程)")
+        return "\n".join(lines)
+
+
+class ElasticWorkerPool:
+    """运行中可增减的工作进程池
+
+    - 扩容：控制文件中的 `add <设备>`、SIGUSR1（在新空闲的GPU上加一个），或定期重新发现空闲GPU
+    - 缩容：控制文件中的 `drain [worker_id]` 或 SIGUSR2（默认最后加入的进程）；
+      被排空的进程处理完手上的批次、结果全部放入结果队列后退出，队列里的任务留给其他进程，不丢任务；
+      释放的GPU不会被自动发现重新占用，只有 `add <设备>` 或 SIGUSR1 能取回
+    worker_id 不复用，统计和放置表只追加。
+    """
+
+    def __init__(self, generator, worker_args, elastic=False, control_file=DEFAULT_CONTROL_FILE,
+                 rescan_interval=DEFAULT_RESCAN_INTERVAL, min_free_fraction=DEFAULT_MIN_FREE_FRACTION):
+        self.generator = generator
+        self.elastic = elastic  # 关闭时只是固定大小的进程组，不响应控制文件和信号
+        self.worker_args = worker_args
+        self.control_file = control_file
+        self.rescan_interval = rescan_interval
+        self.min_free_fraction = min_free_fraction
+
+        self.workers = {}  # worker_id -> {'process', 'drain_event', 'draining'}
+        self.released = set()  # 排空后让给其他任务的设备，自动发现时跳过，只能显式 add 取回
+        self.segments = PoolSegments()
+        self.pending_signals = []
+        self.last_rescan = time.time()
+        self.added = 0
+        self.drained = 0
+
+    def start(self):
+        for worker in self.generator.placement:
+            self.spawn(worker)
+        if not self.elastic:
+            return
+        # 信号处理只能在主线程注册
+        signal.signal(signal.SIGUSR1, lambda *_: self.pending_signals.append(('add', None, True)))
+        signal.signal(signal.SIGUSR2, lambda *_: self.pending_signals.append(('drain', None, False)))
+
+    def spawn(self, worker):
+        drain_event = Event()
+        process = Process(
+            target=self.generator.worker_process,
+            args=(worker['worker_id'], *self.worker_args, drain_event)
+        )
+        process.start()
+        self.workers[worker['worker_id']] = {'process': process, 'drain_event': drain_event, 'draining': False}
+
+    def active_ids(self):
+        return [worker_id for worker_id, entry in self.workers.items() if not entry['draining']]
+
+    def active_count(self):
+        return len(self.active_ids())
+
+    def alive_count(self):
+        return sum(1 for entry in self.workers.values() if entry['process'].is_alive())
+
+    def busy_devices(self):
+        return {self.generator.placement[worker_id]['device'] for worker_id in self.workers}
+
+    def free_cpu_cores(self, count):
+        used = set()
+        for worker_id in self.workers:
+            used.update(self.generator.placement[worker_id]['cores'] or [])
+        used.update(self.generator.reserved_cores or [])
+        # 主进程可能已经绑定到保留核心，按绑定前的全部核心分配
+        free = [core for core in self.generator.all_cores if core not in used]
+        return free[:count] if len(free) >= count else None
+
+    def normalize_device(self, device):
+        """把控制文件中的设备写法（"3"、"cuda:3"、"cpu"）统一成放置表中的设备名，不可见的设备返回 None"""
+        devices = parse_device_list(str(device), self.generator.device_type)
+        if len(devices) != 1:
+            logger.warning(f"无法识别的设备: {device}")
+            return None
+        device = devices[0]
+        if device == "cpu":
+            return device
+        # 与 discover_devices 相同的编号方式（按 CUDA_VISIBLE_DEVICES 重新编号），不要求空闲显存
+        visible = discover_devices(self.generator.device_type, min_free_fraction=0.0)
+        if device not in visible:
+            logger.warning(f"设备 {device} 不存在或不可见（可见设备: {visible or '无法查询'}），忽略扩容请求")
+            return None
+        return device
+
+    def add_worker(self, device=None, include_released=False):
+        """在指定设备（默认新发现的空闲GPU）上加一个工作进程；自动发现默认跳过已释放的设备"""
+        if device is not None:
+            device = self.normalize_device(device)
+            if device is None:
+                return None
+        else:
+            candidates = [d for d in discover_devices(self.generator.device_type, self.min_free_fraction)
+                          if d not in self.busy_devices() and (include_released or d not in self.released)]
+            if not candidates:
+                logger.info("没有新的空闲设备，忽略扩容请求")
+                return None
+            device = candidates[0]
+
+        cores = None
+        if device != "cpu" and self.generator.thread_budget:
+            # 线程预算：新的GPU工作进程按已有GPU进程的核心数分配空闲核心，不够时只限制线程数
+            sizes = [len(w['cores']) for w in self.generator.placement if w['cores'] and w['device'] != "cpu"]
+            cores = self.free_cpu_cores(sizes[0]) if sizes else None
+        if device == "cpu":
+            cpu_workers = [w for w in self.generator.placement if w['cores']]
+            threads = self.generator.cpu_threads_per_worker or (len(cpu_workers[0]['cores']) if cpu_workers else 1)
+            cores = self.free_cpu_cores(threads)
+            if cores is None:
+                logger.warning(f"没有 {threads} 个空闲CPU核心，忽略扩容请求")
+                return None
+
+        worker = {
+            'worker_id': len(self.generator.placement),
+            'device': device,
+            'replica': sum(1 for worker_id in self.workers if self.generator.placement[worker_id]['device'] == device),
+            'memory_fraction': None,
+            'cores': cores
+        }
+        if self.generator.thread_budget:
+            worker['threads'] = make_thread_budget(len(cores) if cores else 1, self.generator.intra_op_threads,
+                                                   self.generator.inter_op_threads)
+        self.released.discard(device)
+        self.generator.placement.append(worker)
+        self.generator.init_worker_stats(worker)
+        self.spawn(worker)
+        self.added += 1
+        logger.info(f"扩容: Worker {worker['worker_id']} -> {device}")
+        return worker['worker_id']
+
+    def drain_worker(self, worker_id=None):
+        """请求工作进程处理完当前批次后退出"""
+        active = self.active_ids()
+        if worker_id is None:
+            if not active:
+                return None
+            worker_id = active[-1]
+        if worker_id not in active:
+            logger.warning(f"Worker {worker_id} 不存在或已在排空")
+            return None
+        if len(active) == 1:
+            logger.warning("只剩一个工作进程，拒绝排空")
+            return None
+
+        entry = self.workers[worker_id]
+        entry['drain_event'].set()
+        entry['draining'] = True
+        logger.info(f"排空 Worker {worker_id} ({self.generator.placement[worker_id]['device']})")
+        return worker_id
+
+    def poll(self, processed):
+        """在收集循环中定期调用：处理扩缩容请求、回收已退出的进程、更新分段统计"""
+        commands = []
+        if self.elastic:
+            # 信号和控制文件都是显式请求，可以取回已释放的设备；自动发现不行
+            requested = [(command, arg, True) for command, arg in read_control_file(self.control_file)]
+            commands = self.pending_signals + requested
+            self.pending_signals = []
+        for command, arg, explicit in commands:
+            if command == 'add':
+                self.add_worker(arg, include_released=explicit)
+            else:
+                self.drain_worker(int(arg) if arg is not None else None)
+
+        if self.elastic and self.rescan_interval and self.generator.device_type != "cpu" \
+                and time.time() - self.last_rescan >= self.rescan_interval:
+            self.last_rescan = time.time()
+            self.add_worker()
+
+        for worker_id, entry in list(self.workers.items()):
+            if entry['process'].is_alive():
+                continue
+            entry['process'].join()
+            del self.workers[worker_id]
+            if entry['draining']:
+                self.drained += 1
+                device = self.generator.placement[worker_id]['device']
+                if device != "cpu" and device not in self.busy_devices():
+                    self.released.add(device)
+                logger.info(f"Worker {worker_id} 已排空并释放 {self.generator.placement[worker_id]['device']}")
+            else:
+                logger.warning(f"Worker {worker_id} 意外退出 (exitcode {entry['process'].exitcode})")
+
+        self.segments.update(self.active_count(), processed)
+
+    def join(self, timeout=10):
+        for entry in self.workers.values():
+            entry['process'].join(timeout=timeout)
+            if entry['process'].is_alive():
+                entry['process'].terminate()
+                entry['process'].join()
+
+    def summary(self, processed):
+        return f"弹性池: 扩容 {self.added} 次, 排空 {self.drained} 次\n" + self.segments.summary(processed)
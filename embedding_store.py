@@ -0,0 +1,197 @@
+import json
+import logging
+import os
+
+from lazy_imports import lazy_import
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EMBEDDING_DIR = "./image_embeddings"
+# 每个分片预分配的行数；分片是 float16 的原始数组文件，可以直接内存映射
+DEFAULT_SHARD_ROWS = 65536
+
+META_FILE = "meta.json"
+IDS_FILE = "ids.txt"
+
+
+def shard_file_name(index):
+    return f"embeddings_{index:05d}.f16"
+
+
+class VisionFeatureCapture:
+    """在 generate 期间截获视觉连接器（perceiver）的输出，不额外运行视觉编码器
+
+    idefics2 只在预填充时计算一次图片特征，之后的解码步复用，因此每次 generate 只取第一次输出。
+    """
+
+    def __init__(self, model):
+        inner = getattr(model, "model", model)
+        self.module = getattr(inner, "connector", None)
+        self.handle = None
+        self.features = None
+
+    def hook(self, module, inputs, output):
+        if self.features is None:
+            self.features = output.detach()
+
+    def __enter__(self):
+        self.features = None
+        if self.module is None:
+            logger.warning("模型没有视觉连接器，无法导出图片特征")
+        else:
+            self.handle = self.module.register_forward_hook(self.hook)
+        return self
+
+    def __exit__(self, *exc):
+        if self.handle is not None:
+            self.handle.remove()
+            self.handle = None
+        return False
+
+
+def pool_features(features, num_images):
+    """把每张图片全部子图的视觉 token 平均成一个向量，返回 float16 的 numpy 数组列表"""
+    if features is None:
+        return [None] * num_images
+    pooled = features.float().reshape(num_images, -1, features.shape[-1]).mean(dim=1)
+    return list(pooled.half().cpu().numpy())
+
+
+class EmbeddingStore:
+    """追加写入的图片特征库：float16 内存映射分片 + 按写入顺序排列的 id 列表
+
+    目录结构：meta.json（维度、各分片行数）、ids.txt（每行一个 id）、embeddings_XXXXX.f16。
+    flush 时才更新 meta.json，崩溃后多出的 id 和行会在下次打开时截掉；已存在的 id 不重复写入。
+    """
+
+    def __init__(self, output_dir=DEFAULT_EMBEDDING_DIR, shard_rows=DEFAULT_SHARD_ROWS):
+        self.output_dir = output_dir
+        self.shard_rows = shard_rows
+        os.makedirs(output_dir, exist_ok=True)
+
+        meta = load_meta(output_dir)
+        self.dim = meta['dim']
+        self.shard_counts = meta['shards']
+        self.ids = load_ids(output_dir, sum(self.shard_counts))
+        self.known = set(self.ids)
+        self.unflushed_ids = []
+        self.shard = None
+        # 截掉上次崩溃时未记录在 meta 中的 id
+        with open(os.path.join(output_dir, IDS_FILE), 'w', encoding='utf-8') as f:
+            f.writelines(f"{item}\n" for item in self.ids)
+
+    def open_shard(self, index):
+        np = lazy_import("numpy")
+        path = os.path.join(self.output_dir, shard_file_name(index))
+        mode = 'r+' if os.path.exists(path) else 'w+'
+        self.shard = np.memmap(path, dtype=np.float16, mode=mode, shape=(self.shard_rows, self.dim))
+
+    def add(self, item_id, vector):
+        """追加一条特征，id 已存在时忽略；返回是否写入"""
+        if vector is None or item_id in self.known:
+            return False
+        if self.dim is None:
+            self.dim = int(vector.shape[-1])
+        if not self.shard_counts or self.shard_counts[-1] >= self.shard_rows:
+            self.shard_counts.append(0)
+            self.shard = None
+        if self.shard is None:
+            self.open_shard(len(self.shard_counts) - 1)
+
+        self.shard[self.shard_counts[-1]] = vector
+        self.shard_counts[-1] += 1
+        self.ids.append(item_id)
+        self.known.add(item_id)
+        self.unflushed_ids.append(item_id)
+        return True
+
+    def flush(self):
+        if not self.unflushed_ids:
+            return
+        if self.shard is not None:
+            self.shard.flush()
+        with open(os.path.join(self.output_dir, IDS_FILE), 'a', encoding='utf-8') as f:
+            f.writelines(f"{item}\n" for item in self.unflushed_ids)
+        self.unflushed_ids = []
+        save_meta(self.output_dir, {'dim': self.dim, 'shard_rows': self.shard_rows, 'shards': self.shard_counts})
+
+    def close(self):
+        self.flush()
+        self.shard = None
+        logger.info(f"图片特征库 {self.output_dir}: {len(self.ids)} 条, 维度 {self.dim}, {len(self.shard_counts)} 个分片")
+
+
+def load_meta(output_dir):
+    path = os.path.join(output_dir, META_FILE)
+    if not os.path.exists(path):
+        return {'dim': None, 'shard_rows': DEFAULT_SHARD_ROWS, 'shards': []}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_meta(output_dir, meta):
+    path = os.path.join(output_dir, META_FILE)
+    with open(path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(path + ".tmp", path)
+
+
+def load_ids(output_dir, count):
+    path = os.path.join(output_dir, IDS_FILE)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        ids = f.read().splitlines()
+    return ids[:count]
+
+
+class EmbeddingIndex:
+    """只读的最近邻查询：分片按需内存映射，逐分片计算余弦相似度，不把整个特征库读入内存"""
+
+    def __init__(self, output_dir=DEFAULT_EMBEDDING_DIR):
+        np = lazy_import("numpy")
+        meta = load_meta(output_dir)
+        if meta['dim'] is None:
+            raise ValueError(f"{output_dir} 中没有图片特征")
+        self.dim = meta['dim']
+        self.ids = load_ids(output_dir, sum(meta['shards']))
+        self.rows = {item_id: row for row, item_id in enumerate(self.ids)}
+        self.shards = [
+            np.memmap(os.path.join(output_dir, shard_file_name(index)), dtype=np.float16, mode='r',
+                      shape=(meta['shard_rows'], self.dim))[:count]
+            for index, count in enumerate(meta['shards'])
+        ]
+        self.shard_rows = meta['shard_rows']
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, item_id):
+        row = self.rows[item_id]
+        return self.shards[row // self.shard_rows][row % self.shard_rows]
+
+    def nearest(self, query, k=10, chunk_rows=65536):
+        """返回与查询向量余弦相似度最高的 k 条 [(id, 相似度)]"""
+        np = lazy_import("numpy")
+        query = np.asarray(query, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+
+        scores = []
+        for shard in self.shards:
+            for start in range(0, len(shard), chunk_rows):
+                block = np.asarray(shard[start:start + chunk_rows], dtype=np.float32)
+                norms = np.linalg.norm(block, axis=1)
+                norms[norms == 0] = 1.0
+                scores.append(block @ query / norms)
+        if not scores:
+            return []
+
+        scores = np.concatenate(scores)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[row], float(scores[row])) for row in top]
+
+    def nearest_to_id(self, item_id, k=10):
+        """以库中某张图片为查询，结果不包含它自己"""
+        return [(other, score) for other, score in self.nearest(self.get(item_id), k + 1) if other != item_id][:k]
@@ -0,0 +1,140 @@
+import logging
+import threading
+import time
+from queue import Full
+
+from lazy_imports import lazy_import
+
+logger = logging.getLogger(__name__)
+
+# 每个工作进程预取的批次数；结果队列按图片计
+TASK_PREFETCH_PER_WORKER = 2
+RESULT_QUEUE_PER_WORKER = 64
+PROGRESS_QUEUE_SIZE = 1000
+# 主机内存超过该比例时暂停派发新批次
+DEFAULT_MAX_MEMORY_PERCENT = 85
+
+
+def host_memory_percent():
+    psutil = lazy_import("psutil")
+    return psutil.virtual_memory().percent
+
+
+def put_progress(progress_queue, count):
+    """进度只是提示信息，队列满时直接丢弃，不阻塞工作进程"""
+    try:
+        progress_queue.put_nowait(count)
+        return True
+    except Full:
+        return False
+
+
+class TaskFeeder:
+    """派发线程：按队列容量和主机内存逐个放入批次，队列满时阻塞而不是一次性预加载
+
+    sentinels 为派发完全部批次后追加的结束信号数量（为 0 时由调用方自行发送）。
+    """
+
+    def __init__(self, task_queue, batches, sentinels=0, max_memory_percent=DEFAULT_MAX_MEMORY_PERCENT,
+                 poll_interval=0.5, on_feed=None):
+        self.task_queue = task_queue
+        self.batches = batches
+        self.sentinels = sentinels
+        self.max_memory_percent = max_memory_percent
+        self.poll_interval = poll_interval
+        self.on_feed = on_feed  # 放入队列前对批次的回调
+
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.fed = 0
+        self.blocked_seconds = 0.0
+        self.memory_paused_seconds = 0.0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def put(self, item):
+        """阻塞放入，期间可以被 stop 打断；返回是否放入了队列"""
+        start = time.time()
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    self.task_queue.put(item, timeout=self.poll_interval)
+                    return True
+                except Full:
+                    continue
+            return False
+        finally:
+            self.blocked_seconds += time.time() - start
+
+    def loop(self):
+        for batch in self.batches:
+            # 主机内存紧张时先暂停派发，等结果被写出、内存回落
+            paused_at = None
+            while (self.max_memory_percent and not self.stop_event.is_set()
+                   and host_memory_percent() > self.max_memory_percent):
+                if paused_at is None:
+                    paused_at = time.time()
+                    logger.warning(f"主机内存超过 {self.max_memory_percent}%，暂停派发新批次")
+                self.stop_event.wait(self.poll_interval)
+            if paused_at is not None:
+                self.memory_paused_seconds += time.time() - paused_at
+
+            if self.stop_event.is_set():
+                return
+            if self.on_feed is not None:
+                self.on_feed(batch)
+            if not self.put(batch):
+                return
+            self.fed += 1
+
+        for _ in range(self.sentinels):
+            if not self.put(None):
+                return
+
+    def summary(self):
+        return (f"派发: {self.fed}/{len(self.batches)} 个批次, 任务队列满等待 {self.blocked_seconds:.1f}s, "
+                f"内存紧张暂停 {self.memory_paused_seconds:.1f}s")
+
+
+class QueueOccupancy:
+    """各阶段队列占用率统计：{阶段名: (队列, 容量)}"""
+
+    def __init__(self, queues):
+        self.queues = queues
+        self.peak = {name: 0 for name in queues}
+        self.total = {name: 0 for name in queues}
+        self.samples = 0
+
+    def sample(self):
+        self.samples += 1
+        for name, (q, _) in self.queues.items():
+            try:
+                depth = q.qsize()
+            except NotImplementedError:
+                continue
+            self.peak[name] = max(self.peak[name], depth)
+            self.total[name] += depth
+
+    def current(self):
+        """简短的当前占用，用于进度条"""
+        parts = []
+        for name, (q, capacity) in self.queues.items():
+            try:
+                parts.append(f"{name}:{q.qsize()}/{capacity}")
+            except NotImplementedError:
+                pass
+        return " ".join(parts)
+
+    def summary(self):
+        if not self.samples:
+            return "队列占用: 无样本"
+        parts = [
+            f"{name} 平均 {self.total[name] / self.samples / capacity:.0%} 峰值 {self.peak[name]}/{capacity}"
+            for name, (_, capacity) in self.queues.items()
+        ]
+        return "队列占用: " + ", ".join(parts)
@@ -0,0 +1,163 @@
+import gc
+import json
+import logging
+import os
+import re
+import time
+
+from lazy_imports import lazy_import
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SAMPLE_PATH = "golden_sample.json"
+
+# 提示词要求描述不要以这些说法开头
+BANNED_PREFIXES = ("the image is", "the photo is", "i can see", "this image", "the image shows", "this is an image")
+
+
+def save_sample(tasks, path=DEFAULT_SAMPLE_PATH):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(tasks, f, ensure_ascii=False, indent=2)
+
+
+def load_sample(path=DEFAULT_SAMPLE_PATH):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def parse_config(value):
+    """解析配置：JSON 文件路径，或 "batch_size=8,max_image_size=768" 形式的键值对"""
+    if value is None or value == "":
+        return {}
+    if os.path.exists(value):
+        with open(value, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    config = {}
+    for item in value.split(","):
+        key, _, raw = item.partition("=")
+        try:
+            config[key.strip()] = json.loads(raw)
+        except ValueError:
+            config[key.strip()] = raw.strip()
+    return config
+
+
+def normalize_caption(text):
+    return re.sub(r"[^\w\s]", "", text.lower()).split()
+
+
+def has_banned_prefix(text):
+    return text.strip().lower().startswith(BANNED_PREFIXES)
+
+
+def run_config(config, sample_tasks, device="cuda:0", model_name="HuggingFaceM4/idefics2-8b", warmup_batches=1):
+    """用一组配置跑完整个样本，返回吞吐和每张图片的描述"""
+    torch = lazy_import("torch")
+    from advanced_multi_gpu_caption import AdvancedMultiGPUCaptionGenerator
+    from assisted_decoding import AssistedDecoder
+
+    kwargs = {'num_gpus': 1, 'model_name': model_name, 'device_type': "cpu" if device == "cpu" else "cuda"}
+    kwargs.update(config)
+    generator = AdvancedMultiGPUCaptionGenerator(**kwargs)
+
+    model, processor = generator.load_model(device)
+    if generator.draft_model_name:
+        generator.assistant = AssistedDecoder(generator.draft_model_name, model, processor, device)
+    if generator.compile_mode:
+        generator.compile_worker_model(0, model, processor, device)
+
+    batches = generator.create_batches(sample_tasks)
+    for batch in batches[:warmup_batches]:
+        generator.process_batch_advanced(batch, model, processor, device, 0)
+
+    captions = {}
+    start = time.perf_counter()
+    for batch in batches:
+        for result in generator.process_batch_advanced(batch, model, processor, device, 0):
+            captions[result['image_path']] = result['caption'] if result['success'] else None
+    if device.startswith("cuda"):
+        torch.cuda.synchronize(device)
+    elapsed = time.perf_counter() - start
+
+    del model, processor
+    gc.collect()
+    if device.startswith("cuda"):
+        torch.cuda.empty_cache()
+
+    return {
+        'config': config,
+        'images': len(captions),
+        'failed': sum(1 for caption in captions.values() if caption is None),
+        'seconds': elapsed,
+        'images_per_sec': len(captions) / elapsed if elapsed > 0 else 0.0,
+        'captions': captions,
+    }
+
+
+def length_distribution(captions):
+    lengths = sorted(len(caption.split()) for caption in captions)
+    if not lengths:
+        return {'mean': 0.0, 'p50': 0, 'p90': 0, 'max': 0}
+    return {
+        'mean': sum(lengths) / len(lengths),
+        'p50': lengths[len(lengths) // 2],
+        'p90': lengths[min(len(lengths) - 1, int(len(lengths) * 0.9))],
+        'max': lengths[-1],
+    }
+
+
+def compare_runs(baseline, candidate, max_diffs=20):
+    """对比两次运行：吞吐差异与描述差异并列"""
+    common = [path for path, caption in baseline['captions'].items()
+              if caption is not None and candidate['captions'].get(path) is not None]
+
+    exact = 0
+    normalized = 0
+    diffs = []
+    for path in common:
+        a, b = baseline['captions'][path], candidate['captions'][path]
+        if a.strip() == b.strip():
+            exact += 1
+        elif normalize_caption(a) == normalize_caption(b):
+            normalized += 1
+        elif len(diffs) < max_diffs:
+            diffs.append({'image_path': path, 'baseline': a, 'candidate': b})
+
+    report = {'compared': len(common), 'diffs': diffs}
+    for name, run in (('baseline', baseline), ('candidate', candidate)):
+        succeeded = [caption for caption in run['captions'].values() if caption is not None]
+        report[name] = {
+            'config': run['config'],
+            'images_per_sec': run['images_per_sec'],
+            'failed': run['failed'],
+            'length_words': length_distribution(succeeded),
+            'banned_prefix': sum(1 for caption in succeeded if has_banned_prefix(caption)),
+        }
+
+    report['throughput_delta'] = (candidate['images_per_sec'] / baseline['images_per_sec'] - 1
+                                  if baseline['images_per_sec'] > 0 else None)
+    report['exact_match_rate'] = exact / len(common) if common else None
+    report['normalized_match_rate'] = (exact + normalized) / len(common) if common else None
+    return report
+
+
+def format_report(report, show_diffs=5):
+    lines = []
+    for name in ('baseline', 'candidate'):
+        side = report[name]
+        lengths = side['length_words']
+        lines.append(f"{name:>9}: {side['images_per_sec']:.2f} 图片/秒, 失败 {side['failed']}, "
+                     f"词数 平均 {lengths['mean']:.1f} / p50 {lengths['p50']} / p90 {lengths['p90']} / "
+                     f"最大 {lengths['max']}, 违规开头 {side['banned_prefix']}  {side['config']}")
+
+    delta = report['throughput_delta']
+    lines.append(f"吞吐变化: {delta:+.1%}" if delta is not None else "吞吐变化: 无法计算")
+    if report['compared']:
+        lines.append(f"描述对比 {report['compared']} 张: 完全一致 {report['exact_match_rate']:.1%}, "
+                     f"忽略大小写和标点后一致 {report['normalized_match_rate']:.1%}")
+    for diff in report['diffs'][:show_diffs]:
+        lines.append(f"  {diff['image_path']}")
+        lines.append(f"    - {diff['baseline']}")
+        lines.append(f"    + {diff['candidate']}")
+    return "\n".join(lines)
@@ -0,0 +1,250 @@
+import io
+import json
+import logging
+import os
+import struct
+import tarfile
+import time
+import zipfile
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_IMAGE_ROOT = "/root/dataset/raw"
+DEFAULT_SHARD_SIZE_MB = 1024
+INDEX_FILE_NAME = "index.json"
+
+# zip 本地文件头：固定 30 字节，之后是文件名和扩展字段
+ZIP_LOCAL_HEADER = struct.Struct("<4s5H3I2H")
+
+
+class DirectorySource:
+    """默认输入：图片以独立文件存放在 root 目录下"""
+
+    def __init__(self, root=DEFAULT_IMAGE_ROOT):
+        self.root = root
+
+    def describe(self):
+        return f"目录 {self.root}"
+
+    def full_path(self, image_path):
+        return f"{self.root}/{image_path}"
+
+    def exists(self, image_path):
+        return os.path.exists(self.full_path(image_path))
+
+    def open(self, image_path):
+        return open(self.full_path(image_path), 'rb')
+
+    def stat_key(self, image_path):
+        """文件变化的判断依据（坏图缓存用），不存在时返回 None"""
+        try:
+            return os.stat(self.full_path(image_path)).st_mtime
+        except OSError:
+            return None
+
+    def locate(self, image_path):
+        """(分片序号, 分片内偏移)；目录输入没有分片"""
+        return None
+
+
+class ArchiveSource:
+    """从 tar / zip 分片读取图片：按索引（成员 -> 分片, 偏移, 长度）直接 seek 读取，不逐个打开小文件
+
+    分片内成员必须未压缩存储（图片本身已压缩），这样每张图片都是分片中连续的一段字节。
+    索引在每个进程里按需加载，分片文件句柄按进程缓存，spawn 时只传递索引路径。
+    """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.shards = None
+        self.members = None
+        self.handles = {}
+
+    def __getstate__(self):
+        return {'index_path': self.index_path}
+
+    def __setstate__(self, state):
+        self.__init__(state['index_path'])
+
+    def load(self):
+        if self.members is None:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            # 分片路径相对索引文件所在目录
+            base = os.path.dirname(os.path.abspath(self.index_path))
+            self.shards = [os.path.join(base, shard) for shard in index['shards']]
+            self.members = index['members']
+        return self.members
+
+    def describe(self):
+        members = self.load()
+        return f"归档 {self.index_path} ({len(self.shards)} 个分片, {len(members)} 张图片)"
+
+    def exists(self, image_path):
+        return image_path in self.load()
+
+    def read(self, image_path):
+        shard, offset, size = self.load()[image_path]
+        handle = self.handles.get(shard)
+        if handle is None:
+            handle = self.handles[shard] = open(self.shards[shard], 'rb')
+        handle.seek(offset)
+        return handle.read(size)
+
+    def open(self, image_path):
+        if image_path not in self.load():
+            raise FileNotFoundError(image_path)
+        return io.BytesIO(self.read(image_path))
+
+    def stat_key(self, image_path):
+        entry = self.load().get(image_path)
+        if entry is None:
+            return None
+        # 分片重新打包后偏移会变化，连同分片 mtime 一起作为判断依据
+        return f"{os.stat(self.shards[entry[0]]).st_mtime}:{entry[1]}"
+
+    def locate(self, image_path):
+        entry = self.load().get(image_path)
+        return None if entry is None else (entry[0], entry[1])
+
+    def close(self):
+        for handle in self.handles.values():
+            handle.close()
+        self.handles = {}
+
+
+def open_image_source(spec=DEFAULT_IMAGE_ROOT):
+    """按参数选择输入后端：归档索引文件（.json）或图片目录"""
+    if spec.endswith(".json"):
+        return ArchiveSource(spec)
+    return DirectorySource(spec)
+
+
+def tar_members(shard_path):
+    with tarfile.open(shard_path, 'r:') as tar:
+        for info in tar:
+            if info.isfile():
+                yield info.name, info.offset_data, info.size
+
+
+def zip_members(shard_path):
+    with zipfile.ZipFile(shard_path) as archive, open(shard_path, 'rb') as f:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"{shard_path}: {info.filename} 不是未压缩存储，无法按偏移直接读取")
+            f.seek(info.header_offset)
+            header = ZIP_LOCAL_HEADER.unpack(f.read(ZIP_LOCAL_HEADER.size))
+            name_length, extra_length = header[-2], header[-1]
+            yield info.filename, info.header_offset + ZIP_LOCAL_HEADER.size + name_length + extra_length, info.file_size
+
+
+def build_archive_index(shard_paths, index_path):
+    """扫描已有的 tar / zip 分片，写出 成员 -> [分片序号, 数据偏移, 长度] 索引"""
+    base = os.path.dirname(os.path.abspath(index_path))
+    members = {}
+    for shard, shard_path in enumerate(shard_paths):
+        reader = zip_members if shard_path.endswith(".zip") else tar_members
+        for name, offset, size in reader(shard_path):
+            if name in members:
+                logger.warning(f"重复的成员 {name}，保留第一个分片中的版本")
+                continue
+            members[name] = [shard, offset, size]
+
+    index = {
+        'shards': [os.path.relpath(os.path.abspath(path), base) for path in shard_paths],
+        'members': members,
+    }
+    with open(index_path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(index_path + ".tmp", index_path)
+    logger.info(f"索引已写入 {index_path}: {len(shard_paths)} 个分片, {len(members)} 张图片")
+    return index
+
+
+def list_images(root):
+    """按目录顺序列出 root 下的全部文件（相对路径），同一目录的图片在分片中相邻"""
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            paths.append(os.path.relpath(os.path.join(dirpath, filename), root))
+    return paths
+
+
+def pack_directory(root, output_dir, image_paths=None, shard_size_mb=DEFAULT_SHARD_SIZE_MB, archive_format="tar"):
+    """把图片目录打包成若干 tar / zip 分片并建立索引，返回索引路径
+
+    image_paths 决定成员顺序（例如按模板顺序），默认按目录顺序打包 root 下的全部文件。
+    """
+    if image_paths is None:
+        image_paths = list_images(root)
+    os.makedirs(output_dir, exist_ok=True)
+
+    start = time.time()
+    shard_limit = shard_size_mb * 1024**2
+    shard_paths = []
+    archive = None
+    shard_bytes = 0
+    packed = 0
+    missing = 0
+
+    def close_shard():
+        if archive is not None:
+            archive.close()
+
+    for image_path in image_paths:
+        full_path = os.path.join(root, image_path)
+        if not os.path.isfile(full_path):
+            missing += 1
+            continue
+        size = os.path.getsize(full_path)
+
+        if archive is None or shard_bytes + size > shard_limit:
+            close_shard()
+            shard_path = os.path.join(output_dir, f"shard-{len(shard_paths):05d}.{archive_format}")
+            if archive_format == "zip":
+                archive = zipfile.ZipFile(shard_path, 'w', compression=zipfile.ZIP_STORED)
+            else:
+                archive = tarfile.open(shard_path, 'w:')
+            shard_paths.append(shard_path)
+            shard_bytes = 0
+
+        if archive_format == "zip":
+            archive.write(full_path, arcname=image_path)
+        else:
+            archive.add(full_path, arcname=image_path, recursive=False)
+        shard_bytes += size
+        packed += 1
+    close_shard()
+
+    index_path = os.path.join(output_dir, INDEX_FILE_NAME)
+    build_archive_index(shard_paths, index_path)
+    logger.info(f"打包完成: {packed} 张图片, {len(shard_paths)} 个分片, 缺失 {missing} 张, "
+                f"耗时 {time.time() - start:.1f}s")
+    return index_path
+
+
+def create_shard_local_batches(tasks, batch_size, source):
+    """按分片分组、分片内按偏移排序后切批：每个批次只读一个分片，且顺序读取
+
+    不在归档中的任务（通常是文件不存在）单独成批，交给工作进程的预检查报错。
+    """
+    by_shard = {}
+    unlocated = []
+    for task in tasks:
+        location = source.locate(task['image_path'])
+        if location is None:
+            unlocated.append(task)
+        else:
+            by_shard.setdefault(location[0], []).append((location[1], task))
+
+    batches = []
+    for shard in sorted(by_shard):
+        shard_tasks = [task for _, task in sorted(by_shard[shard], key=lambda item: item[0])]
+        for i in range(0, len(shard_tasks), batch_size):
+            batches.append(shard_tasks[i:i + batch_size])
+    for i in range(0, len(unlocated), batch_size):
+        batches.append(unlocated[i:i + batch_size])
+    return batches
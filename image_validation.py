@@ -0,0 +1,146 @@
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from image_sources import DirectorySource
+from lazy_imports import lazy_import
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_NEGATIVE_CACHE_PATH = "bad_images.json"
+DEFAULT_VALIDATION_REPORT_PATH = "bad_images_report.json"
+
+# 与工作进程预检查一致的可处理图片模式
+SUPPORTED_MODES = ('RGB', 'RGBA', 'L')
+
+
+def check_image_header(full_path):
+    """只读取图片头部检查能否打开以及图片模式，返回错误信息，正常时返回 None（也接受文件对象）"""
+    Image = lazy_import("PIL.Image")
+    try:
+        with Image.open(full_path) as img:
+            if img.mode not in SUPPORTED_MODES:
+                return f"不支持的图片格式 {img.mode}"
+    except Exception as e:
+        return f"图片格式错误 - {e}"
+    return None
+
+
+# 检查进程中的输入后端：每个进程在初始化时接收一次，之后只传递图片路径
+_worker_source = None
+
+
+def init_check_worker(source):
+    global _worker_source
+    _worker_source = source
+
+
+def check_source_image(image_path, source=None):
+    source = source or _worker_source
+    try:
+        f = source.open(image_path)
+    except Exception as e:
+        return f"图片格式错误 - {e}"
+    with f:
+        return check_image_header(f)
+
+
+def load_negative_cache(path=DEFAULT_NEGATIVE_CACHE_PATH):
+    """读取坏图缓存 {image_path: {'mtime': ..., 'error': ...}}"""
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        logger.warning(f"读取坏图缓存失败，将重新检查: {e}")
+        return {}
+
+
+def save_negative_cache(cache, path=DEFAULT_NEGATIVE_CACHE_PATH):
+    with open(path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(cache, f, ensure_ascii=False, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def validate_tasks(tasks, image_source=None, num_workers=None,
+                   cache_path=DEFAULT_NEGATIVE_CACHE_PATH):
+    """派发前在CPU进程池中并行检查图片头部
+
+    image_source 为输入后端（默认图片目录）；坏图按 路径 + mtime 记录在持久缓存中，文件没有变化时下次运行直接跳过，不再打开。
+    返回 (有效任务列表, 坏图列表)，有效任务带 'validated' 标记，工作进程据此跳过预检查。
+    """
+    start = time.time()
+    cache = load_negative_cache(cache_path)
+    if image_source is None:
+        image_source = DirectorySource()
+
+    valid_tasks = []
+    bad_images = []
+    to_check = []
+    cache_hits = 0
+
+    for task in tasks:
+        image_path = task['image_path']
+        mtime = image_source.stat_key(image_path)
+
+        cached = cache.get(image_path)
+        if cached is not None and cached['mtime'] == mtime:
+            bad_images.append({'task': task, 'error': cached['error'], 'cached': True})
+            cache_hits += 1
+        elif mtime is None:
+            cache[image_path] = {'mtime': None, 'error': "文件不存在"}
+            bad_images.append({'task': task, 'error': "文件不存在", 'cached': False})
+        else:
+            cache.pop(image_path, None)
+            to_check.append((task, mtime))
+
+    if to_check:
+        paths = [task['image_path'] for task, _ in to_check]
+        # 输入后端（归档时包括整个索引）每个检查进程只加载一次，不随每个分块重复传递
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=init_check_worker,
+                                 initargs=(image_source,)) as pool:
+            errors = list(pool.map(check_source_image, paths, chunksize=256))
+
+        for (task, mtime), error in zip(to_check, errors):
+            if error is None:
+                valid_tasks.append(dict(task, validated=True))
+            else:
+                cache[task['image_path']] = {'mtime': mtime, 'error': error}
+                bad_images.append({'task': task, 'error': error, 'cached': False})
+
+    save_negative_cache(cache, cache_path)
+    logger.info(f"图片检查: {len(tasks)} 张, 打开检查 {len(to_check)} 张, 坏图 {len(bad_images)} 张 "
+                f"(缓存命中 {cache_hits}), 耗时 {time.time() - start:.1f}s")
+    return valid_tasks, bad_images
+
+
+def write_validation_report(bad_images, path=DEFAULT_VALIDATION_REPORT_PATH):
+    """写出坏图报告，按错误类型汇总"""
+    by_error = {}
+    for bad in bad_images:
+        error_type = bad['error'].split(" - ")[0]
+        by_error[error_type] = by_error.get(error_type, 0) + 1
+
+    report = {
+        'total': len(bad_images),
+        'by_error': by_error,
+        'images': [
+            {
+                'image_path': bad['task']['image_path'],
+                'json_name': bad['task'].get('json_name'),
+                'error': bad['error'],
+                'cached': bad['cached']
+            }
+            for bad in bad_images
+        ]
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    for error_type, count in sorted(by_error.items(), key=lambda item: -item[1]):
+        logger.info(f"  {error_type}: {count} 张")
+    logger.info(f"坏图报告已写入 {path}")
+    return report
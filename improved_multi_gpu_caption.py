@@ -1,28 +1,40 @@
 import json
 import os
-from datasets import load_dataset
 from tqdm import tqdm
 import multiprocessing as mp
 from multiprocessing import Queue, Process
-import torch
-from transformers import AutoProcessor, AutoModelForImageTextToText
-import qwen_vl_utils.vision_process
 from PIL import Image
 import time
 from queue import Empty
 import gc
+from lazy_imports import lazy_import, get_import_times, format_import_times
+from autotune import load_profile, apply_profile
+from caption_decoding import build_caption_stopping_criteria, decode_new_tokens, parse_group_captions
+from flow_control import PROGRESS_QUEUE_SIZE, RESULT_QUEUE_PER_WORKER, QueueOccupancy
+from preprocessing_profile import apply_preprocess_profile, load_preprocess_profile
 
-# 设置视觉处理参数
-qwen_vl_utils.vision_process.MIN_PIXELS = 28 * 28 * 8
-qwen_vl_utils.vision_process.MAX_PIXELS = 28 * 28 * 64
+def _import_heavy_modules():
+    """延迟导入 torch / transformers，只在真正需要模型的工作进程中调用"""
+    torch = lazy_import("torch")
+    transformers = lazy_import("transformers")
+    return torch, transformers
+
+CAPTION_INSTRUCTION = "describe the image briefly, within 30 words, output the description directly, do not start with 'the image is' or 'the photo is' or 'I can see' or anything that start with this image."
 
 class ImprovedMultiGPUCaptionGenerator:
-    def __init__(self, num_gpus=8, model_name="HuggingFaceM4/idefics2-8b"):
+    def __init__(self, num_gpus=8, model_name="HuggingFaceM4/idefics2-8b", max_new_tokens=64,
+                 group_size=1, canvas_context=False):
         self.num_gpus = num_gpus
         self.model_name = model_name
+        self.max_new_tokens = max_new_tokens
+        self.group_size = group_size  # 同一模板的多个元素合并到一个多图提示中，1 表示逐张生成
+        self.canvas_context = canvas_context  # 多图提示中附带画布的类别、标题和关键词
+        # 画布描述按模板只存一份，不再复制到该模板的每个任务中
+        self.canvas_descriptions = {}
         
     def get_caption(self, image_path, model, processor, device):
         """单张图片描述生成函数 - 基于原始代码"""
+        torch = lazy_import("torch")
         try:
             messages = [
                 {
@@ -31,7 +43,7 @@ class ImprovedMultiGPUCaptionGenerator:
                         {
                             "type": "image",
                         },
-                        {"type": "text", "text": "describe the image briefly, within 30 words, output the description directly, do not start with 'the image is' or 'the photo is' or 'I can see' or anything that start with this image."},
+                        {"type": "text", "text": CAPTION_INSTRUCTION},
                     ],
                 }
             ]
@@ -40,25 +52,84 @@ class ImprovedMultiGPUCaptionGenerator:
             
             prompt = processor.apply_chat_template(messages, add_generation_prompt=True)
             inputs = processor(text=prompt, images=images, return_tensors="pt").to(device)
+            prompt_length = inputs['input_ids'].shape[1]
 
             with torch.no_grad():
-                generated_ids = model.generate(**inputs, max_new_tokens=500)
-                generated_texts = processor.batch_decode(generated_ids, skip_special_tokens=True)
-                res = generated_texts[0]
-            
-            key = "Assistant: "
-            _index = res.rfind(key)
-            if _index != -1:
-                res = res[_index+len(key):]
+                # 超过30词或写完一句即停止，只解码新生成的部分
+                generated_ids = model.generate(
+                    **inputs,
+                    max_new_tokens=self.max_new_tokens,
+                    stopping_criteria=build_caption_stopping_criteria(processor.tokenizer, prompt_length)
+                )
+                captions, _ = decode_new_tokens(processor.tokenizer, generated_ids, prompt_length)
             
-            return res.strip()
+            return captions[0]
             
         except Exception as e:
             print(f"处理图片 {image_path} 时出错: {e}")
             return f"ERROR: {str(e)}"
 
+    def build_group_messages(self, group):
+        """多图提示：逐张编号，要求按 "Image k: 描述" 逐行输出"""
+        content = []
+        if self.canvas_context:
+            content.append({"type": "text", "text": f"These images are elements of one design canvas ({self.canvas_descriptions[group[0]['json_name']]})."})
+        for index in range(1, len(group) + 1):
+            content.append({"type": "text", "text": f"Image {index}:"})
+            content.append({"type": "image"})
+        content.append({"type": "text", "text": (
+            f"For each of the {len(group)} images above, {CAPTION_INSTRUCTION} "
+            f"Output exactly {len(group)} lines, one per image, in the form 'Image k: description'."
+        )})
+        return [{"role": "user", "content": content}]
+
+    def get_group_captions(self, group, model, processor, device):
+        """一次生成同一模板多个元素的描述，解析失败时返回 None"""
+        torch = lazy_import("torch")
+        images = [Image.open(f"/root/dataset/raw/{task['image_path']}").convert("RGB") for task in group]
+        prompt = processor.apply_chat_template(self.build_group_messages(group), add_generation_prompt=True)
+        inputs = processor(text=prompt, images=[images], return_tensors="pt").to(device)
+        prompt_length = inputs['input_ids'].shape[1]
+
+        with torch.no_grad():
+            # 每张图片一行，生成预算按元素数放大；不用单句停止条件
+            generated_ids = model.generate(**inputs, max_new_tokens=self.max_new_tokens * len(group))
+        text = processor.tokenizer.batch_decode(generated_ids[:, prompt_length:], skip_special_tokens=True)[0]
+        return parse_group_captions(text, len(group))
+
+    def group_tasks(self, tasks):
+        """把连续的同模板任务按 group_size 分组（prepare_tasks 按模板顺序生成任务）"""
+        groups = []
+        for task in tasks:
+            if (groups and len(groups[-1]) < self.group_size
+                    and groups[-1][0]['json_name'] == task['json_name']):
+                groups[-1].append(task)
+            else:
+                groups.append([task])
+        return groups
+
+    def caption_group(self, group, model, processor, device, stats):
+        """返回与 group 一一对应的描述；多图调用失败或解析失败时退回逐张生成"""
+        if len(group) > 1:
+            stats['generate_calls'] += 1
+            try:
+                captions = self.get_group_captions(group, model, processor, device)
+            except Exception as e:
+                print(f"多图提示出错 {group[0]['json_name']}: {e}")
+                captions = None
+            if captions is not None:
+                stats['grouped_images'] += len(group)
+                return captions
+            stats['fallback_groups'] += 1
+
+        stats['generate_calls'] += len(group)
+        return [self.get_caption(task['image_path'], model, processor, device) for task in group]
+
     def worker_process(self, gpu_id, tasks_chunk, result_queue, progress_queue):
         """每个GPU上的工作进程"""
+        torch, transformers = _import_heavy_modules()
+        print(f"GPU {gpu_id}: 依赖导入耗时: {format_import_times(get_import_times())}")
+        
         try:
             # 设置CUDA设备
             device = f"cuda:{gpu_id}"
@@ -67,57 +138,62 @@ class ImprovedMultiGPUCaptionGenerator:
             print(f"GPU {gpu_id}: 开始加载模型...")
             
             # 加载模型到指定GPU
-            model = AutoModelForImageTextToText.from_pretrained(
+            model = transformers.AutoModelForImageTextToText.from_pretrained(
                 self.model_name,
                 torch_dtype="auto", 
                 device_map=device
             ).to(device)
             
-            processor = AutoProcessor.from_pretrained(self.model_name)
+            processor = transformers.AutoProcessor.from_pretrained(self.model_name)
+            # 按模型的预处理配置设置切分和分辨率，控制每张图片的视觉 token 数
+            apply_preprocess_profile(processor, load_preprocess_profile(self.model_name))
             
             print(f"GPU {gpu_id}: 模型加载完成，开始处理 {len(tasks_chunk)} 个任务")
             
-            # 处理分配给这个GPU的所有任务
-            for task in tqdm(tasks_chunk, desc=f"GPU {gpu_id} 进度"):
-                try:
-                    image_path = task['image_path']
-                    output_path = task['output_path']
-                    
+            # 处理分配给这个GPU的所有任务；group_size > 1 时同模板元素合并成一次多图生成
+            stats = {'generate_calls': 0, 'grouped_images': 0, 'fallback_groups': 0}
+            with tqdm(total=len(tasks_chunk), desc=f"GPU {gpu_id} 进度") as worker_bar:
+                for group in self.group_tasks(tasks_chunk):
                     # 检查文件是否已经存在
-                    if os.path.exists(output_path):
-                        print(f"GPU {gpu_id}: 跳过已存在的文件 {image_path}")
-                        progress_queue.put(1)
+                    pending = []
+                    for task in group:
+                        if os.path.exists(task['output_path']):
+                            print(f"GPU {gpu_id}: 跳过已存在的文件 {task['image_path']}")
+                            progress_queue.put(1)
+                        else:
+                            pending.append(task)
+                    worker_bar.update(len(group) - len(pending))
+                    if not pending:
                         continue
                     
-                    # 生成描述
-                    caption = self.get_caption(image_path, model, processor, device)
+                    try:
+                        # 生成描述
+                        captions = self.caption_group(pending, model, processor, device, stats)
+                    except Exception as e:
+                        print(f"GPU {gpu_id}: 处理任务时出错 {pending[0]['image_path']}: {e}")
+                        captions = [f"ERROR: {str(e)}"] * len(pending)
                     
                     # 保存结果
-                    result_queue.put({
-                        'image_path': image_path,
-                        'output_path': output_path,
-                        'caption': caption,
-                        'success': not caption.startswith('ERROR:')
-                    })
-                    
-                    # 更新进度
-                    progress_queue.put(1)
+                    for task, caption in zip(pending, captions):
+                        result_queue.put({
+                            'image_path': task['image_path'],
+                            'output_path': task['output_path'],
+                            'caption': caption,
+                            'success': not caption.startswith('ERROR:')
+                        })
+                        
+                        # 更新进度
+                        progress_queue.put(1)
+                    worker_bar.update(len(pending))
                     
                     # 定期清理GPU内存
                     if len(tasks_chunk) % 10 == 0:
                         torch.cuda.empty_cache()
                         gc.collect()
-                    
-                except Exception as e:
-                    print(f"GPU {gpu_id}: 处理任务时出错 {task['image_path']}: {e}")
-                    result_queue.put({
-                        'image_path': task['image_path'],
-                        'output_path': task['output_path'],
-                        'caption': f"ERROR: {str(e)}",
-                        'success': False
-                    })
-                    progress_queue.put(1)
-                    
+            
+            print(f"GPU {gpu_id}: generate 调用 {stats['generate_calls']} 次, "
+                  f"多图合并 {stats['grouped_images']} 张, 解析失败退回逐张 {stats['fallback_groups']} 组")
+            
         except Exception as e:
             print(f"GPU {gpu_id}: 初始化失败: {e}")
         finally:
@@ -164,7 +240,8 @@ class ImprovedMultiGPUCaptionGenerator:
                 keywords = detail_json["keywords"]
                 keyword_results = ','.join(keywords)
                 
-                canvas_description = f"category: {category}; title: {title}; keywords: {keyword_results}"
+                if self.canvas_context:
+                    self.canvas_descriptions[name] = f"category: {category}; title: {title}; keywords: {keyword_results}"
                 
                 detail_imgs = detail_json["images"]
                 _images = _data["images"]
@@ -183,7 +260,6 @@ class ImprovedMultiGPUCaptionGenerator:
                                 'image_path': image_file,
                                 'output_path': output_path,
                                 'json_name': name,
-                                'canvas_description': canvas_description,
                                 'type': types[img_idx]
                             })
                 
@@ -236,9 +312,14 @@ class ImprovedMultiGPUCaptionGenerator:
         # 将任务分成8份
         task_chunks = self.split_tasks(all_tasks)
         
-        # 创建队列
-        result_queue = Queue()
-        progress_queue = Queue()
+        # 创建有界队列：收集进程写盘跟不上时，工作进程在 put 上阻塞，而不是让结果堆积在内存中
+        result_capacity = self.num_gpus * RESULT_QUEUE_PER_WORKER
+        result_queue = Queue(maxsize=result_capacity)
+        progress_queue = Queue(maxsize=PROGRESS_QUEUE_SIZE)
+        occupancy = QueueOccupancy({
+            'result': (result_queue, result_capacity),
+            'progress': (progress_queue, PROGRESS_QUEUE_SIZE),
+        })
         
         # 启动8个工作进程
         processes = []
@@ -258,75 +339,89 @@ class ImprovedMultiGPUCaptionGenerator:
         successful_count = 0
         failed_count = 0
         
+        def save_result(result):
+            nonlocal successful_count, failed_count
+            if result['success']:
+                with open(result['output_path'], "w", encoding='utf-8') as file:
+                    file.write(result['caption'])
+                successful_count += 1
+            else:
+                print(f"\n处理失败: {result['image_path']} - {result['caption']}")
+                failed_count += 1
+        
         print(f"\n开始处理 {total_images} 张图片...")
         start_time = time.time()
         
         with tqdm(total=total_images, desc="总体进度") as pbar:
-            # 收集结果
+            # 收集结果：阻塞等待结果，每轮把已到达的结果和进度全部取完
             while total_processed < total_images:
                 try:
-                    # 获取进度更新
-                    if not progress_queue.empty():
-                        progress_update = progress_queue.get_nowait()
+                    occupancy.sample()
+                    try:
+                        save_result(result_queue.get(timeout=0.1))
+                        while True:
+                            save_result(result_queue.get_nowait())
+                    except Empty:
+                        pass
+                    
+                    progress_update = 0
+                    try:
+                        while True:
+                            progress_update += progress_queue.get_nowait()
+                    except Empty:
+                        pass
+                    
+                    if progress_update:
                         total_processed += progress_update
                         pbar.update(progress_update)
                         
                         # 更新速度信息
-                        if total_processed > 0:
-                            elapsed = time.time() - start_time
-                            speed = total_processed / elapsed
-                            pbar.set_postfix({
-                                'speed': f'{speed:.2f} img/s',
-                                'GPUs': self.num_gpus
-                            })
-                    
-                    # 获取结果并保存
-                    if not result_queue.empty():
-                        result = result_queue.get_nowait()
-                        
-                        if result['success']:
-                            with open(result['output_path'], "w", encoding='utf-8') as file:
-                                file.write(result['caption'])
-                            successful_count += 1
-                        else:
-                            print(f"\n处理失败: {result['image_path']} - {result['caption']}")
-                            failed_count += 1
-                    
-                    time.sleep(0.1)  # 避免过度占用CPU
+                        elapsed = time.time() - start_time
+                        speed = total_processed / elapsed
+                        pbar.set_postfix({
+                            'speed': f'{speed:.2f} img/s',
+                            'GPUs': self.num_gpus,
+                            'queues': occupancy.current()
+                        })
                     
                 except Exception as e:
                     print(f"监控进度时出错: {e}")
                     time.sleep(1)
         
+        # 处理剩余的结果；先取完再 join，避免工作进程阻塞在有界队列上
+        while any(p.is_alive() for p in processes) or not result_queue.empty():
+            try:
+                save_result(result_queue.get(timeout=0.5))
+            except Empty:
+                continue
+        
         # 等待所有进程结束
         for p in processes:
             p.join()
         
-        # 处理剩余的结果
-        while not result_queue.empty():
-            try:
-                result = result_queue.get_nowait()
-                if result['success']:
-                    with open(result['output_path'], "w", encoding='utf-8') as file:
-                        file.write(result['caption'])
-                    successful_count += 1
-                else:
-                    failed_count += 1
-            except:
-                break
-        
         elapsed_time = time.time() - start_time
         print(f"\n处理完成!")
         print(f"总用时: {elapsed_time:.2f} 秒")
         print(f"成功处理: {successful_count} 张图片")
         print(f"处理失败: {failed_count} 张图片")
         print(f"平均速度: {total_processed / elapsed_time:.2f} 图片/秒")
+        print(occupancy.summary())
         print(f"GPU并行加速: {self.num_gpus}x")
 
 def main():
     # 配置参数
     NUM_GPUS = 8  # 使用8张GPU
     MODEL_NAME = "HuggingFaceM4/idefics2-8b"
+    MAX_NEW_TOKENS = 64  # 最大生成长度（30词以内的描述通常不超过50个token）
+    GROUP_SIZE = 1  # 每个多图提示包含的同模板元素数，1 表示逐张生成
+    CANVAS_CONTEXT = False  # 多图提示中是否附带画布描述
+    
+    # 如果存在自动调优结果，则覆盖上面的默认值
+    config = apply_profile({
+        'num_gpus': NUM_GPUS,
+        'max_new_tokens': MAX_NEW_TOKENS,
+    }, load_profile(), MODEL_NAME)
+    NUM_GPUS = config['num_gpus']
     
     print(f"配置信息:")
     print(f"- GPU数量: {NUM_GPUS}")
@@ -336,7 +431,10 @@ def main():
     # 创建并运行处理器
     generator = ImprovedMultiGPUCaptionGenerator(
         num_gpus=NUM_GPUS,
-        model_name=MODEL_NAME
+        model_name=MODEL_NAME,
+        max_new_tokens=config['max_new_tokens'],
+        group_size=GROUP_SIZE,
+        canvas_context=CANVAS_CONTEXT
     )
     
     generator.run()
@@ -0,0 +1,57 @@
+import importlib
+import subprocess
+import sys
+import time
+
+# 已导入模块的耗时记录（秒），只记录由 lazy_import 真正触发的导入
+_IMPORT_TIMES = {}
+
+# 生成脚本依赖的重量级模块
+HEAVY_MODULES = ["torch", "transformers", "PIL.Image", "psutil"]
+
+
+def lazy_import(name):
+    """按需导入模块，并记录首次导入的耗时"""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    _IMPORT_TIMES[name] = time.perf_counter() - start
+    return module
+
+
+def get_import_times():
+    """返回当前进程中各模块的导入耗时"""
+    return dict(_IMPORT_TIMES)
+
+
+def format_import_times(import_times):
+    """把导入耗时格式化为一行日志"""
+    if not import_times:
+        return "无"
+    return ", ".join(f"{name}: {seconds:.2f}s" for name, seconds in import_times.items())
+
+
+def measure_cold_import(name, timeout=300):
+    """在独立子进程中测量模块的冷启动导入耗时，不污染当前进程"""
+    code = (
+        "import time, importlib\n"
+        "start = time.perf_counter()\n"
+        f"importlib.import_module({name!r})\n"
+        "print(time.perf_counter() - start)\n"
+    )
+    try:
+        output = subprocess.run(
+            [sys.executable, "-c", code],
+            capture_output=True,
+            text=True,
+            timeout=timeout,
+        )
+    except subprocess.TimeoutExpired:
+        return None
+
+    if output.returncode != 0:
+        return None
+    return float(output.stdout.strip().splitlines()[-1])
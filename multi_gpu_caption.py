@@ -1,44 +1,56 @@
 import json
 import os
-from datasets import load_dataset
 from tqdm import tqdm
 import multiprocessing as mp
 from multiprocessing import Queue, Process
-import torch
-from transformers import AutoProcessor, AutoModelForImageTextToText
-import qwen_vl_utils.vision_process
 from PIL import Image
 import time
 from queue import Empty
 import gc
+from lazy_imports import lazy_import, get_import_times, format_import_times
+from autotune import load_profile, apply_profile
+from caption_decoding import build_caption_stopping_criteria, decode_new_tokens
+from flow_control import (DEFAULT_MAX_MEMORY_PERCENT, PROGRESS_QUEUE_SIZE, RESULT_QUEUE_PER_WORKER,
+                          TASK_PREFETCH_PER_WORKER, QueueOccupancy, TaskFeeder, put_progress)
+from preprocessing_profile import apply_preprocess_profile, load_preprocess_profile
 
-# 设置视觉处理参数
-qwen_vl_utils.vision_process.MIN_PIXELS = 28 * 28 * 8
-qwen_vl_utils.vision_process.MAX_PIXELS = 28 * 28 * 64
+def _import_heavy_modules():
+    """延迟导入 torch / transformers，只在真正需要模型的工作进程中调用"""
+    torch = lazy_import("torch")
+    transformers = lazy_import("transformers")
+    return torch, transformers
 
 class MultiGPUCaptionGenerator:
-    def __init__(self, num_gpus=8, batch_size=8, model_name="HuggingFaceM4/idefics2-8b"):
+    def __init__(self, num_gpus=8, batch_size=8, model_name="HuggingFaceM4/idefics2-8b", max_new_tokens=64,
+                 max_memory_percent=DEFAULT_MAX_MEMORY_PERCENT):
         self.num_gpus = num_gpus
         self.batch_size = batch_size
         self.model_name = model_name
+        self.max_new_tokens = max_new_tokens
+        self.max_memory_percent = max_memory_percent  # 主机内存超过该比例时暂停派发
         
     def worker_process(self, gpu_id, task_queue, result_queue, progress_queue):
         """每个GPU上的工作进程"""
         try:
+            torch, transformers = _import_heavy_modules()
+            print(f"GPU {gpu_id} 依赖导入耗时: {format_import_times(get_import_times())}")
+            
             # 设置CUDA设备
             torch.cuda.set_device(gpu_id)
             device = f"cuda:{gpu_id}"
             
             # 加载模型到指定GPU
             print(f"在GPU {gpu_id}上加载模型...")
-            model = AutoModelForImageTextToText.from_pretrained(
+            model = transformers.AutoModelForImageTextToText.from_pretrained(
                 self.model_name,
                 torch_dtype="auto",
                 device_map={"": device},
                 low_cpu_mem_usage=True
             )
             
-            processor = AutoProcessor.from_pretrained(self.model_name)
+            processor = transformers.AutoProcessor.from_pretrained(self.model_name)
+            # 按模型的预处理配置设置切分和分辨率，控制每张图片的视觉 token 数
+            apply_preprocess_profile(processor, load_preprocess_profile(self.model_name))
             
             print(f"GPU {gpu_id} 模型加载完成，开始处理任务")
             
@@ -56,8 +68,8 @@ class MultiGPUCaptionGenerator:
                     for result in batch_results:
                         result_queue.put(result)
                     
-                    # 更新进度
-                    progress_queue.put(len(batch_tasks))
+                    # 更新进度（队列满时丢弃，不阻塞）
+                    put_progress(progress_queue, len(batch_tasks))
                     
                     # 清理GPU内存
                     torch.cuda.empty_cache()
@@ -77,12 +89,13 @@ class MultiGPUCaptionGenerator:
     
     def process_batch(self, batch_tasks, model, processor, device):
         """批量处理图片"""
+        torch = lazy_import("torch")
         results = []
         
         try:
             # 准备批次数据
             images = []
-            image_paths = []
+            image_tasks = []
             
             for task in batch_tasks:
                 image_path = task['image_path']
@@ -91,11 +104,12 @@ class MultiGPUCaptionGenerator:
                 try:
                     image = Image.open(full_path).convert("RGB")
                     images.append(image)
-                    image_paths.append(image_path)
+                    image_tasks.append(task)
                 except Exception as e:
                     print(f"无法加载图片 {image_path}: {e}")
                     results.append({
                         'image_path': image_path,
+                        'output_path': task['output_path'],
                         'caption': f"ERROR: 无法加载图片 - {e}",
                         'success': False
                     })
@@ -115,7 +129,8 @@ class MultiGPUCaptionGenerator:
             ]
             
             # 批量处理
-            for i, (image, image_path) in enumerate(zip(images, image_paths)):
+            for i, (image, task) in enumerate(zip(images, image_tasks)):
+                image_path = task['image_path']
                 try:
                     prompt = processor.apply_chat_template(messages, add_generation_prompt=True)
                     inputs = processor(text=prompt, images=[image], return_tensors="pt")
@@ -123,31 +138,44 @@ class MultiGPUCaptionGenerator:
                     # 将输入移动到GPU
                     inputs = {k: v.to(device) if isinstance(v, torch.Tensor) else v for k, v in inputs.items()}
                     
-                    with torch.no_grad():
-                        generated_ids = model.generate(**inputs, max_new_tokens=500, do_sample=False)
-                        generated_texts = processor.batch_decode(generated_ids, skip_special_tokens=True)
+                    prompt_length = inputs['input_ids'].shape[1]
                     
-                    caption = generated_texts[0].strip()
+                    with torch.no_grad():
+                        # 超过30词或写完一句即停止，只解码新生成的部分
+                        generated_ids = model.generate(
+                            **inputs,
+                            max_new_tokens=self.max_new_tokens,
+                            do_sample=False,
+                            stopping_criteria=build_caption_stopping_criteria(processor.tokenizer, prompt_length)
+                        )
+                        captions, token_counts = decode_new_tokens(processor.tokenizer, generated_ids, prompt_length)
                     
                     results.append({
                         'image_path': image_path,
-                        'caption': caption,
-                        'success': True
+                        'output_path': task['output_path'],
+                        'caption': captions[0],
+                        'success': True,
+                        'tokens_saved': self.max_new_tokens - token_counts[0]
                     })
                     
                 except Exception as e:
                     print(f"处理图片 {image_path} 时出错: {e}")
                     results.append({
                         'image_path': image_path,
+                        'output_path': task['output_path'],
                         'caption': f"ERROR: 处理失败 - {e}",
                         'success': False
                     })
             
         except Exception as e:
             print(f"批量处理出错: {e}")
-            for image_path in image_paths:
+            done = {result['image_path'] for result in results}
+            for task in batch_tasks:
+                if task['image_path'] in done:
+                    continue
                 results.append({
-                    'image_path': image_path,
+                    'image_path': task['image_path'],
+                    'output_path': task['output_path'],
                     'caption': f"ERROR: 批量处理失败 - {e}",
                     'success': False
                 })
@@ -222,18 +250,21 @@ class MultiGPUCaptionGenerator:
         batches = self.create_batches(all_tasks)
         print(f"分成 {len(batches)} 个批次，每个批次 {self.batch_size} 张图片")
         
-        # 创建队列
-        task_queue = Queue(maxsize=len(batches) + self.num_gpus)
-        result_queue = Queue()
-        progress_queue = Queue()
+        # 创建有界队列：派发线程按容量逐步放入批次，结果队列满时工作进程阻塞等待写出
+        task_capacity = self.num_gpus * TASK_PREFETCH_PER_WORKER
+        result_capacity = self.num_gpus * max(RESULT_QUEUE_PER_WORKER, self.batch_size)
+        task_queue = Queue(maxsize=task_capacity)
+        result_queue = Queue(maxsize=result_capacity)
+        progress_queue = Queue(maxsize=PROGRESS_QUEUE_SIZE)
+        occupancy = QueueOccupancy({
+            'task': (task_queue, task_capacity),
+            'result': (result_queue, result_capacity),
+        })
         
-        # 将批次任务放入队列
-        for batch in batches:
-            task_queue.put(batch)
-        
-        # 添加结束信号
-        for _ in range(self.num_gpus):
-            task_queue.put(None)
+        # 将批次任务和结束信号交给派发线程
+        feeder = TaskFeeder(task_queue, batches, sentinels=self.num_gpus,
+                            max_memory_percent=self.max_memory_percent)
+        feeder.start()
         
         # 启动工作进程
         processes = []
@@ -248,6 +279,7 @@ class MultiGPUCaptionGenerator:
         # 监控进度
         total_processed = 0
         total_images = len(all_tasks)
+        total_tokens_saved = 0
         
         with tqdm(total=total_images, desc="处理进度") as pbar:
             start_time = time.time()
@@ -266,7 +298,9 @@ class MultiGPUCaptionGenerator:
                         print(f"处理失败: {result['image_path']} - {result['caption']}")
                     
                     total_processed += 1
+                    total_tokens_saved += result.get('tokens_saved', 0)
                     pbar.update(1)
+                    occupancy.sample()
                     
                     # 显示速度信息
                     if total_processed % 100 == 0:
@@ -274,7 +308,8 @@ class MultiGPUCaptionGenerator:
                         speed = total_processed / elapsed
                         pbar.set_postfix({
                             'speed': f'{speed:.2f} img/s',
-                            'GPU利用率': f'{self.num_gpus}x'
+                            'GPU利用率': f'{self.num_gpus}x',
+                            'queues': occupancy.current()
                         })
                 
                 except Empty:
@@ -284,6 +319,7 @@ class MultiGPUCaptionGenerator:
                     break
         
         # 等待所有进程结束
+        feeder.stop()
         for p in processes:
             p.join()
         
@@ -291,12 +327,26 @@ class MultiGPUCaptionGenerator:
         print(f"\n处理完成!")
         print(f"总用时: {elapsed_time:.2f} 秒")
         print(f"平均速度: {total_processed / elapsed_time:.2f} 图片/秒")
+        if total_processed > 0:
+            print(f"提前停止平均节省: {total_tokens_saved / total_processed:.1f} token/图")
+        print(feeder.summary())
+        print(occupancy.summary())
         print(f"GPU加速比: {self.num_gpus}x")
 
 def main():
     # 配置参数
     NUM_GPUS = 8  # GPU数量
     BATCH_SIZE = 8  # 每个GPU每次处理的图片数
+    MAX_NEW_TOKENS = 64  # 最大生成长度（30词以内的描述通常不超过50个token）
+    
+    # 如果存在自动调优结果，则覆盖上面的默认值
+    config = apply_profile({
+        'num_gpus': NUM_GPUS,
+        'batch_size': BATCH_SIZE,
+        'max_new_tokens': MAX_NEW_TOKENS,
+    }, load_profile())
+    NUM_GPUS = config['num_gpus']
+    BATCH_SIZE = config['batch_size']
     
     print(f"配置: {NUM_GPUS} 个GPU, 每个GPU批次大小: {BATCH_SIZE}")
     print(f"理论并行处理能力: {NUM_GPUS * BATCH_SIZE} 张图片/批次")
@@ -304,7 +354,8 @@ def main():
     # 创建并运行处理器
     generator = MultiGPUCaptionGenerator(
         num_gpus=NUM_GPUS,
-        batch_size=BATCH_SIZE
+        batch_size=BATCH_SIZE,
+        max_new_tokens=config['max_new_tokens']
     )
     
     generator.run()
@@ -0,0 +1,115 @@
+import json
+import os
+
+from caption_decoding import DEFAULT_MAX_CAPTION_WORDS
+from lazy_imports import lazy_import
+
+# 预置的输出类型：键名 -> 提示词和输出约定
+# caption 写入原有的描述文件，其他键写入 <图片>.<键名>.txt；max_new_tokens 为 None 时使用生成器的设置
+PROMPT_PRESETS = {
+    'caption': {
+        'instruction': "describe the image briefly, within 30 words, output the description directly, do not start with 'the image is' or 'the photo is' or 'I can see' or anything that start with this image.",
+        'max_words': DEFAULT_MAX_CAPTION_WORDS,
+        'stop_on_sentence_end': True,
+        'max_new_tokens': None,
+    },
+    'description': {
+        'instruction': "describe the image in detail in two or three sentences: the subject, colors, composition and style. output the description directly, do not start with 'the image is'.",
+        'max_words': 80,
+        'stop_on_sentence_end': False,
+        'max_new_tokens': 128,
+    },
+    'tags': {
+        'instruction': "list up to 8 short style tags for the image (for example flat, line art, watercolor, 3d, minimal), separated by commas. output the tags only.",
+        'max_words': 16,
+        'stop_on_sentence_end': False,
+        'max_new_tokens': 40,
+    },
+}
+
+PRIMARY_PROMPT = 'caption'
+
+
+def load_prompts(spec):
+    """解析 --prompts：逗号分隔的预置键名，或 JSON 文件 {键名: 提示词 或 {"instruction": ..., "max_words": ...}}
+
+    返回有序字典 {键名: 提示词设置}，未指定时返回 None（单提示词模式）。
+    """
+    if not spec:
+        return None
+
+    if os.path.exists(spec):
+        with open(spec, 'r', encoding='utf-8') as f:
+            custom = json.load(f)
+        prompts = {}
+        for key, prompt in custom.items():
+            if isinstance(prompt, str):
+                prompt = {'instruction': prompt}
+            prompts[key] = {
+                'instruction': prompt['instruction'],
+                'max_words': prompt.get('max_words', DEFAULT_MAX_CAPTION_WORDS),
+                'stop_on_sentence_end': prompt.get('stop_on_sentence_end', True),
+                'max_new_tokens': prompt.get('max_new_tokens'),
+            }
+        return prompts
+
+    keys = [key.strip() for key in spec.split(",") if key.strip()]
+    unknown = [key for key in keys if key not in PROMPT_PRESETS]
+    if unknown:
+        raise ValueError(f"未知的提示词 {unknown}，可选: {', '.join(PROMPT_PRESETS)}，或传入 JSON 文件")
+    return {key: PROMPT_PRESETS[key] for key in keys}
+
+
+def build_prompt_messages(instruction):
+    """单图提示的消息模板"""
+    return [
+        {
+            "role": "user",
+            "content": [
+                {"type": "image"},
+                {"type": "text", "text": instruction},
+            ],
+        }
+    ]
+
+
+def prompt_output_path(output_path, key):
+    """每个输出键对应的文件：caption 沿用原路径，其他键在扩展名前插入键名"""
+    if key == PRIMARY_PROMPT:
+        return output_path
+    root, ext = os.path.splitext(output_path)
+    return f"{root}.{key}{ext}"
+
+
+def missing_prompts(output_path, prompts):
+    """返回输出文件还不存在的键名，已经生成过的输出不再重复生成"""
+    return [key for key in prompts if not os.path.exists(prompt_output_path(output_path, key))]
+
+
+def write_outputs(result):
+    """写出一个结果的全部输出，单提示词结果只写 caption"""
+    outputs = result.get('outputs') or {PRIMARY_PROMPT: result['caption']}
+    for key, text in outputs.items():
+        with open(prompt_output_path(result['output_path'], key), "w", encoding='utf-8') as file:
+            file.write(text)
+
+
+def encode_images(model, pixel_values, pixel_attention_mask):
+    """只运行一次视觉编码器和连接器，返回每个子图的视觉特征 (子图数, image_seq_len, hidden)
+
+    模型没有 get_image_features（较旧的 transformers）时返回 None，由调用方退回逐行编码。
+    """
+    inner = getattr(model, "model", model)
+    get_image_features = getattr(inner, "get_image_features", None)
+    if get_image_features is None:
+        return None
+    return get_image_features(pixel_values, pixel_attention_mask)
+
+
+def select_image_features(features, num_images, image_indices):
+    """按行取出对应图片的视觉特征，多个提示词共享同一份编码结果"""
+    torch = lazy_import("torch")
+    crops = features.shape[0] // num_images
+    per_image = features.view(num_images, crops, *features.shape[1:])
+    index = torch.tensor(image_indices, device=features.device)
+    return per_image[index].reshape(-1, *features.shape[1:])
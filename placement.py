@@ -0,0 +1,89 @@
+import json
+from collections import OrderedDict
+
+from cpu_backend import partition_cores
+
+
+def parse_device_list(value, device_type="cuda"):
+    """解析设备列表，例如 "0,2,3" -> ["cuda:0", "cuda:2", "cuda:3"]"""
+    devices = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        devices.append(item if ":" in item or item == "cpu" else f"{device_type}:{item}")
+    return devices
+
+
+def build_placement(devices, replicas_per_device=1, memory_fraction=None, cpu_threads_per_worker=None):
+    """生成 工作进程 -> 设备 的放置表，每个设备可以放多个副本"""
+    placement = []
+    for device in devices:
+        for replica in range(replicas_per_device):
+            placement.append({
+                'worker_id': len(placement),
+                'device': device,
+                'replica': replica,
+                'memory_fraction': memory_fraction,
+                'cores': None
+            })
+    return assign_cpu_cores(placement, cpu_threads_per_worker)
+
+
+def load_placement_file(path, cpu_threads_per_worker=None):
+    """从JSON文件读取放置表
+
+    文件格式: [{"device": "cuda:0", "replicas": 2, "memory_fraction": 0.45}, {"device": "cuda:3"}]
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        entries = json.load(f)
+
+    placement = []
+    for entry in entries:
+        for replica in range(entry.get('replicas', 1)):
+            placement.append({
+                'worker_id': len(placement),
+                'device': entry['device'],
+                'replica': replica,
+                'memory_fraction': entry.get('memory_fraction'),
+                'cores': entry.get('cores')
+            })
+    return assign_cpu_cores(placement, cpu_threads_per_worker)
+
+
+def assign_cpu_cores(placement, cpu_threads_per_worker=None):
+    """为没有指定核心的CPU工作进程平均分配互不重叠的核心"""
+    cpu_workers = [p for p in placement if p['device'] == "cpu" and p['cores'] is None]
+    if cpu_workers:
+        core_sets = partition_cores(len(cpu_workers), cpu_threads_per_worker)
+        for worker, cores in zip(cpu_workers, core_sets):
+            worker['cores'] = cores
+    return placement
+
+
+def device_index(device):
+    """返回 "cuda:3" 中的设备序号，CPU 返回 None"""
+    if device.startswith("cuda:"):
+        return int(device.split(":", 1)[1])
+    return None
+
+
+def group_by_device(placement):
+    """按设备分组，返回 {设备: [worker_id, ...]}"""
+    groups = OrderedDict()
+    for worker in placement:
+        groups.setdefault(worker['device'], []).append(worker['worker_id'])
+    return groups
+
+
+def format_placement(placement):
+    """把放置表格式化为日志行"""
+    lines = []
+    for worker in placement:
+        line = f"Worker {worker['worker_id']} -> {worker['device']} (副本 {worker['replica']}"
+        if worker['memory_fraction'] is not None:
+            line += f", 显存上限 {worker['memory_fraction']:.0%}"
+        if worker['cores'] is not None:
+            line += f", 核心 {worker['cores'][0]}-{worker['cores'][-1]}"
+        lines.append(line + ")")
+    return lines
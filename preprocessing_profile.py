@@ -0,0 +1,83 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# 按模型名覆盖内置预处理设置的配置文件，格式: {"模型名": {"do_image_splitting": false, "longest_edge": 980}}
+DEFAULT_PREPROCESS_PROFILE_PATH = "preprocess_profiles.json"
+
+# 内置的每模型预处理设置：决定每张图片实际占用的视觉 token 数
+# idefics2：每个子图经 perceiver 压缩为 image_seq_len 个 token；开启切分时为 4 个切片 + 原图
+BUILTIN_PREPROCESS_PROFILES = {
+    "HuggingFaceM4/idefics2-8b": {
+        "do_image_splitting": False,
+        "longest_edge": 980,
+        "shortest_edge": 378,
+        "image_seq_len": 64,
+        "image_token": "<image>",
+    },
+}
+
+# 未知模型的默认值：不改动处理器，只用于估算
+FALLBACK_PREPROCESS_PROFILE = {
+    "do_image_splitting": None,
+    "longest_edge": None,
+    "shortest_edge": None,
+    "image_seq_len": 64,
+    "image_token": "<image>",
+}
+
+# 可以由命令行 / 调优结果覆盖的预处理参数
+PREPROCESS_KEYS = ("do_image_splitting", "longest_edge")
+
+
+def load_preprocess_profile(model_name, path=DEFAULT_PREPROCESS_PROFILE_PATH, overrides=None):
+    """内置设置 < 配置文件中该模型的条目 < overrides（值为 None 的项忽略）"""
+    profile = dict(FALLBACK_PREPROCESS_PROFILE)
+    profile.update(BUILTIN_PREPROCESS_PROFILES.get(model_name, {}))
+
+    if path and os.path.exists(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                profile.update(json.load(f).get(model_name, {}))
+        except Exception as e:
+            logger.warning(f"读取预处理配置 {path} 失败: {e}")
+
+    for key, value in (overrides or {}).items():
+        if value is not None:
+            profile[key] = value
+    return profile
+
+
+def apply_preprocess_profile(processor, profile):
+    """把切分和分辨率设置写入处理器，之后的每次调用都按该预算生成视觉 token"""
+    image_processor = getattr(processor, "image_processor", None)
+    if image_processor is None:
+        return
+    if profile.get("do_image_splitting") is not None and hasattr(image_processor, "do_image_splitting"):
+        image_processor.do_image_splitting = profile["do_image_splitting"]
+    size = dict(getattr(image_processor, "size", None) or {})
+    for key in ("longest_edge", "shortest_edge"):
+        if profile.get(key) is not None:
+            size[key] = profile[key]
+    if size:
+        image_processor.size = size
+
+
+def estimate_vision_tokens(profile):
+    """按配置估算每张图片的视觉 token 数（不加载处理器）"""
+    crops = 5 if profile.get("do_image_splitting") else 1
+    return profile["image_seq_len"] * crops
+
+
+def count_vision_tokens(processor, input_ids, profile):
+    """统计处理器实际生成的每行视觉 token 数"""
+    image_token_id = processor.tokenizer.convert_tokens_to_ids(profile["image_token"])
+    return (input_ids == image_token_id).sum(dim=1).tolist()
+
+
+def describe_preprocess_profile(profile):
+    splitting = profile.get("do_image_splitting")
+    return (f"切分 {'默认' if splitting is None else ('开' if splitting else '关')}, "
+            f"最长边 {profile.get('longest_edge') or '默认'}, 预计 {estimate_vision_tokens(profile)} 视觉token/图")
@@ -0,0 +1,72 @@
+import heapq
+import itertools
+import time
+from queue import Full
+
+from task_trace import mark
+
+
+class RetryScheduler:
+    """延后重试：失败的图片不在GPU工作进程里原地 sleep 重试，而是交回主进程排队
+
+    每次重试按指数退避延后，并换用更保守的设置（单张一批、更小的缩放尺寸），
+    到期后放入独立的重试队列；工作进程只在主任务队列暂时为空时才处理重试队列。
+    """
+
+    def __init__(self, retry_queue, max_retries=3, backoff=2.0, resize_factor=0.75, base_image_size=1024):
+        self.retry_queue = retry_queue
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.resize_factor = resize_factor
+        self.base_image_size = base_image_size
+
+        self.heap = []
+        self.counter = itertools.count()
+        self.stats = {'scheduled': 0, 'succeeded': 0, 'failed': 0}
+
+    def schedule(self, result):
+        """登记一个需要重试的结果；超过重试次数时返回最终失败结果，否则返回 None"""
+        task = result['retry_task']
+        attempt = task.get('retry_attempt', 0) + 1
+
+        if attempt > self.max_retries:
+            self.stats['failed'] += 1
+            final = {key: value for key, value in result.items() if key not in ('retry', 'retry_task')}
+            final['caption'] = f"ERROR: 处理失败，已重试 {self.max_retries} 次 - {result['caption']}"
+            return final
+
+        retry_task = dict(task)
+        retry_task['retry_attempt'] = attempt
+        retry_task['max_image_size'] = int(self.base_image_size * self.resize_factor ** attempt)
+
+        ready_at = time.time() + self.backoff * 2 ** (attempt - 1)
+        heapq.heappush(self.heap, (ready_at, next(self.counter), retry_task))
+        self.stats['scheduled'] += 1
+        return None
+
+    def pump(self):
+        """把到期的重试任务以单张批次放入重试队列，返回放入的数量"""
+        now = time.time()
+        released = 0
+        while self.heap and self.heap[0][0] <= now:
+            try:
+                self.retry_queue.put_nowait([self.heap[0][2]])
+            except Full:
+                # 重试队列有容量上限，放不下的留到下一次
+                break
+            _, _, task = heapq.heappop(self.heap)
+            mark(task, 'retry_released', 'retry_backoff')
+            released += 1
+        return released
+
+    def record(self, result):
+        """统计重试成功的结果"""
+        if result['success'] and result.get('attempt', 0) > 0:
+            self.stats['succeeded'] += 1
+
+    def pending(self):
+        return len(self.heap)
+
+    def summary(self):
+        return (f"重试: 登记 {self.stats['scheduled']} 次, 重试后成功 {self.stats['succeeded']}, "
+                f"最终失败 {self.stats['failed']}, 等待中 {self.pending()}")
@@ -0,0 +1,169 @@
+import logging
+import time
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+from lazy_imports import lazy_import
+
+logger = logging.getLogger(__name__)
+
+
+class ShmRing:
+    """共享内存环形缓冲区：固定大小的槽位承载张量数据，队列里只传递很小的描述符
+
+    生产者 acquire 一个空闲槽位、把数据拷入共享内存后发出描述符；消费者按描述符
+    直接在共享内存上构造数组（不拷贝、不 pickle），用完后 release 把槽位还回空闲队列。
+    没有空闲槽位时生产者阻塞，槽位数即在途数据的上限。
+    """
+
+    def __init__(self, slot_bytes, num_slots=8, name=None, ctx=None):
+        self.slot_bytes = slot_bytes
+        self.num_slots = num_slots
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=slot_bytes * num_slots)
+        self.owner = True
+        self.free_slots = (ctx or mp).Queue()
+        for slot in range(num_slots):
+            self.free_slots.put(slot)
+
+    def __getstate__(self):
+        # 子进程按名字重新挂载同一块共享内存
+        return {
+            'slot_bytes': self.slot_bytes,
+            'num_slots': self.num_slots,
+            'name': self.shm.name,
+            'free_slots': self.free_slots,
+        }
+
+    def __setstate__(self, state):
+        self.slot_bytes = state['slot_bytes']
+        self.num_slots = state['num_slots']
+        self.free_slots = state['free_slots']
+        self.shm = shared_memory.SharedMemory(name=state['name'])
+        self.owner = False
+
+    def slot_view(self, slot, nbytes):
+        offset = slot * self.slot_bytes
+        return self.shm.buf[offset:offset + nbytes]
+
+    def write(self, data, meta=None, timeout=None):
+        """把一个数组（numpy / CPU 张量 / bytes）写入空闲槽位，返回描述符"""
+        if hasattr(data, 'numpy') and hasattr(data, 'detach'):
+            data = data.detach().cpu().numpy()
+
+        descriptor = {'meta': meta}
+        if hasattr(data, 'dtype') and hasattr(data, 'shape'):
+            numpy = lazy_import("numpy")
+            data = numpy.ascontiguousarray(data)
+            descriptor['dtype'] = data.dtype.str
+            descriptor['shape'] = data.shape
+
+        source = memoryview(data).cast('B')
+        if source.nbytes > self.slot_bytes:
+            raise ValueError(f"数据 {source.nbytes} 字节超过槽位大小 {self.slot_bytes}")
+
+        slot = self.free_slots.get(timeout=timeout)
+        self.slot_view(slot, source.nbytes)[:] = source
+        descriptor['slot'] = slot
+        descriptor['nbytes'] = source.nbytes
+        return descriptor
+
+    def read(self, descriptor):
+        """按描述符返回共享内存上的视图；release 之前有效，需要保留时请自行拷贝"""
+        view = self.slot_view(descriptor['slot'], descriptor['nbytes'])
+        if 'dtype' not in descriptor:
+            return view
+        numpy = lazy_import("numpy")
+        return numpy.frombuffer(view, dtype=descriptor['dtype']).reshape(descriptor['shape'])
+
+    def read_tensor(self, descriptor):
+        """以 torch 张量形式读取（与共享内存共用存储）"""
+        torch = lazy_import("torch")
+        return torch.from_numpy(self.read(descriptor))
+
+    def release(self, descriptor):
+        self.free_slots.put(descriptor['slot'])
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def _queue_consumer(data_queue, stats_queue):
+    latencies = []
+    while True:
+        item = data_queue.get()
+        if item is None:
+            break
+        sent_at, data = item
+        data[-1]  # 访问一次数据，与环形缓冲区路径保持一致
+        latencies.append(time.time() - sent_at)
+    stats_queue.put(latencies)
+
+
+def _ring_consumer(ring, descriptor_queue, stats_queue):
+    latencies = []
+    while True:
+        descriptor = descriptor_queue.get()
+        if descriptor is None:
+            break
+        data = ring.read(descriptor)
+        data[-1]
+        latencies.append(time.time() - descriptor['meta'])
+        del data
+        ring.release(descriptor)
+    ring.shm.close()
+    stats_queue.put(latencies)
+
+
+def _summarize(name, payload_bytes, iterations, elapsed, latencies):
+    latencies = sorted(latencies)
+    return {
+        'transport': name,
+        'payload_mb': payload_bytes / 1024**2,
+        'iterations': iterations,
+        'mb_per_sec': payload_bytes * iterations / 1024**2 / elapsed,
+        'latency_p50_ms': latencies[len(latencies) // 2] * 1000,
+        'latency_p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+    }
+
+
+def benchmark_transport(payload_mb=8, iterations=50, num_slots=4):
+    """比较 pickle 的 multiprocessing.Queue 与共享内存环形缓冲区的吞吐和延迟"""
+    payload_bytes = int(payload_mb * 1024**2)
+    try:
+        numpy = lazy_import("numpy")
+        payload = numpy.random.rand(payload_bytes // 4).astype(numpy.float32)
+    except ImportError:
+        payload = bytearray(payload_bytes)
+    ctx = mp.get_context('spawn')
+    results = []
+
+    # pickle 路径：数据随消息一起序列化、写入管道、在另一端反序列化
+    data_queue = ctx.Queue(maxsize=num_slots)
+    stats_queue = ctx.Queue()
+    consumer = ctx.Process(target=_queue_consumer, args=(data_queue, stats_queue))
+    consumer.start()
+    start = time.time()
+    for _ in range(iterations):
+        data_queue.put((time.time(), payload))
+    data_queue.put(None)
+    latencies = stats_queue.get()
+    results.append(_summarize('queue', payload_bytes, iterations, time.time() - start, latencies))
+    consumer.join()
+
+    # 共享内存路径：数据拷入槽位一次，队列里只有描述符
+    ring = ShmRing(payload_bytes, num_slots, ctx=ctx)
+    descriptor_queue = ctx.Queue()
+    consumer = ctx.Process(target=_ring_consumer, args=(ring, descriptor_queue, stats_queue))
+    consumer.start()
+    start = time.time()
+    for _ in range(iterations):
+        descriptor_queue.put(ring.write(payload, meta=time.time()))
+    descriptor_queue.put(None)
+    latencies = stats_queue.get()
+    results.append(_summarize('shm_ring', payload_bytes, iterations, time.time() - start, latencies))
+    consumer.join()
+    ring.close()
+
+    return results
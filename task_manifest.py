@@ -0,0 +1,115 @@
+import json
+import os
+from collections import Counter
+
+# 不需要生成描述的元素类型
+SKIPPED_ELEMENT_TYPES = ("TextElement", "ImageElement")
+
+DEFAULT_JSONS_DIR = "./jsons"
+DEFAULT_DETAIL_DIR = "./json_detail"
+DEFAULT_OUTPUT_DIR = "./shape_descriptions"
+
+
+def shape_output_path(image_file, output_dir=DEFAULT_OUTPUT_DIR):
+    """由图片文件名推导描述文件路径"""
+    return f"{output_dir}/{image_file}.txt"
+
+
+def load_template(json_file, jsons_dir=DEFAULT_JSONS_DIR, detail_dir=DEFAULT_DETAIL_DIR):
+    """读取一个模板的 jsons / json_detail 两份描述，返回 (模板名, data, detail)"""
+    name = json_file[:json_file.rfind(".")]
+
+    with open(f"{jsons_dir}/{json_file}") as file:
+        data = json.load(file)
+
+    with open(f"{detail_dir}/{json_file}") as file:
+        detail = json.load(file)
+
+    return name, data, detail
+
+
+def iter_template_shapes(name, data, detail):
+    """遍历一个模板中需要生成描述的形状元素"""
+    types = detail["types"]
+    images = data["images"]
+
+    for img_idx in range(len(detail["images"])):
+        if types[img_idx] not in SKIPPED_ELEMENT_TYPES:
+            yield {
+                'image_path': images[img_idx]["file"],
+                'json_name': name,
+                'type': types[img_idx]
+            }
+
+
+def iter_pending_shapes(jsons_dir=DEFAULT_JSONS_DIR, detail_dir=DEFAULT_DETAIL_DIR, output_dir=DEFAULT_OUTPUT_DIR):
+    """逐个产生还没有描述文件的形状元素 (模板名, 图片路径)，不在内存中保留整个任务列表"""
+    for _json in os.listdir(jsons_dir):
+        try:
+            name, data, detail = load_template(_json, jsons_dir, detail_dir)
+            if len(detail["images"]) != len(data["images"]):
+                continue
+            shapes = list(iter_template_shapes(name, data, detail))
+        except Exception:
+            continue
+        for shape in shapes:
+            if not os.path.exists(shape_output_path(shape['image_path'], output_dir)):
+                yield name, shape['image_path']
+
+
+def scan_manifest(jsons_dir=DEFAULT_JSONS_DIR, detail_dir=DEFAULT_DETAIL_DIR,
+                  output_dir=DEFAULT_OUTPUT_DIR, skip_files=None):
+    """扫描全部模板，统计待处理任务（与各生成脚本的 prepare_tasks 规则一致，但不产生副作用）"""
+    if skip_files is None:
+        skip_files = set()
+
+    summary = {
+        'templates': 0,
+        'mismatched_templates': [],
+        'broken_templates': [],
+        'shape_elements': 0,
+        'already_done': 0,
+        'checkpoint_skipped': 0,
+        'pending_tasks': [],
+        'duplicates': {},
+    }
+
+    for _json in os.listdir(jsons_dir):
+        summary['templates'] += 1
+        try:
+            name, data, detail = load_template(_json, jsons_dir, detail_dir)
+        except Exception as e:
+            summary['broken_templates'].append((_json, str(e)))
+            continue
+
+        if len(detail["images"]) != len(data["images"]):
+            summary['mismatched_templates'].append(name)
+            continue
+
+        try:
+            shapes = list(iter_template_shapes(name, data, detail))
+        except Exception as e:
+            summary['broken_templates'].append((_json, str(e)))
+            continue
+
+        for shape in shapes:
+            summary['shape_elements'] += 1
+            image_file = shape['image_path']
+
+            if image_file in skip_files:
+                summary['checkpoint_skipped'] += 1
+                continue
+
+            output_path = shape_output_path(image_file, output_dir)
+            if os.path.exists(output_path):
+                summary['already_done'] += 1
+                continue
+
+            shape['output_path'] = output_path
+            summary['pending_tasks'].append(shape)
+
+    # 同一张图片在多个模板中出现时会被重复处理，写入同一个输出文件
+    counts = Counter(task['image_path'] for task in summary['pending_tasks'])
+    summary['duplicates'] = {path: count for path, count in counts.items() if count > 1}
+
+    return summary
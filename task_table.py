@@ -0,0 +1,185 @@
+import logging
+import pickle
+import time
+from array import array
+
+from task_manifest import DEFAULT_OUTPUT_DIR, shape_output_path
+
+logger = logging.getLogger(__name__)
+
+
+class TaskTable:
+    """紧凑任务表：数百万个任务不再各自是一个字典
+
+    - 图片路径拼接在一个 bytes 缓冲区中，按偏移数组切分，不为每个任务保留字符串对象
+    - 模板名只存一份，任务只记模板序号（array('I')）
+    - output_path 按图片路径即时推导，不存储
+    - 已检查过的任务记在一个标志字节数组中
+    任务表在工作进程启动时随生成器传递一次，之后批次只传 range 或序号列表；
+    需要携带额外状态的少数任务（抽样追踪）放在 inline 中，随批次以字典形式传递。
+    """
+
+    VALIDATED = 1
+    # 可以由任务表推导的字段；带其他字段（追踪记录、部分提示词等）的任务需要内联
+    DERIVED_KEYS = frozenset(('image_path', 'output_path', 'json_name', 'task_index', 'validated'))
+
+    def __init__(self, output_dir=DEFAULT_OUTPUT_DIR):
+        self.output_dir = output_dir
+        self.templates = []
+        self.template_index = {}
+        self.template_ids = array('I')
+        self.path_blob = bytearray()
+        self.path_offsets = array('Q', [0])
+        self.flags = bytearray()
+        self.inline = {}  # 任务序号 -> 任务字典（带追踪记录等额外状态）
+
+    def __len__(self):
+        return len(self.template_ids)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('template_index')
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.template_index = {name: tid for tid, name in enumerate(self.templates)}
+
+    def template_id(self, name):
+        tid = self.template_index.get(name)
+        if tid is None:
+            tid = self.template_index[name] = len(self.templates)
+            self.templates.append(name)
+        return tid
+
+    def append(self, image_path, json_name, flags=0):
+        """追加一个任务，返回任务序号"""
+        self.path_blob += image_path.encode('utf-8')
+        self.path_offsets.append(len(self.path_blob))
+        self.template_ids.append(self.template_id(json_name))
+        self.flags.append(flags)
+        return len(self.template_ids) - 1
+
+    def image_path(self, index):
+        return self.path_blob[self.path_offsets[index]:self.path_offsets[index + 1]].decode('utf-8')
+
+    def json_name(self, index):
+        return self.templates[self.template_ids[index]]
+
+    def output_path(self, index):
+        return shape_output_path(self.image_path(index), self.output_dir)
+
+    def task(self, index):
+        """还原成生成器使用的任务字典（只在工作进程处理该批次时创建）"""
+        inline = self.inline.get(index)
+        if inline is not None:
+            return inline
+        image_path = self.image_path(index)
+        task = {
+            'image_path': image_path,
+            'output_path': shape_output_path(image_path, self.output_dir),
+            'json_name': self.json_name(index),
+            'task_index': index
+        }
+        if self.flags[index] & self.VALIDATED:
+            task['validated'] = True
+        return task
+
+    def iter_tasks(self):
+        for index in range(len(self)):
+            yield self.task(index)
+
+    def materialize(self, batch):
+        """批次中的序号还原为任务字典，已经是字典的（追踪任务、重试任务）原样保留"""
+        return [self.task(item) if isinstance(item, int) else item for item in batch]
+
+    def subset(self, tasks, flags=0):
+        """按给定任务字典（如图片检查后的有效任务）重建任务表，保持顺序"""
+        table = TaskTable(self.output_dir)
+        for task in tasks:
+            index = table.append(task['image_path'], task['json_name'], flags)
+            if not self.DERIVED_KEYS.issuperset(task):
+                table.inline[index] = dict(task, task_index=index)
+        return table
+
+    def nbytes(self):
+        """任务表数据本身占用的字节数（不含模板名字符串）"""
+        return (len(self.path_blob) + self.path_offsets.itemsize * len(self.path_offsets)
+                + self.template_ids.itemsize * len(self.template_ids) + len(self.flags))
+
+    def contiguous_batches(self, batch_size):
+        """按顺序切分批次：没有内联任务的批次是一个 range，pickle 后只有几十字节"""
+        batches = []
+        for start in range(0, len(self), batch_size):
+            batch = range(start, min(start + batch_size, len(self)))
+            if any(index in self.inline for index in batch):
+                batch = [self.inline.get(index, index) for index in batch]
+            batches.append(batch)
+        return batches
+
+    def to_refs(self, batches):
+        """把按任务字典切好的批次（模板顺序、分片顺序）转换成序号列表"""
+        return [[task['task_index'] if task['task_index'] not in self.inline else task for task in batch]
+                for batch in batches]
+
+
+def batch_pickle_bytes(batches, sample=None):
+    """批次 pickle 后的总字节数；sample 为抽样批次数，按比例外推"""
+    if not batches:
+        return 0
+    measured = batches if sample is None or len(batches) <= sample else batches[::max(1, len(batches) // sample)]
+    total = sum(len(pickle.dumps(batch, protocol=pickle.HIGHEST_PROTOCOL)) for batch in measured)
+    return int(total * len(batches) / len(measured))
+
+
+def measure_representation(kind, jsons_dir, detail_dir, output_dir, batch_size):
+    """在独立的 spawn 子进程中调用：构建一种任务表示，返回内存峰值和 pickle 字节数"""
+    import resource
+    import tracemalloc
+    from task_manifest import iter_pending_shapes
+
+    # 新进程的 ru_maxrss 只包含本次构建，不会继承其他表示的峰值
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    start = time.perf_counter()
+    if kind == 'dict':
+        tasks = [{'image_path': image_path, 'output_path': shape_output_path(image_path, output_dir),
+                  'json_name': json_name}
+                 for json_name, image_path in iter_pending_shapes(jsons_dir, detail_dir, output_dir)]
+        batches = [tasks[i:i + batch_size] for i in range(0, len(tasks), batch_size)]
+        count = len(tasks)
+        once_bytes = 0
+    else:
+        table = TaskTable(output_dir)
+        for json_name, image_path in iter_pending_shapes(jsons_dir, detail_dir, output_dir):
+            table.append(image_path, json_name)
+        batches = table.contiguous_batches(batch_size)
+        count = len(table)
+        # 任务表随生成器在每个工作进程启动时传递一次
+        once_bytes = len(pickle.dumps(table, protocol=pickle.HIGHEST_PROTOCOL))
+    build_seconds = time.perf_counter() - start
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'kind': kind,
+        'tasks': count,
+        'build_seconds': build_seconds,
+        'python_peak_mb': traced_peak / 1024**2,
+        'rss_growth_mb': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline_kb) / 1024,
+        'batches': len(batches),
+        'batch_pickle_bytes': batch_pickle_bytes(batches, sample=1000),
+        'per_worker_pickle_bytes': once_bytes,
+    }
+
+
+def compare_task_representations(jsons_dir, detail_dir, output_dir, batch_size):
+    """分别在新的子进程中构建字典任务和紧凑任务表，返回两者的测量结果"""
+    import multiprocessing as mp
+
+    ctx = mp.get_context('spawn')
+    results = []
+    for kind in ('dict', 'compact'):
+        with ctx.Pool(1) as pool:
+            results.append(pool.apply(measure_representation, (kind, jsons_dir, detail_dir, output_dir, batch_size)))
+    return results
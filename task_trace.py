@@ -0,0 +1,98 @@
+import json
+import logging
+import random
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TRACE_PATH = "trace.json"
+
+
+def start_trace(task):
+    """给任务附加追踪记录，第一跳 scanned 记为调用时刻，应在扫描到该任务时调用
+
+    追踪记录随任务字典在进程间传递，每经过一跳追加一个 (跳名, 轨道, 时间戳)，
+    相邻两跳之间的耗时记在后一跳的轨道上（队列等待记在队列轨道，处理记在工作进程轨道）。
+    """
+    task['trace'] = {'id': uuid.uuid4().hex[:16], 'events': [('scanned', 'main', time.time())]}
+
+
+class TraceSampler:
+    """扫描任务时按采样率决定是否追踪"""
+
+    def __init__(self, sample_rate, seed=None):
+        self.sample_rate = sample_rate
+        self.rng = random.Random(seed)
+        self.count = 0
+
+    def maybe_start(self, task):
+        if self.sample_rate and self.rng.random() < self.sample_rate:
+            start_trace(task)
+            self.count += 1
+
+
+def mark(item, hop, track):
+    """给带追踪记录的任务或结果追加一跳，未被采样的（以及紧凑任务表中的任务序号）直接跳过"""
+    trace = item.get('trace') if isinstance(item, dict) else None
+    if trace is not None:
+        trace['events'].append((hop, track, time.time()))
+
+
+def mark_all(items, hop, track):
+    for item in items:
+        mark(item, hop, track)
+
+
+class TraceCollector:
+    """收集已完成任务的追踪记录，导出为 Chrome trace-event 格式（chrome://tracing / Perfetto）"""
+
+    def __init__(self, max_traces=2000):
+        self.max_traces = max_traces
+        self.traces = []
+
+    def add(self, result):
+        trace = result.get('trace')
+        if trace is not None and len(self.traces) < self.max_traces:
+            self.traces.append({'id': trace['id'], 'image_path': result['image_path'], 'events': trace['events']})
+
+    def spans(self):
+        """把每条追踪拆成相邻两跳之间的区间：(追踪序号, 追踪, 区间名, 轨道, 开始, 结束)"""
+        for index, trace in enumerate(self.traces):
+            events = trace['events']
+            for (prev_hop, _, start), (hop, track, end) in zip(events, events[1:]):
+                yield index, trace, f"{prev_hop} → {hop}", track, start, end
+
+    def export(self, path=DEFAULT_TRACE_PATH):
+        """每个进程 / 队列一条轨道（pid），同一轨道内每个任务一行（tid）"""
+        tracks = {}
+        events = []
+        for index, trace, name, track, start, end in self.spans():
+            pid = tracks.setdefault(track, len(tracks) + 1)
+            events.append({
+                'name': name,
+                'ph': 'X',
+                'pid': pid,
+                'tid': index,
+                'ts': start * 1e6,
+                'dur': max(0.0, end - start) * 1e6,
+                'args': {'trace_id': trace['id'], 'image_path': trace['image_path']},
+            })
+        for track, pid in tracks.items():
+            events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': track}})
+
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, ensure_ascii=False)
+        logger.info(f"追踪时间线已写入 {path} ({len(self.traces)} 条任务)")
+
+    def summary(self):
+        """各区间的平均 / 最大耗时，便于找出排队和长尾"""
+        durations = {}
+        for _, _, name, _, start, end in self.spans():
+            durations.setdefault(name, []).append(end - start)
+        if not durations:
+            return "追踪: 无样本"
+        lines = [f"追踪: {len(self.traces)} 条任务"]
+        for name, values in durations.items():
+            lines.append(f"  {name}: 平均 {sum(values) / len(values) * 1000:.1f}ms, 最大 {max(values) * 1000:.1f}ms")
+        return "\n".join(lines)
@@ -0,0 +1,184 @@
+import csv
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+from lazy_imports import lazy_import
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TELEMETRY_PATH = "telemetry.jsonl"
+# CSV 使用长格式：每个样本按 主机 / 工作进程 / 设备 / 队列 展开成多行，列固定，弹性扩容的工作进程不会丢列
+CSV_FIELDS = ['time', 'kind', 'id', 'metric', 'value']
+
+
+def queue_depth(q):
+    """multiprocessing.Queue.qsize 在部分平台上不可用"""
+    try:
+        return q.qsize()
+    except NotImplementedError:
+        return None
+
+
+class TelemetrySampler:
+    """资源时序采样线程
+
+    按固定间隔记录主机 CPU/内存、每个工作进程的 RSS、各设备显存以及队列深度，
+    写入 JSONL 或 CSV（按文件扩展名），并在内存中保留最近的样本用于运行结束时的汇总。
+    显存由工作进程在自己的 CUDA 上下文中写入 worker_stats，主进程不调用 torch.cuda。
+    """
+
+    def __init__(self, worker_stats, placement, queues, interval=10.0, buffer_size=4096,
+                 output_path=DEFAULT_TELEMETRY_PATH, warn_percent=90):
+        self.worker_stats = worker_stats
+        self.placement = placement
+        self.queues = queues
+        self.interval = interval
+        self.samples = deque(maxlen=buffer_size)
+        self.output_path = output_path
+        self.warn_percent = warn_percent
+
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.processes = {}
+        self.sample_seconds = 0.0
+        self.sample_count = 0
+        self.started_at = None
+        self.file = None
+        self.csv_writer = None
+
+    def start(self):
+        self.started_at = time.time()
+        if self.output_path:
+            self.file = open(self.output_path, "a", encoding='utf-8', newline='')
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=self.interval + 5)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def loop(self):
+        psutil = lazy_import("psutil")
+        psutil.cpu_percent(interval=None)  # 第一次调用只建立基准
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.record(self.sample())
+            except Exception as e:
+                logger.error(f"资源采样错误: {e}")
+
+    def worker_rss(self, psutil, pid):
+        """工作进程已退出（崩溃或被排空）时返回 None，不影响本次样本的其他字段"""
+        try:
+            process = self.processes.get(pid)
+            if process is None:
+                process = self.processes[pid] = psutil.Process(pid)
+            return process.memory_info().rss / 1024**3
+        except psutil.Error:
+            self.processes.pop(pid, None)
+            return None
+
+    def sample(self):
+        psutil = lazy_import("psutil")
+        start = time.perf_counter()
+
+        memory = psutil.virtual_memory()
+        sample = {
+            'time': time.time(),
+            'cpu_percent': psutil.cpu_percent(interval=None),
+            'ram_used_gb': memory.used / 1024**3,
+            'ram_percent': memory.percent,
+            'workers': {},
+            'devices': {},
+            'queues': {name: queue_depth(q) for name, q in self.queues.items()},
+        }
+
+        for worker in self.placement:
+            stats = self.worker_stats.get(worker['worker_id'])
+            if stats is None:
+                continue
+            rss = self.worker_rss(psutil, stats['pid']) if stats.get('pid') else None
+            sample['workers'][worker['worker_id']] = {
+                'rss_gb': rss,
+                'processed': stats['processed'],
+            }
+            if worker['device'] != "cpu":
+                device = sample['devices'].setdefault(worker['device'], {'allocated_gb': 0.0, 'reserved_gb': 0.0})
+                device['allocated_gb'] += stats.get('memory_usage', 0.0)
+                device['reserved_gb'] += stats.get('memory_reserved', 0.0)
+
+        self.sample_seconds += time.perf_counter() - start
+        self.sample_count += 1
+        return sample
+
+    def record(self, sample):
+        self.samples.append(sample)
+
+        if sample['cpu_percent'] > self.warn_percent or sample['ram_percent'] > self.warn_percent:
+            logger.warning(f"系统资源紧张 - CPU: {sample['cpu_percent']}%, 内存: {sample['ram_percent']}%")
+
+        if self.file is None:
+            return
+        if self.output_path.endswith(".csv"):
+            self.write_csv_row(sample)
+        else:
+            self.file.write(json.dumps(sample, ensure_ascii=False) + "\n")
+        self.file.flush()
+
+    def write_csv_row(self, sample):
+        """CSV 长格式：每个 (对象, 指标) 一行，例如 worker,3,rss_gb,1.2；运行中新增的工作进程和设备直接多出行"""
+        rows = [(kind, '', name, sample[name]) for kind, name in
+                (('host', 'cpu_percent'), ('host', 'ram_used_gb'), ('host', 'ram_percent'))]
+        for kind, section in (('worker', 'workers'), ('device', 'devices')):
+            for key, values in sample[section].items():
+                rows.extend((kind, key, name, value) for name, value in values.items())
+        rows.extend(('queue', name, 'depth', depth) for name, depth in sample['queues'].items())
+
+        if self.csv_writer is None:
+            self.csv_writer = csv.writer(self.file)
+            if self.file.tell() == 0:
+                self.csv_writer.writerow(CSV_FIELDS)
+        self.csv_writer.writerows([sample['time'], kind, key, name, value] for kind, key, name, value in rows)
+
+    def summary(self):
+        """运行结束时的简要汇总"""
+        samples = list(self.samples)
+        if not samples:
+            return "资源采样: 无样本"
+
+        def peak(values):
+            values = [v for v in values if v is not None]
+            return max(values) if values else 0
+
+        cpu = [s['cpu_percent'] for s in samples]
+        lines = [
+            f"资源采样: {len(samples)} 个样本 (间隔 {self.interval}s), "
+            f"CPU 平均 {sum(cpu) / len(cpu):.0f}% / 峰值 {max(cpu):.0f}%, "
+            f"内存峰值 {peak(s['ram_used_gb'] for s in samples):.1f}GB",
+        ]
+
+        worker_ids = sorted({w for s in samples for w in s['workers']})
+        if worker_ids:
+            peaks = [f"W{w}:{peak(s['workers'].get(w, {}).get('rss_gb') for s in samples):.1f}" for w in worker_ids]
+            lines.append(f"  工作进程 RSS 峰值(GB): {' '.join(peaks)}")
+
+        devices = sorted({d for s in samples for d in s['devices']})
+        if devices:
+            peaks = [f"{d}:{peak(s['devices'].get(d, {}).get('reserved_gb') for s in samples):.1f}" for d in devices]
+            lines.append(f"  设备显存保留峰值(GB): {' '.join(peaks)}")
+
+        queue_names = sorted({name for s in samples for name in s['queues']})
+        if queue_names:
+            peaks = [f"{name}:{peak(s['queues'].get(name) for s in samples)}" for name in queue_names]
+            lines.append(f"  队列深度峰值: {' '.join(peaks)}")
+
+        elapsed = time.time() - self.started_at
+        lines.append(f"  采样开销: 每次 {self.sample_seconds / self.sample_count * 1000:.2f}ms, "
+                     f"占运行时间 {self.sample_seconds / elapsed:.4%}")
+        return "\n".join(lines)
@@ -0,0 +1,115 @@
+import json
+import logging
+import os
+import time
+
+from task_manifest import DEFAULT_OUTPUT_DIR, shape_output_path
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TEMPLATE_OUTPUT_DIR = "./template_captions"
+
+
+def create_template_batches(tasks, batch_size):
+    """按模板切分批次：同一模板的元素放在连续批次中，能放进当前批次的小模板不跨批次拆分"""
+    groups = {}
+    for task in tasks:
+        groups.setdefault(task['json_name'], []).append(task)
+
+    batches = []
+    current = []
+    for template_tasks in groups.values():
+        if len(template_tasks) <= batch_size and len(current) + len(template_tasks) > batch_size:
+            batches.append(current)
+            current = []
+        for task in template_tasks:
+            current.append(task)
+            if len(current) == batch_size:
+                batches.append(current)
+                current = []
+    if current:
+        batches.append(current)
+    return batches
+
+
+class TemplateCompletionTracker:
+    """跟踪每个模板的完成情况，模板的全部元素结束后立即写出汇总记录
+
+    汇总记录包含该模板所有形状元素的描述（包括之前运行中已经完成的元素），
+    下游任务不必等整个运行结束就可以使用已完成的模板。
+    """
+
+    def __init__(self, output_dir=DEFAULT_TEMPLATE_OUTPUT_DIR, shape_output_dir=DEFAULT_OUTPUT_DIR):
+        self.output_dir = output_dir
+        self.shape_output_dir = shape_output_dir
+        self.elements = {}
+        self.pending = {}
+        self.failed = {}
+        self.templates_by_image = {}
+        self.completed = 0
+        os.makedirs(output_dir, exist_ok=True)
+
+    def register(self, json_name, shapes, pending_images):
+        """登记一个模板的全部形状元素 [{'image_path', 'type'}] 以及本次待处理的图片"""
+        self.elements[json_name] = shapes
+        self.pending[json_name] = set(pending_images)
+        self.failed[json_name] = {}
+        for image_path in pending_images:
+            self.templates_by_image.setdefault(image_path, set()).add(json_name)
+
+    def start(self):
+        """写出之前已全部完成、但还没有汇总记录的模板"""
+        for json_name, pending in self.pending.items():
+            if not pending and not os.path.exists(self.record_path(json_name)):
+                self.emit(json_name)
+
+    def record(self, result):
+        """登记一张图片的最终结果（成功或最终失败），返回因此完成的模板名列表"""
+        finished = []
+        for json_name in self.templates_by_image.pop(result['image_path'], ()):
+            pending = self.pending[json_name]
+            pending.discard(result['image_path'])
+            if not result['success']:
+                self.failed[json_name][result['image_path']] = result['caption']
+            if not pending:
+                self.emit(json_name)
+                finished.append(json_name)
+        return finished
+
+    def record_path(self, json_name):
+        return f"{self.output_dir}/{json_name}.json"
+
+    def emit(self, json_name):
+        elements = []
+        for shape in self.elements[json_name]:
+            image_path = shape['image_path']
+            caption = None
+            output_path = shape_output_path(image_path, self.shape_output_dir)
+            if os.path.exists(output_path):
+                with open(output_path, encoding='utf-8') as file:
+                    caption = file.read()
+            elements.append({
+                'image_path': image_path,
+                'type': shape.get('type'),
+                'caption': caption,
+                'error': self.failed[json_name].get(image_path)
+            })
+
+        record = {
+            'json_name': json_name,
+            'completed_at': time.time(),
+            'elements': elements,
+            'failed': len(self.failed[json_name])
+        }
+        # 先写临时文件再改名，下游读取时不会看到写了一半的记录
+        path = self.record_path(json_name)
+        with open(path + ".tmp", "w", encoding='utf-8') as file:
+            json.dump(record, file, ensure_ascii=False, indent=2)
+        os.replace(path + ".tmp", path)
+
+        self.completed += 1
+        logger.debug(f"模板 {json_name} 已完成，汇总写入 {path}")
+
+    def summary(self):
+        remaining = sum(1 for pending in self.pending.values() if pending)
+        return f"模板: 共 {len(self.pending)} 个, 已写出汇总 {self.completed} 个, 未完成 {remaining} 个"
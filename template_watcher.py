@@ -0,0 +1,191 @@
+import json
+import logging
+import os
+import time
+
+from caption_service import percentile
+from task_manifest import (DEFAULT_DETAIL_DIR, DEFAULT_JSONS_DIR, DEFAULT_OUTPUT_DIR, iter_template_shapes,
+                           load_template, shape_output_path)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POLL_INTERVAL = 2.0
+DEFAULT_WATCH_REPORT_INTERVAL = 60.0
+DEFAULT_LATENCY_LOG_PATH = "watch_latency.jsonl"
+
+
+class TemplateWatcher:
+    """按 mtime 轮询 jsons / json_detail 目录，找出新增或修改过的模板
+
+    只对目录做 listdir + stat，不重新解析没有变化的模板；两份文件都到齐才算到达，
+    到达时间取两者中较晚的 mtime。解析失败（文件可能还在写入）的模板下一轮重试。
+    """
+
+    def __init__(self, jsons_dir=DEFAULT_JSONS_DIR, detail_dir=DEFAULT_DETAIL_DIR):
+        self.jsons_dir = jsons_dir
+        self.detail_dir = detail_dir
+        self.seen = {}  # json 文件名 -> (jsons mtime, json_detail mtime)
+
+    def stat_pair(self, json_file):
+        try:
+            return (os.stat(os.path.join(self.jsons_dir, json_file)).st_mtime,
+                    os.stat(os.path.join(self.detail_dir, json_file)).st_mtime)
+        except OSError:
+            return None
+
+    def changed(self):
+        """返回 [(json 文件名, mtime 对)]，mtime 对在 mark_seen 后才记录"""
+        changed = []
+        for json_file in os.listdir(self.jsons_dir):
+            mtimes = self.stat_pair(json_file)
+            if mtimes is not None and self.seen.get(json_file) != mtimes:
+                changed.append((json_file, mtimes))
+        return changed
+
+    def mark_seen(self, json_file, mtimes):
+        self.seen[json_file] = mtimes
+
+    def mark_all_seen(self):
+        """启动时把已有的模板全部视为已处理，只关注之后到达的文件"""
+        for json_file, mtimes in self.changed():
+            self.mark_seen(json_file, mtimes)
+        return len(self.seen)
+
+
+class CaptionWatchDaemon:
+    """守护模式：工作进程常驻（复用 CaptionService），新到达模板的形状元素立即提交生成
+
+    报告每张图片从模板文件到达到描述写出的端到端延迟，以及每个模板全部完成的延迟。
+    """
+
+    def __init__(self, service, watcher, output_dir=DEFAULT_OUTPUT_DIR, poll_interval=DEFAULT_POLL_INTERVAL,
+                 report_interval=DEFAULT_WATCH_REPORT_INTERVAL, latency_log_path=DEFAULT_LATENCY_LOG_PATH):
+        self.service = service
+        self.watcher = watcher
+        self.output_dir = output_dir
+        self.poll_interval = poll_interval
+        self.report_interval = report_interval
+        self.latency_log_path = latency_log_path
+
+        self.in_flight = {}  # image_path -> {'request', 'arrival', 'detected', 'templates'}
+        self.template_pending = {}  # 模板名 -> 未完成的图片数
+        self.template_arrival = {}
+        self.image_latencies = []
+        self.template_latencies = []
+        self.templates_seen = 0
+        self.completed = 0
+        self.failed = 0
+
+    def enqueue_template(self, json_file, mtimes):
+        """读取一个新到达的模板，提交还没有描述文件的形状元素，返回提交数；读取失败返回 None"""
+        detected = time.time()
+        try:
+            name, data, detail = load_template(json_file, self.watcher.jsons_dir, self.watcher.detail_dir)
+            if len(detail["images"]) != len(data["images"]):
+                logger.warning(f"图片数量不匹配: {name}")
+                self.watcher.mark_seen(json_file, mtimes)
+                return 0
+            shapes = list(iter_template_shapes(name, data, detail))
+        except Exception as e:
+            logger.debug(f"读取模板 {json_file} 失败，下一轮重试: {e}")
+            return None
+        self.watcher.mark_seen(json_file, mtimes)
+        self.templates_seen += 1
+
+        arrival = max(mtimes)
+        submitted = 0
+        for shape in shapes:
+            image_path = shape['image_path']
+            output_path = shape_output_path(image_path, self.output_dir)
+            if image_path in self.in_flight:
+                # 同一张图片已经在其他模板中提交过，完成时一并计入本模板
+                self.in_flight[image_path]['templates'].append(name)
+            elif os.path.exists(output_path):
+                continue
+            else:
+                self.in_flight[image_path] = {
+                    'request': self.service.submit(image_path, output_path),
+                    'arrival': arrival,
+                    'detected': detected,
+                    'templates': [name]
+                }
+                submitted += 1
+            self.template_pending[name] = self.template_pending.get(name, 0) + 1
+            self.template_arrival[name] = arrival
+
+        if submitted:
+            logger.info(f"新模板 {name}: 提交 {submitted} 张图片，发现延迟 {detected - arrival:.1f}s")
+        return submitted
+
+    def collect(self):
+        """回收已完成的请求，记录端到端延迟"""
+        done = [image_path for image_path, entry in self.in_flight.items() if entry['request'].done.is_set()]
+        records = []
+        for image_path in done:
+            entry = self.in_flight.pop(image_path)
+            request = entry['request']
+            result = request.result
+            # 服务在写出描述文件前记录请求延迟，写出时间取 提交时间 + 延迟
+            written = request.submitted_at + result.get('latency', 0.0)
+            latency = written - entry['arrival']
+            if result['success']:
+                self.completed += 1
+                self.image_latencies.append(latency)
+            else:
+                self.failed += 1
+            records.append({
+                'image_path': image_path,
+                'templates': entry['templates'],
+                'success': result['success'],
+                'arrival': entry['arrival'],
+                'detected': entry['detected'],
+                'written': written,
+                'latency': latency
+            })
+
+            for name in entry['templates']:
+                self.template_pending[name] -= 1
+                if self.template_pending[name] == 0:
+                    del self.template_pending[name]
+                    template_latency = written - self.template_arrival.pop(name)
+                    self.template_latencies.append(template_latency)
+                    logger.info(f"模板 {name} 完成，到达后 {template_latency:.1f}s")
+
+        if records and self.latency_log_path:
+            with open(self.latency_log_path, "a", encoding='utf-8') as file:
+                file.writelines(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+        return len(records)
+
+    def summary(self):
+        lines = [f"守护模式: 模板 {self.templates_seen} 个, 完成 {self.completed} 张, 失败 {self.failed} 张, "
+                 f"处理中 {len(self.in_flight)} 张"]
+        for label, values in (("到达 -> 描述写出", self.image_latencies), ("模板到达 -> 全部完成", self.template_latencies)):
+            if values:
+                lines.append(f"  {label}: p50 {percentile(values, 0.50):.2f}s, p90 {percentile(values, 0.90):.2f}s, "
+                             f"p99 {percentile(values, 0.99):.2f}s, 最大 {max(values):.2f}s ({len(values)} 个)")
+        return "\n".join(lines)
+
+    def run(self, from_now=False):
+        """启动工作进程并持续轮询，直到 Ctrl+C"""
+        if from_now:
+            logger.info(f"跳过已有的 {self.watcher.mark_all_seen()} 个模板，只处理之后到达的文件")
+        self.service.start()
+        last_report = time.time()
+        try:
+            while True:
+                for json_file, mtimes in self.watcher.changed():
+                    self.enqueue_template(json_file, mtimes)
+                self.collect()
+
+                if time.time() - last_report >= self.report_interval:
+                    last_report = time.time()
+                    logger.info(self.summary())
+                time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            logger.info("收到中断信号，等待处理中的图片完成...")
+            while self.in_flight and any(p.is_alive() for p in self.service.processes):
+                self.collect()
+                time.sleep(0.2)
+        finally:
+            self.service.stop()
+            logger.info(self.summary())
@@ -0,0 +1,227 @@
+import glob
+import logging
+import os
+import subprocess
+import time
+from contextlib import contextmanager
+
+from cpu_backend import available_cores, partition_cores
+from lazy_imports import lazy_import
+from placement import device_index
+
+logger = logging.getLogger(__name__)
+
+# 留给主进程（收集循环、tqdm、派发线程、资源采样）和 Manager 进程的核心数
+DEFAULT_RESERVED_CORES = 1
+DEFAULT_INTER_OP_THREADS = 1
+
+# 各阶段在统计和日志中的名称
+STAGE_NAMES = {
+    'load_image': "读图",
+    'preprocess': "预处理",
+    'generate': "生成",
+    'decode': "解码",
+}
+
+
+def parse_cpu_list(text):
+    """解析 sysfs 的 cpulist 格式，例如 "0-15,32-47" """
+    cores = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            cores.extend(range(int(start), int(end) + 1))
+        else:
+            cores.append(int(part))
+    return cores
+
+
+def numa_nodes():
+    """返回 {NUMA 节点: [本进程可用的核心]}，没有 NUMA 信息时返回空字典"""
+    allowed = set(available_cores())
+    nodes = {}
+    for path in glob.glob("/sys/devices/system/node/node[0-9]*/cpulist"):
+        node = int(os.path.basename(os.path.dirname(path))[len("node"):])
+        try:
+            with open(path) as f:
+                cores = [core for core in parse_cpu_list(f.read()) if core in allowed]
+        except OSError:
+            continue
+        if cores:
+            nodes[node] = cores
+    return nodes
+
+
+def gpu_numa_nodes():
+    """通过 nvidia-smi 的 PCI 地址查询每张GPU所在的 NUMA 节点，返回 {进程内设备序号: 节点}"""
+    try:
+        output = subprocess.run(
+            ["nvidia-smi", "--query-gpu=index,pci.bus_id", "--format=csv,noheader"],
+            capture_output=True, text=True, timeout=10, check=True
+        ).stdout
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning(f"查询GPU的 PCI 地址失败，不按 NUMA 分配: {e}")
+        return {}
+
+    visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+    visible = None if visible is None else [item.strip() for item in visible.split(",") if item.strip()]
+    nodes = {}
+    for line in output.strip().splitlines():
+        index, bus_id = [item.strip() for item in line.split(",")]
+        if visible is not None and index not in visible:
+            continue
+        # nvidia-smi 的域是 8 位十六进制，sysfs 使用 4 位小写
+        domain, rest = bus_id.lower().split(":", 1)
+        try:
+            with open(f"/sys/bus/pci/devices/{domain[-4:]}:{rest}/numa_node") as f:
+                node = int(f.read().strip())
+        except (OSError, ValueError):
+            continue
+        if node >= 0:
+            nodes[int(index) if visible is None else visible.index(index)] = node
+    return nodes
+
+
+def plan_thread_budgets(placement, reserved_cores=DEFAULT_RESERVED_CORES, numa_aware=False,
+                        intra_op_threads=None, inter_op_threads=DEFAULT_INTER_OP_THREADS):
+    """为每个工作进程分配互不重叠的核心和线程预算，写入放置表的 'cores' / 'threads' / 'numa_node'
+
+    前 reserved_cores 个核心留给主进程；CPU工作进程的核心与之重叠时在其余核心上重新切分，
+    GPU工作进程平分剩下的核心。numa_aware 时GPU工作进程优先使用其设备所在 NUMA 节点上的核心。
+    返回留给主进程的核心。
+    """
+    cores = available_cores()
+    reserved = cores[:reserved_cores] if len(cores) > reserved_cores else []
+    cpu_workers = [worker for worker in placement if worker['device'] == "cpu" and worker['cores']]
+    if cpu_workers and any(set(worker['cores']) & set(reserved) for worker in cpu_workers):
+        remaining = cores[len(reserved):]
+        per_cpu_worker = min(len(cpu_workers[0]['cores']), len(remaining) // len(cpu_workers))
+        if per_cpu_worker:
+            for worker, worker_cores in zip(cpu_workers, partition_cores(len(cpu_workers), per_cpu_worker, remaining)):
+                worker['cores'] = worker_cores
+        else:
+            logger.warning(f"保留 {len(reserved)} 个核心后不够 {len(cpu_workers)} 个CPU工作进程各分一个，不为主进程保留核心")
+            reserved = []
+    used = set(reserved)
+    for worker in placement:
+        used.update(worker['cores'] or [])
+    free = [core for core in cores if core not in used]
+
+    gpu_workers = [worker for worker in placement if worker['cores'] is None]
+    per_worker = len(free) // len(gpu_workers) if gpu_workers else 0
+    if gpu_workers and per_worker == 0:
+        logger.warning(f"剩余 {len(free)} 个核心不足以给 {len(gpu_workers)} 个GPU工作进程各分一个，只限制线程数")
+
+    nodes = numa_nodes() if numa_aware and per_worker else {}
+    device_nodes = gpu_numa_nodes() if nodes else {}
+    core_node = {core: node for node, node_cores in nodes.items() for core in node_cores}
+
+    for worker in gpu_workers:
+        if not per_worker:
+            break
+        node = device_nodes.get(device_index(worker['device']))
+        local = [core for core in free if core_node.get(core) == node] if node is not None else []
+        # 本节点的核心不够时退回全局顺序分配
+        pool = local if len(local) >= per_worker else free
+        worker['cores'] = pool[:per_worker]
+        free = [core for core in free if core not in worker['cores']]
+
+    for worker in placement:
+        worker['numa_node'] = core_node.get(worker['cores'][0]) if worker['cores'] and core_node else None
+        worker['threads'] = make_thread_budget(len(worker['cores']) if worker['cores'] else 1,
+                                               intra_op_threads, inter_op_threads)
+    return reserved
+
+
+def make_thread_budget(num_cores, intra_op_threads=None, inter_op_threads=DEFAULT_INTER_OP_THREADS):
+    """一个工作进程的线程预算
+
+    intra_op: PyTorch / OpenMP / MKL 算子内并行，默认等于分到的核心数
+    inter_op: PyTorch 算子间并行
+    tokenizers: HF tokenizers 的 rayon 线程池，工作进程内关闭
+    image: 图片解码和预处理（PIL / numpy / OpenBLAS）；PIL 解码本身是单线程的，这里限制的是预处理中的 BLAS 线程
+    """
+    return {
+        'intra_op': intra_op_threads or num_cores,
+        'inter_op': inter_op_threads,
+        'tokenizers': False,
+        'image': 1,
+    }
+
+
+def apply_thread_budget(cores, budget):
+    """在导入 torch / numpy 之前调用：设置亲和性和各线程池的环境变量"""
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    os.environ["OMP_NUM_THREADS"] = str(budget['intra_op'])
+    os.environ["MKL_NUM_THREADS"] = str(budget['intra_op'])
+    os.environ["OPENBLAS_NUM_THREADS"] = str(budget['image'])
+    os.environ["TOKENIZERS_PARALLELISM"] = "true" if budget['tokenizers'] else "false"
+
+
+def reserve_main_process(reserved):
+    """把主进程绑定到保留核心并限制其线程池
+
+    必须在创建 Manager、图片检查进程池等子进程之前调用，它们继承主进程的亲和性和环境变量；
+    工作进程启动时再绑定到各自的核心。
+    """
+    if not reserved:
+        return
+    apply_thread_budget(reserved, make_thread_budget(len(reserved)))
+
+
+def set_torch_threads(budget):
+    """导入 torch 后、执行任何算子前调用"""
+    torch = lazy_import("torch")
+    torch.set_num_threads(budget['intra_op'])
+    try:
+        torch.set_num_interop_threads(budget['inter_op'])
+    except RuntimeError as e:
+        # 算子间线程池一旦启动就不能再修改
+        logger.warning(f"设置 inter-op 线程数失败: {e}")
+
+
+def format_thread_layout(placement, reserved):
+    """启动时打印的线程布局"""
+    lines = [f"主进程保留核心: {reserved or '无'}"]
+    for worker in placement:
+        budget = worker.get('threads')
+        if budget is None:
+            continue
+        cores = worker['cores']
+        node = f", NUMA {worker['numa_node']}" if worker.get('numa_node') is not None else ""
+        lines.append(f"Worker {worker['worker_id']} ({worker['device']}): 核心 {cores if cores else '不绑定'}{node}, "
+                     f"intra-op {budget['intra_op']}, inter-op {budget['inter_op']}, "
+                     f"tokenizers {'并行' if budget['tokenizers'] else '单线程'}, 图片预处理 {budget['image']}")
+    return lines
+
+
+class StageTimer:
+    """按阶段累计本进程的 CPU 时间（包含所有线程）和墙钟时间"""
+
+    def __init__(self):
+        self.stats = {}
+
+    @contextmanager
+    def stage(self, name):
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            entry = self.stats.setdefault(name, {'cpu': 0.0, 'wall': 0.0, 'calls': 0})
+            entry['cpu'] += time.process_time() - cpu_start
+            entry['wall'] += time.perf_counter() - wall_start
+            entry['calls'] += 1
+
+
+def format_stage_cpu(stage_stats, images):
+    """每阶段的 CPU 时间、每张图片的 CPU 毫秒数，以及 CPU/墙钟比（平均占用的核心数）"""
+    parts = []
+    for name, entry in stage_stats.items():
+        ratio = entry['cpu'] / entry['wall'] if entry['wall'] > 0 else 0.0
+        per_image = entry['cpu'] / images * 1000 if images else 0.0
+        parts.append(f"{STAGE_NAMES.get(name, name)} {entry['cpu']:.1f}s ({per_image:.0f}ms/图, {ratio:.2f} 核)")
+    return ", ".join(parts)